@@ -0,0 +1,124 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Benchmark transfer of full-frame camera images over RPC, comparing the
+single-buffer _server_pack_data() reply with the zero-copy multipart
+_server_pack_data_multipart() reply, with and without blocked (parallel)
+compression; and transfer of a stack of images (e.g. from autofocus) one image
+per call versus several per call with _server_pack_many().
+
+For each compressor, report throughput over a TCP loopback connection, and
+the number of image-sized copies made in python while packing on the server
+and unpacking on the client (measured with tracemalloc). Note that sending a
+single-buffer reply also makes a further copy inside ZeroMQ, which tracemalloc
+cannot see; multipart replies are sent with copy=False.
+
+Usage: python image_transfer_benchmark.py [iterations] [stack_size]
+"""
+
+import importlib.util
+import sys
+import time
+import tracemalloc
+
+import numpy
+import zmq
+
+from scope.simple_rpc import rpc_client
+from scope.simple_rpc import rpc_server
+from scope.util import transfer_ism_buffer
+
+SHAPE = (2560, 2160)
+ADDRESS = 'tcp://127.0.0.1:16003'
+
+class Namespace:
+    pass
+
+def make_image():
+    # something like a real image: smooth background plus noise, so compression is realistic
+    x, y = numpy.indices(SHAPE, dtype=numpy.float32)
+    image = 1000 + 500 * numpy.sin(x / 300) * numpy.cos(y / 200) + numpy.random.normal(0, 20, SHAPE)
+    return numpy.asfortranarray(image.astype(numpy.uint16))
+
+def count_copies(function, nbytes):
+    """Return the peak python memory allocated by function(), in units of nbytes."""
+    tracemalloc.start()
+    function()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / nbytes
+
+def measure(image, compressor, reply_type, iterations, client):
+    name = 'benchmark'
+    if reply_type == 'single':
+        command = '_transfer_ism_buffer._server_pack_data'
+        unpack = transfer_ism_buffer._client_unpack_data
+        args = (compressor,)
+    else:
+        command = '_transfer_ism_buffer._server_pack_data_multipart'
+        unpack = transfer_ism_buffer._client_unpack_parts
+        args = (compressor, None, reply_type == 'blocked')
+
+    # copies made on the server while packing
+    transfer_ism_buffer.register_array_for_transfer(name, image)
+    pack = getattr(transfer_ism_buffer, command.split('.')[-1])
+    server_copies = count_copies(lambda: pack(name, *args), image.nbytes)
+
+    # copies made on the client while unpacking
+    transfer_ism_buffer.register_array_for_transfer(name, image)
+    reply = client(command, name, *args)
+    client_copies = count_copies(lambda: unpack(reply, compressor), image.nbytes)
+    assert (unpack(reply, compressor) == image).all()
+
+    t0 = time.perf_counter()
+    for i in range(iterations):
+        transfer_ism_buffer.register_array_for_transfer(name, image)
+        unpack(client(command, name, *args), compressor)
+    elapsed = (time.perf_counter() - t0) / iterations
+    return elapsed, server_copies, client_copies
+
+def measure_stack(images, compressor, get_data):
+    """Return the time to fetch a stack of images one per call, and several per call."""
+    names = ['stack-{}'.format(i) for i in range(len(images))]
+    get_data.set_network_compression(compressor)
+    times = []
+    for fetch in (lambda: [get_data(name) for name in names], lambda: get_data.get_many(names)):
+        for name, image in zip(names, images):
+            transfer_ism_buffer.register_array_for_transfer(name, image)
+        t0 = time.perf_counter()
+        fetched = fetch()
+        times.append(time.perf_counter() - t0)
+        assert all((a == b).all() for a, b in zip(fetched, images))
+    return times
+
+def main(iterations=20, stack_size=24):
+    image = make_image()
+    context = zmq.Context()
+    namespace = Namespace()
+    namespace._transfer_ism_buffer = transfer_ism_buffer
+    server = rpc_server.BackgroundBaseZMQServer(namespace, ADDRESS, context=context)
+    client = rpc_client.ZMQClient(ADDRESS, timeout_sec=60, context=context)
+    compressors = [None, 'zlib']
+    if importlib.util.find_spec('blosc') is not None:
+        compressors.insert(1, 'blosc')
+    print('{}x{} uint16 images ({:.1f} MB), {} iterations'.format(*SHAPE, image.nbytes / 1e6, iterations))
+    print('{:<8} {:<10} {:>10} {:>10} {:>14} {:>14}'.format('codec', 'reply', 'ms/image', 'MB/s', 'server copies', 'client copies'))
+    try:
+        for compressor in compressors:
+            reply_types = ['single', 'multipart', 'blocked'] if compressor == 'zlib' else ['single', 'multipart']
+            for reply_type in reply_types:
+                elapsed, server_copies, client_copies = measure(image, compressor, reply_type, iterations, client)
+                print('{:<8} {:<10} {:>10.1f} {:>10.0f} {:>14.2f} {:>14.2f}'.format(str(compressor),
+                    reply_type, elapsed * 1000, image.nbytes / elapsed / 1e6, server_copies, client_copies))
+        images = [make_image() for i in range(stack_size)]
+        get_data = transfer_ism_buffer._NetworkGetData(client)
+        print('\n{}-image stacks'.format(stack_size))
+        print('{:<8} {:>14} {:>14}'.format('codec', 'ms/image each', 'ms/image many'))
+        for compressor in compressors:
+            each_time, many_time = measure_stack(images, compressor, get_data)
+            print('{:<8} {:>14.1f} {:>14.1f}'.format(str(compressor), each_time * 1000 / stack_size,
+                many_time * 1000 / stack_size))
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,80 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Benchmark finding the callbacks to run for each property update in
+PropertyClient, comparing the previous approach (exact-name callbacks plus a
+scan of a util.trie of prefix callbacks, for every update) with the current
+dispatch cache (a dict of property names to all their callbacks, rebuilt only
+when the subscriptions change).
+
+Subscription counts are chosen to resemble the GUI: a few hundred properties,
+with most of them subscribed individually by widgets, and a handful of prefix
+subscriptions (e.g. from a ScopeClient property cache, a LiveStreamer, or a
+logging script).
+
+Usage: python property_dispatch_benchmark.py [updates]
+"""
+
+import collections
+import sys
+import time
+
+from scope.simple_rpc import control
+from scope.simple_rpc import property_client
+from scope.util import trie
+
+DEVICES = ['stand', 'stage', 'nosepiece', 'il', 'tl', 'il.spectra', 'tl.lamp', 'camera',
+    'camera.acquisition_sequencer', 'camera.autofocus', 'iotool', 'temperature_controller',
+    'humidity_controller', 'job_runner']
+PROPERTIES_PER_DEVICE = 20
+PREFIXES = ['scope.', 'scope.camera.', 'scope.stage.', 'scope.il.spectra.', 'scope.tl.lamp.']
+
+class _IdleClient(property_client.PropertyClient):
+    """PropertyClient with no connection: the background thread exits at once."""
+    def _receive_updates(self):
+        raise control.Stopped()
+
+def callback(property_name, value):
+    pass
+
+def make_property_names():
+    return ['scope.{}.property_{}'.format(device, i) for device in DEVICES for i in range(PROPERTIES_PER_DEVICE)]
+
+def trie_subscribers(callbacks, prefix_callbacks, property_name):
+    # the per-update lookup that PropertyClient used to do
+    return [callbacks[property_name]] + list(prefix_callbacks.values(property_name))
+
+def measure(lookup, names, updates):
+    t0 = time.perf_counter()
+    for i in range(updates):
+        lookup(names[i % len(names)])
+    return (time.perf_counter() - t0) / updates
+
+def main(updates=200000):
+    names = make_property_names()
+    subscribed = names[::4] * 3 # several widgets subscribe to many of the properties
+
+    callbacks = collections.defaultdict(set)
+    prefix_callbacks = trie.trie()
+    for name in subscribed:
+        callbacks[name].add((callback, False))
+    for prefix in PREFIXES:
+        prefix_callbacks[prefix] = {(callback, False)}
+
+    client = _IdleClient()
+    client.join()
+    for name in subscribed:
+        client.subscribe(name, callback)
+    for prefix in PREFIXES:
+        client.subscribe_prefix(prefix, callback)
+
+    print('{} properties, {} exact subscriptions, {} prefix subscriptions, {} updates'.format(
+        len(names), len(subscribed), len(PREFIXES), updates))
+    trie_time = measure(lambda name: trie_subscribers(callbacks, prefix_callbacks, name), names, updates)
+    cache_time = measure(client._subscribers, names, updates)
+    print('{:<18} {:>10}'.format('lookup', 'us/update'))
+    print('{:<18} {:>10.2f}'.format('trie', trie_time * 1e6))
+    print('{:<18} {:>10.2f}'.format('dispatch cache', cache_time * 1e6))
+    print('speedup: {:.1f}x'.format(trie_time / cache_time))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -30,6 +30,28 @@ scope_configuration = dict(
         RPC_INTERRUPT_PORT = '6001',
         PROPERTY_PORT = '6002',
         IMAGE_TRANSFER_RPC_PORT = '6003',
+        LIVE_FRAME_PORT = '6004', # live camera frames are pushed to remote viewers on this port; None to disable
+        RPC_LANES = False, # if True, RPC calls to different devices (stage, camera, il, etc.) run concurrently
+        RPC_STATS_INTERVAL = 600, # seconds between writes of RPC call statistics to rpc_stats.json in the server log directory; None to disable
+        # how updates to high-rate properties are published: property name (or prefix ending in '.') -> (policy, interval in seconds)
+        # (see PropertyServer.set_publication_policy for the available policies)
+        PROPERTY_PUBLICATION_POLICIES = {
+            # scope.camera.frame_number is left 'immediate': local live viewers fetch a frame per update,
+            # so a 'latest' policy with interval t would cap their frame rate at 1/t fps
+            'scope.stage.x': ('latest', 0.05),
+            'scope.stage.y': ('latest', 0.05),
+            'scope.stage.z': ('latest', 0.05),
+        },
+        # properties whose history is recorded by the server: property name (or prefix ending in '.') -> number of values to keep
+        PROPERTY_HISTORY = {
+            'scope.temperature_controller.': 200000,
+            'scope.humidity_controller.': 200000, # 14 days of updates every 10 seconds is ~121000
+            'scope.tl.lamp.': 50000,
+            'scope.il.spectra.': 50000,
+            'scope.stage.x': 100000,
+            'scope.stage.y': 100000,
+            'scope.stage.z': 100000,
+        },
     ),
 
     stand = dict(
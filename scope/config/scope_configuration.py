@@ -21,12 +21,17 @@ def get_addresses(host=None, config=None):
         config = get_config()
     if host is None:
         host = config.server.LOCALHOST
-    return dict(
+    addresses = dict(
         rpc=make_tcp_host(host, config.server.RPC_PORT),
         interrupt=make_tcp_host(host, config.server.RPC_INTERRUPT_PORT),
         property=make_tcp_host(host, config.server.PROPERTY_PORT),
         image_transfer_rpc=make_tcp_host(host, config.server.IMAGE_TRANSFER_RPC_PORT)
      )
+    # configuration files from before live-frame publishing was introduced will not have that port
+    live_frame_port = config.server.get('LIVE_FRAME_PORT')
+    if live_frame_port is not None:
+        addresses['live_frames'] = make_tcp_host(host, live_frame_port)
+    return addresses
 
 _CONFIG = None
 
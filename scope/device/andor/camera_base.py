@@ -134,6 +134,7 @@ class Camera(property_device.PropertyDevice):
         'ExposureTime'
     ])
     _GAIN_TO_ENCODING = None # to be filled by subclass
+    _LIVE_FRAME_POOL_SIZE = 8 # number of reusable shared-memory buffers for live images
     _IO_PINS = None # to be filled by subclass
     _BASIC_PROPERTIES = None # minimal set of properties to concern oneself with (e.g. from a GUI), filled by subclass
     _UNITS = {
@@ -551,15 +552,25 @@ class Camera(property_device.PropertyDevice):
         # note: this function (and ONLY this function in this file) can get called
         # simultaneously from two threads. Below operations need to be atomic,
         # intrinsically thread-safe, or serialized.
-        name, array, frame_number, timestamp = self._latest_data
-        transfer_ism_buffer.register_array_for_transfer(name, array)
-        return name, timestamp, frame_number
+        while True:
+            name, array, frame_number, timestamp = self._latest_data
+            try:
+                transfer_ism_buffer.register_array_for_transfer(name, array)
+            except transfer_ism_buffer.StaleFrameError:
+                # a pooled live frame was replaced and its buffer reused since we read
+                # self._latest_data: try again with the newer frame.
+                continue
+            return name, timestamp, frame_number
 
     def _update_image_data(self, name, array, timestamp):
         """Update information about the latest image, and broadcast to the world
         that another image has been retrieved."""
         self._frame_number += 1
+        previous_data = self._latest_data
         self._latest_data = name, array, self._frame_number, timestamp
+        if previous_data is not None:
+            # if the previous frame came from a FramePool, its buffer can be reused once no client is using it
+            transfer_ism_buffer.release_frame(previous_data[0])
         self._update_property('frame_number', self._frame_number)
 
     def _enable_live(self):
@@ -580,7 +591,7 @@ class Camera(property_device.PropertyDevice):
         self.push_state(cycle_mode='Continuous', trigger_mode='Software')
         trigger_interval = self._calculate_live_trigger_interval()
         namebase = 'live@-'+str(time.time())
-        buffer_maker = BufferFactory(namebase, frame_count=1, cycle=True)
+        buffer_maker = BufferFactory(namebase, frame_count=1, cycle=True, pool_size=self._LIVE_FRAME_POOL_SIZE)
         self._live_mode = True
         lowlevel.Command('AcquisitionStart')
         def update():
@@ -828,9 +839,17 @@ class Camera(property_device.PropertyDevice):
 UINT8_P = ctypes.POINTER(ctypes.c_uint8)
 
 class BufferFactory:
-    def __init__(self, namebase, frame_count=1, cycle=False):
+    def __init__(self, namebase, frame_count=1, cycle=False, pool_size=None):
+        """Queue buffers for the camera to fill, and convert them to ISM_Buffer-backed
+        output arrays. If pool_size is not None, output arrays come from a
+        transfer_ism_buffer.FramePool of that size (and new arrays are only
+        created if all of the pool's arrays are still in use)."""
         width, height, stride = map(lowlevel.GetInt, ('AOIWidth', 'AOIHeight', 'AOIStride'))
         self.buffer_shape = (width, height)
+        if pool_size is None:
+            self.pool = None
+        else:
+            self.pool = transfer_ism_buffer.FramePool(namebase, self.buffer_shape, numpy.uint16, 'Fortran', pool_size)
         input_encoding = lowlevel.GetEnumStringByIndex('PixelEncoding', lowlevel.GetEnumIndex('PixelEncoding'))
         self.convert_buffer_args = (width, height, stride, input_encoding, 'Mono16')
         image_bytes = lowlevel.GetInt('ImageSizeBytes')
@@ -868,9 +887,13 @@ class BufferFactory:
             self.queue_buffer()
 
     def convert_buffer(self):
-        name = next(self.names)
-        output_array = transfer_ism_buffer.create_array(name, shape=self.buffer_shape,
-            dtype=numpy.uint16, order='Fortran')
+        frame = None if self.pool is None else self.pool.acquire()
+        if frame is None:
+            name = next(self.names)
+            output_array = transfer_ism_buffer.create_array(name, shape=self.buffer_shape,
+                dtype=numpy.uint16, order='Fortran')
+        else:
+            name, output_array = frame
         buffer = self.queued_buffers.popleft()
         timestamp = parse_buffer_metadata(buffer, 1) # timestamp is metadata CID 1
         if timestamp is not None:
@@ -144,5 +144,8 @@ class MonitorWidget(ScopeViewerWidget):
         self.timer.stop()
         if not self.scope._is_local:
             self.scope._get_data.downsample = self.downsample
-        self.live_streamer.image_ready_callback = self.post_new_image_event
-        self.scope.rebroadcast_properties()
+            self.scope._get_data.delta = True # send only the changes between successive live images
+        # replace the streamer made before connecting, so that it can receive frames pushed by the server
+        self.live_streamer.detach()
+        self.live_streamer = scope_client.LiveStreamer(self.scope, self.post_new_image_event)
+        self.scope.properties.synchronize(self.scope.property_snapshot)
@@ -36,7 +36,7 @@ class WidgetWindow(Qt.QMainWindow):
                     self.add_widget(widget, widget_info['name'], widget_info.get('docked', False),
                         widget_info.get('start_visible', False), widget_info.get('pad', False))
         self.show()
-        scope.rebroadcast_properties()
+        scope.properties.synchronize(scope.property_snapshot)
 
     def add_widget(self, widget, name, docked, visible, pad):
         container = HideableWidgetContainer(widget, name, docked, pad)
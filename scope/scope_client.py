@@ -1,23 +1,49 @@
 # This code is licensed under the MIT License (see LICENSE file for details)
 
 import zmq
+import zmq.asyncio
+import asyncio
 import time
 import collections
 import numpy
 import threading
 import contextlib
+import inspect
+import pathlib
 
-from .simple_rpc import rpc_client, property_client
+from .simple_rpc import rpc_client, property_client, plan as rpc_plan
 from .util import transfer_ism_buffer
+from .util import live_frames
 from .config import scope_configuration
 
+# Directory in which to cache the server's function descriptions between
+# connections, which makes connecting much faster. Set to None to disable.
+DESCRIPTION_CACHE_DIR = pathlib.Path.home() / '.cache' / 'scope_client'
+
 class ScopeClient:
     _HEARTBEAT_SEC = 3
     _scope = None # set to not none in instances when connected
 
-    def __init__(self, host='127.0.0.1', allow_interrupt=True, auto_connect=True):
+    def __init__(self, host='127.0.0.1', allow_interrupt=True, auto_connect=True, cache_properties=False):
+        """Client for controlling the microscope.
+
+        Parameters:
+            host: address of the microscope server.
+            allow_interrupt: if True, control-c interrupts running calls on the server.
+            auto_connect: if True, connect to the server immediately.
+            cache_properties: if True, get_ functions (and the properties made
+                from them) whose values are published by the property server
+                return the most recently published value, without contacting
+                the server. Any other call (e.g. a set_ function) clears the
+                cache, so values are always current as of the last call this
+                client made, but may lag changes made by other clients by the
+                time it takes a property update to arrive. Values that might
+                predate this client's last call, or that are more than a few
+                seconds old, are fetched from the server instead.
+        """
         self.host = host
         self._allow_interrupt = allow_interrupt
+        self._cache_properties = cache_properties
 
         context = zmq.Context()
         addresses = scope_configuration.get_addresses(host)
@@ -27,6 +53,9 @@ class ScopeClient:
         self._image_transfer_client = rpc_client.ZMQClient(addresses['image_transfer_rpc'], **kws)
         del kws['timeout_sec'] # no timeout for property_client since it's a receive channel
         self.properties = property_client.ZMQClient(addresses['property'], **kws)
+        self._live_frame_addr = addresses.get('live_frames')
+        if cache_properties:
+            self._rpc_client.call_cache = _PropertyCache(self.properties)
 
         self._ping = self._rpc_client.proxy_function('_ping')
         self._sleep = self._rpc_client.proxy_function('_sleep')
@@ -51,8 +80,8 @@ class ScopeClient:
         self._rpc_client._timeout_sec = 60
 
         # do this after setting the longer timeout, since this can take ~10 sec
-        no_property = {'iotool.commands.set_' + val for val in ('high', 'low', 'tristate')}
-        scope = self._rpc_client.proxy_namespace(no_property)
+        # (unless the descriptions are cached from a previous connection)
+        scope = self._rpc_client.proxy_namespace(_NO_PROPERTY, cache_dir=DESCRIPTION_CACHE_DIR, lazy=True)
 
         is_local, get_data = transfer_ism_buffer.client_get_data_getter(self._image_transfer_client)
 
@@ -60,20 +89,12 @@ class ScopeClient:
             _patch_camera(scope.camera, get_data, self._image_transfer_client)
             if not is_local:
                 scope.camera.set_network_compression = get_data.set_network_compression
-            if hasattr(scope.camera, 'autofocus'):
-                # set a 45-minute timeout to allow for FFT calculation if necessary
-                scope.camera.autofocus.ensure_fft_ready._timeout_sec = 45*60
-                # autofocus might be a bit slow too
-                scope.camera.autofocus.autofocus._timeout_sec = 2*60
-                scope.camera.autofocus.autofocus_continuous_move._timeout_sec = 2*60
-
-        if hasattr(scope, 'stage'):
-            # stage init can take more than our usual 60-second timeout
-            scope.stage.reinit._timeout_sec = 2*60
-            scope.stage.reinit_x._timeout_sec = 2*60
-            scope.stage.reinit_y._timeout_sec = 2*60
-            scope.stage.reinit_z._timeout_sec = 2*60
-
+                # let get_data bit-pack images from 12-bit camera modes
+                def bit_depth_changed(bit_depth):
+                    get_data.bit_depth = int(bit_depth[:2])
+                self.properties.subscribe('scope.camera.bit_depth', bit_depth_changed, valueonly=True)
+                bit_depth_changed(scope.camera.bit_depth)
+        _set_long_timeouts(scope)
         _patch_in_state_context_managers(scope)
 
         scope._get_configuration._output_handler = scope_configuration.ConfigDict
@@ -84,15 +105,69 @@ class ScopeClient:
         self._functions_proxied = scope._functions_proxied
         self._scope = scope
 
+    def batch(self):
+        """Context manager to send all calls made on this client within the
+        with-block to the server as a single message, saving a network round-trip
+        per call. Inside the block, function calls and property accesses return
+        futures whose result() method gives the value after the block exits.
+
+        Example:
+            with scope.batch():
+                scope.stage.z = 5
+                scope.il.filter_cube = 'GFP'
+                exposure = scope.camera.exposure_time
+            print(exposure.result())
+        """
+        return self._rpc_client.batch()
+
+    def run_plan(self, plan, timeout_sec=None):
+        """Send a plan (a simple_rpc.plan.Plan, or list of plan operations) to
+        be run by the server in a single call. Return a dict of the named results,
+        processed as they would be by the corresponding functions of this client
+        (e.g. image names are turned into image arrays).
+
+        Parameters:
+            plan: Plan instance or list of operations.
+            timeout_sec: timeout for the whole plan. If None, use the sum of
+                the timeouts of the individual calls.
+        """
+        ops, proxies, unnamed, timeout_sec = _prepare_plan(self._scope, self._rpc_client, plan, timeout_sec)
+        plan_kwargs = _plan_kwargs(self._get_data, self._is_local, self._rpc_client, proxies, unnamed)
+        with self._rpc_client.timeout_sec(timeout_sec):
+            results, error, *packed = self._rpc_client('__PLAN__', ops, **plan_kwargs)
+        if packed and packed[0] is not None:
+            self._get_data.prefetch(packed[0])
+        # process all the results that were obtained, even if there was an error,
+        # so that any images get transferred and released on the server
+        results = {name: proxies[name]._output_handler(value) for name, value in results.items()
+            if name not in unnamed}
+        if error is not None:
+            _raise_plan_error(error)
+        return results
+
     def reconnect(self):
         self._rpc_client.reconnect()
         self._image_transfer_client.reconnect()
         self.properties.reconnect()
+        if self._rpc_client.call_cache is not None:
+            # updates may have been missed while disconnected
+            self._rpc_client.call_cache.clear()
+
+    def _live_frame_client(self, frame_callback):
+        """Return a live_frames.LiveFrameClient to receive live frames pushed
+        by the server, or None if the client is not connected, is on the same
+        machine as the server (so images need not be packed for transfer), or
+        the server does not push live frames."""
+        if not self._is_connected() or self._is_local or self._live_frame_addr is None:
+            return None
+        return live_frames.LiveFrameClient(self._live_frame_addr, frame_callback,
+            heartbeat_sec=self._HEARTBEAT_SEC, context=self.properties.context)
 
     def _clone(self):
         """Create an identical client with distinct ZMQ sockets, so that it may be safely used
         from a separate thread."""
-        return type(self)(self.host, self._allow_interrupt, auto_connect=self._is_connected())
+        return type(self)(self.host, self._allow_interrupt, auto_connect=self._is_connected(),
+            cache_properties=self._cache_properties)
 
     def __setattr__(self, name, value):
         if self._scope is not None:
@@ -119,13 +194,303 @@ class ScopeClient:
         return listing
 
 
+class _PropertyCache:
+    # cached values older than this are fetched from the server again, in case
+    # an update was missed (e.g. while the property client was reconnecting)
+    _MAX_AGE_SEC = 10
+    # after a call that might change properties returns, updates published
+    # before the call may still be on their way, so don't cache updates for this long
+    _SETTLE_SEC = 0.25
+
+    def __init__(self, property_client):
+        """RPC call cache (see RPCClient) that returns the values of get_
+        functions from the corresponding properties published by the scope's
+        property server (e.g. 'stage.get_z' -> 'scope.stage.z').
+
+        Only values that are known to be current are returned: property updates
+        received, and values returned by RPC calls. Any other call might change
+        property values, so it clears the cache, and updates received while it
+        runs (or shortly after, as they may have been published before the
+        call) are not cached, leaving get_ functions to call the server until
+        new updates arrive. Values older than _MAX_AGE_SEC are also fetched from
+        the server again. get_ functions whose values are not published as
+        properties (e.g. camera.get_live_fps) are never cached, as nothing would
+        tell the cache when their values change."""
+        self._property_client = property_client
+        self._lock = threading.Lock()
+        self._values = {} # property names to (value, time obtained) for values that are known to be current
+        self._update_counts = collections.Counter() # number of updates received for each property
+        self._calls_running = 0 # number of calls running that might change property values
+        self._unsettled_until = 0 # time until which updates might predate the last such call
+        property_client.subscribe_prefix('scope.', self._property_updated)
+
+    def _settled(self):
+        return self._calls_running == 0 and time.monotonic() >= self._unsettled_until
+
+    def _property_updated(self, property_name, value):
+        with self._lock:
+            self._update_counts[property_name] += 1
+            if self._settled():
+                self._values[property_name] = value, time.monotonic()
+            else:
+                self._values.pop(property_name, None)
+
+    @staticmethod
+    def _property_name(command):
+        *parents, name = command.split('.')
+        if not name.startswith('get_'):
+            return None
+        # same as the property names constructed in Scope.initialize_component()
+        return '.'.join(['scope'] + [parent for parent in parents if not parent.startswith('_')] + [name[4:]])
+
+    def lookup(self, command, args, kwargs):
+        property_name = None if args or kwargs else self._property_name(command)
+        with self._lock:
+            if property_name is None:
+                self._values.clear()
+                self._calls_running += 1
+                return False, None, (None, None)
+            if property_name in self._values:
+                value, obtained = self._values[property_name]
+                if time.monotonic() - obtained <= self._MAX_AGE_SEC:
+                    return True, value, None
+                del self._values[property_name]
+            update_count = self._update_counts[property_name]
+            if update_count == 0 and property_name not in self._property_client.properties:
+                return False, None, None # not a published property: always ask the server
+            return False, None, (property_name, update_count)
+
+    def store(self, token, value):
+        property_name, update_count = token
+        with self._lock:
+            if property_name is None:
+                self._call_finished()
+            # don't clobber any newer value that arrived while the call was running
+            elif self._update_counts[property_name] == update_count and self._calls_running == 0:
+                self._values[property_name] = value, time.monotonic()
+
+    def abandon(self, token):
+        property_name, update_count = token
+        if property_name is None:
+            with self._lock:
+                self._call_finished()
+
+    def _call_finished(self):
+        self._calls_running -= 1
+        self._unsettled_until = time.monotonic() + self._SETTLE_SEC
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class AsyncScopeClient:
+    _HEARTBEAT_SEC = 3
+    _scope = None # set to not none in instances when connected
+    _bit_depth_task = None # keeps the image getter's bit depth up to date, for remote clients
+
+    def __init__(self, host='127.0.0.1', allow_interrupt=True):
+        """Client for controlling the microscope from asyncio code.
+
+        The client presents the same namespace as ScopeClient, except that all
+        functions return awaitables, and get_ and set_ functions are not made
+        into properties (use e.g. 'await scope.stage.get_z()' instead of
+        'scope.stage.z'). Calls to different devices can be awaited concurrently
+        over the same connection, and run concurrently if the server uses RPC
+        lanes. Property updates are received by iterating over the
+        properties.updates() asynchronous iterator.
+
+        Example:
+            scope = AsyncScopeClient(host)
+            await scope.connect()
+            await asyncio.gather(scope.stage.set_z(10), scope.il.set_filter_cube('GFP'))
+            async for property_name, value in scope.properties.updates('scope.stage.'):
+                print(property_name, value)
+        """
+        self.host = host
+        context = zmq.asyncio.Context()
+        addresses = scope_configuration.get_addresses(host)
+        interrupt_addr = addresses['interrupt'] if allow_interrupt else None
+        kws = dict(heartbeat_sec=self._HEARTBEAT_SEC, timeout_sec=5, context=context)
+        self._rpc_client = rpc_client.AsyncZMQClient(addresses['rpc'], interrupt_addr, **kws)
+        self._image_transfer_client = rpc_client.AsyncZMQClient(addresses['image_transfer_rpc'], **kws)
+        del kws['timeout_sec'] # no timeout for property_client since it's a receive channel
+        self.properties = property_client.AsyncZMQClient(addresses['property'], **kws)
+        self.send_interrupt = self._rpc_client.send_interrupt
+
+    async def connect(self):
+        """Connect to the server and build the scope namespace."""
+        try:
+            assert await self._rpc_client('_ping') == 'pong'
+        except rpc_client.RPCError:
+            raise RuntimeError(f'Cannot communicate with microscope server at {self.host}.')
+        # now set a 60-second default timeout to allow long blocking rpc calls
+        self._rpc_client._timeout_sec = 60
+        scope = await self._rpc_client.proxy_namespace(cache_dir=DESCRIPTION_CACHE_DIR, lazy=True)
+        is_local, get_data = await transfer_ism_buffer.async_client_get_data_getter(self._image_transfer_client)
+        if hasattr(scope, 'camera'):
+            _patch_async_camera(scope.camera, get_data, self._image_transfer_client)
+            if not is_local:
+                scope.camera.set_network_compression = get_data.set_network_compression
+                # let get_data bit-pack images from 12-bit camera modes
+                async def track_bit_depth():
+                    async for property_name, bit_depth in self.properties.updates('scope.camera.bit_depth'):
+                        if property_name == 'scope.camera.bit_depth':
+                            get_data.bit_depth = int(bit_depth[:2])
+                # start listening before getting the current value, so that no change is missed
+                if self._bit_depth_task is not None:
+                    self._bit_depth_task.cancel()
+                self._bit_depth_task = asyncio.ensure_future(track_bit_depth())
+                bit_depth = await scope.camera.get_bit_depth()
+                if get_data.bit_depth is None:
+                    get_data.bit_depth = int(bit_depth[:2])
+        _set_long_timeouts(scope)
+        _patch_in_state_context_managers(scope, _generate_async_in_state)
+        # get_ functions are not made into properties (and hidden) in the async namespace
+        scope.get_configuration._output_handler = scope_configuration.ConfigDict
+        scope._lock_attrs()
+        self._get_data = get_data
+        self._is_local = is_local
+        self._functions_proxied = scope._functions_proxied
+        self._scope = scope
+
+    async def run_plan(self, plan, timeout_sec=None):
+        """Send a plan to be run by the server in a single call: see
+        ScopeClient.run_plan()."""
+        ops, proxies, unnamed, timeout_sec = _prepare_plan(self._scope, self._rpc_client, plan, timeout_sec)
+        plan_kwargs = _plan_kwargs(self._get_data, self._is_local, self._rpc_client, proxies, unnamed)
+        results, error, *packed = await self._rpc_client.call('__PLAN__', [ops], plan_kwargs, timeout_sec=timeout_sec)
+        if packed and packed[0] is not None:
+            self._get_data.prefetch(packed[0])
+        processed = {}
+        for name, value in results.items():
+            if name in unnamed:
+                continue
+            value = proxies[name]._output_handler(value)
+            if inspect.isawaitable(value):
+                value = await value
+            processed[name] = value
+        if error is not None:
+            _raise_plan_error(error)
+        return processed
+
+    def __getattr__(self, name):
+        if self._scope is not None and hasattr(self._scope, name):
+            return getattr(self._scope, name)
+        raise AttributeError(f"'AsyncScopeClient' object has no attribute '{name}'")
+
+    def __dir__(self):
+        listing = super().__dir__()
+        if self._scope is not None:
+            scope_list = set(dir(self._scope))
+            scope_list.update(listing)
+            listing = sorted(scope_list)
+        return listing
+
+
+_NO_PROPERTY = {'iotool.commands.set_' + val for val in ('high', 'low', 'tristate')}
+
+def _set_long_timeouts(scope):
+    if hasattr(scope, 'camera') and hasattr(scope.camera, 'autofocus'):
+        # set a 45-minute timeout to allow for FFT calculation if necessary
+        scope.camera.autofocus.ensure_fft_ready._timeout_sec = 45*60
+        # autofocus might be a bit slow too
+        scope.camera.autofocus.autofocus._timeout_sec = 2*60
+        scope.camera.autofocus.autofocus_continuous_move._timeout_sec = 2*60
+
+    if hasattr(scope, 'stage'):
+        # stage init can take more than our usual 60-second timeout
+        scope.stage.reinit._timeout_sec = 2*60
+        scope.stage.reinit_x._timeout_sec = 2*60
+        scope.stage.reinit_y._timeout_sec = 2*60
+        scope.stage.reinit_z._timeout_sec = 2*60
+
+def _find_proxy(scope, qualname):
+    """Return the proxy function for the given qualified name, even if it is
+    hidden behind a property."""
+    *parents, name = qualname.split('.')
+    namespace = scope
+    for parent in parents:
+        namespace = getattr(namespace, parent)
+    if name.startswith(('get_', 'set_')) and inspect.getattr_static(namespace, name, None) is None:
+        # this function was made into a property, and is stored as a hidden attribute
+        name = '_' + name
+    return getattr(namespace, name)
+
+def _prepare_plan(scope, client, plan, timeout_sec):
+    """Return the list of plan operations, a dict mapping result names to the
+    proxy functions for the calls that produce them, the list of names given
+    to image-producing calls that had none, and the timeout.
+
+    Images are held on the server until their names are fetched, so unnamed
+    image-producing calls are given names here, allowing the server to release
+    their images once the plan is done."""
+    ops = plan.ops if isinstance(plan, rpc_plan.Plan) else plan
+    calls = list(rpc_plan.iter_calls(ops))
+    unknown = {op['call'] for op in calls} - scope._functions_proxied
+    if unknown:
+        raise rpc_client.RPCError('Unknown command(s) in plan: {}'.format(', '.join(sorted(unknown))))
+    taken = {op['name'] for op in calls if 'name' in op}
+    unnamed = []
+    def name_images(ops):
+        named_ops = []
+        for op in ops:
+            if 'ops' in op:
+                op = dict(op, ops=name_images(op['ops']))
+            elif 'name' not in op and getattr(_find_proxy(scope, op['call']), '_returns_images', False):
+                name = '_unnamed_{}'.format(len(unnamed))
+                while name in taken:
+                    name += '_'
+                unnamed.append(name)
+                op = dict(op, name=name)
+            named_ops.append(op)
+        return named_ops
+    ops = name_images(ops)
+    calls = list(rpc_plan.iter_calls(ops))
+    proxies = {op['name']: _find_proxy(scope, op['call']) for op in calls if 'name' in op}
+    if timeout_sec is None:
+        timeout_sec = 0
+        for op in calls:
+            proxy_timeout = _find_proxy(scope, op['call'])._timeout_sec
+            timeout_sec += proxy_timeout if proxy_timeout is not None else client._timeout_sec
+    return ops, proxies, unnamed, timeout_sec
+
+def _plan_kwargs(get_data, is_local, client, proxies, unnamed):
+    """Return the keyword arguments for a __PLAN__ call, asking the server to
+    release the images from unnamed calls, and to send any other images among
+    the results along with its reply. Sending images is only worthwhile for
+    remote clients, and only the msgpack codec can send the image buffers as
+    they are."""
+    kwargs = {}
+    if unnamed:
+        kwargs['release'] = dict(call='_transfer_ism_buffer._server_release_results', names=unnamed)
+    names = sorted(name for name, proxy in proxies.items()
+        if getattr(proxy, '_returns_images', False) and name not in unnamed)
+    if not is_local and client.codec == 'msgpack' and names:
+        kwargs['pack'] = get_data.plan_pack(names)
+    return kwargs
+
+def _raise_plan_error(error):
+    location, error_text = error
+    raise rpc_client.RPCError('Operation {} in plan failed:\n{}'.format(location, error_text))
+
+def _mark_image_results(camera):
+    # these functions return image names, which run_plan() can have sent along with the plan's results
+    proxies = [camera.acquire_image, camera.next_image, camera.next_image_and_metadata, camera.stream_acquire]
+    if hasattr(camera, 'acquisition_sequencer'):
+        proxies.append(camera.acquisition_sequencer.run)
+    if hasattr(camera, 'autofocus'):
+        proxies += [camera.autofocus.autofocus, camera.autofocus.autofocus_continuous_move]
+    for proxy in proxies:
+        proxy._returns_images = True
+
 def _patch_camera(camera, get_data, image_transfer_client):
     # ensure that the camera uses the proper data-transfer channels, and
     # monkeypatch the sequence acquisition context manager
 
     # define image transfer wrapper functions
     def get_many_data(image_names):
-        return [get_data(name) for name in image_names]
+        return get_data.get_many(image_names)
     def get_data_and_metadata(return_values):
         image_name, timestamp, frame_number = return_values
         return get_data(image_name), timestamp, frame_number
@@ -145,6 +510,7 @@ def _patch_camera(camera, get_data, image_transfer_client):
     if hasattr(camera, 'autofocus'):
         camera.autofocus.autofocus._output_handler = get_autofocus_data
         camera.autofocus.autofocus_continuous_move._output_handler = get_autofocus_data
+    _mark_image_results(camera)
 
     # use a special RPC channel (the "image transfer" connection) devoted to just
     # getting image names and images from the server. This allows us to grab the
@@ -167,17 +533,62 @@ def _patch_camera(camera, get_data, image_transfer_client):
             camera.end_image_sequence_acquisition()
     camera.image_sequence_acquisition = image_sequence_acquisition
 
-def _patch_in_state_context_managers(scope):
+def _patch_async_camera(camera, get_data, image_transfer_client):
+    # asyncio version of _patch_camera(), where get_data is a coroutine function
+    async def get_many_data(image_names):
+        return await get_data.get_many(image_names)
+    async def get_data_and_metadata(return_values):
+        image_name, timestamp, frame_number = return_values
+        return await get_data(image_name), timestamp, frame_number
+    async def get_stream_data(return_values):
+        images_names, timestamps, attempted_frame_rate = return_values
+        return await get_many_data(images_names), timestamps, attempted_frame_rate
+    async def get_autofocus_data(return_values):
+        best_z, positions_and_scores, image_names = return_values
+        return best_z, positions_and_scores, await get_many_data(image_names)
+
+    camera.acquire_image._output_handler = get_data
+    camera.next_image._output_handler = get_data
+    camera.next_image_and_metadata._output_handler = get_data_and_metadata
+    camera.stream_acquire._output_handler = get_stream_data
+    if hasattr(camera, 'acquisition_sequencer'):
+        camera.acquisition_sequencer.run._output_handler = get_many_data
+    if hasattr(camera, 'autofocus'):
+        camera.autofocus.autofocus._output_handler = get_autofocus_data
+        camera.autofocus.autofocus_continuous_move._output_handler = get_autofocus_data
+    _mark_image_results(camera)
+
+    async def latest_image():
+        name, timestamp, frame_number = await image_transfer_client('latest_image')
+        return await get_data(name), timestamp, frame_number
+    latest_image.__doc__ = camera.latest_image.__doc__
+    camera.latest_image = latest_image
+
+    @contextlib.asynccontextmanager
+    async def image_sequence_acquisition(frame_count=1, trigger_mode='Internal', **camera_params):
+        """Context manager to begin and automatically end an image sequence acquisition."""
+        await camera.start_image_sequence_acquisition(frame_count, trigger_mode, **camera_params)
+        try:
+            yield
+        finally:
+            await camera.end_image_sequence_acquisition()
+    camera.image_sequence_acquisition = image_sequence_acquisition
+
+def _patch_in_state_context_managers(scope, generate_in_state=None):
     # monkeypatch in_state context managers to work on client side
+    if generate_in_state is None:
+        generate_in_state = _generate_in_state
     for qualname in scope._functions_proxied:
         if qualname == 'in_state':
             obj = scope
         elif qualname.endswith('.in_state'):
             parents, name = qualname.rsplit('.', maxsplit=1)
-            obj = eval(parents, scope.__dict__)
+            obj = scope
+            for parent in parents.split('.'):
+                obj = getattr(obj, parent)
         else:
             continue
-        _generate_in_state(obj)
+        generate_in_state(obj)
 
 def _generate_in_state(obj):
     # must do below in separate function for each obj so that the closure
@@ -194,12 +605,25 @@ def _generate_in_state(obj):
             obj.pop_state()
     obj.in_state = in_state
 
+def _generate_async_in_state(obj):
+    @contextlib.asynccontextmanager
+    async def in_state(**state):
+        """Asynchronous context manager to set a number of device parameters at
+        once using keyword arguments. The old values of those parameters will be
+        restored upon exiting the async with-block."""
+        await obj.push_state(**state)
+        try:
+            yield
+        finally:
+            await obj.pop_state()
+    obj.in_state = in_state
+
 
 class LiveStreamer:
     class Timeout(RuntimeError):
         pass
 
-    def __init__(self, scope, image_ready_callback=None):
+    def __init__(self, scope, image_ready_callback=None, pushed_frames=True):
         """Class to help manage retrieving images from a camera in live mode.
 
         Parameters:
@@ -209,6 +633,12 @@ class LiveStreamer:
               functions on the scope (e.g. retrieving an image) and MAY NOT call
               the get_image() function of this class. It should be used solely
               to signal the main thread to retrieve the image in some way.
+          pushed_frames: if True, and the scope is connected over the network,
+              receive frames that the server pushes to all remote viewers
+              (compressed with the scope's current network compression
+              settings), rather than requesting each frame. This saves
+              round-trips, and the server packs each frame only once for all
+              viewers with the same settings.
 
         Useful properties:
           live: is the camera in live mode?
@@ -236,12 +666,17 @@ class LiveStreamer:
             self.bit_depth = '16 Bit'
         self.latest_intervals = collections.deque(maxlen=10)
         self._last_time = time.time()
+        self._frame_client = scope._live_frame_client(self._frame_pushed) if pushed_frames else None
+        if self._frame_client is not None:
+            self._update_frame_profile()
         self.scope.properties.subscribe('scope.camera.live_mode', self._live_change, valueonly=True)
         self.scope.properties.subscribe('scope.camera.frame_number', self._image_update, valueonly=True)
         self.scope.properties.subscribe('scope.camera.bit_depth', self._depth_update, valueonly=True)
 
     def detach(self):
         self.image_ready_callback = None
+        if self._frame_client is not None:
+            self._frame_client.stop()
         self.scope.properties.unsubscribe('scope.camera.live_mode', self._live_change, valueonly=True)
         self.scope.properties.unsubscribe('scope.camera.frame_number', self._image_update, valueonly=True)
         self.scope.properties.unsubscribe('scope.camera.bit_depth', self._depth_update, valueonly=True)
@@ -258,17 +693,37 @@ class LiveStreamer:
         image.
 
         To determine whether an image is ready, use image_ready()"""
+        if self._frame_client is not None:
+            # follow any changes to the network compression settings
+            self._update_frame_profile()
+            frame = None
+            while frame is None:
+                self.image_received.wait()
+                # clear before getting the frame, so that a frame that arrives meanwhile is not missed
+                self.image_received.clear()
+                frame = self._frame_client.get_frame()
+            image, timestamp, frame_number = frame
+            self._record_interval()
+            return image, timestamp, frame_number
         self.image_received.wait()
         # get image before re-enabling image-receiving because if this is over the network, it could take a while
         try:
             image, timestamp, frame_number = self.scope.camera.latest_image()
-            t = time.time()
-            self.latest_intervals.append(t - self._last_time)
-            self._last_time = t
+            self._record_interval()
         finally:
             self.image_received.clear()
         return image, timestamp, frame_number
 
+    def _record_interval(self):
+        t = time.time()
+        self.latest_intervals.append(t - self._last_time)
+        self._last_time = t
+
+    def _update_frame_profile(self):
+        get_data = self.scope._get_data
+        self._frame_client.set_profile(get_data.compressor, get_data.downsample, get_data.blocked,
+            get_data.packed_bit_depth(), get_data.delta, **get_data.compressor_args)
+
     def image_ready(self):
         """Return whether an image is ready to be retrieved. If False, a
         call to get_image() will block until an image is ready."""
@@ -288,11 +743,17 @@ class LiveStreamer:
 
     def _image_update(self, frame_number):
         # called in property client's thread: note we can't do RPC calls
-        if frame_number == -1:
+        if frame_number == -1 or self._frame_client is not None:
             return
         self.image_received.set()
         if self.image_ready_callback is not None:
             self.image_ready_callback()
 
+    def _frame_pushed(self):
+        # called in the live frame client's thread
+        self.image_received.set()
+        if self.image_ready_callback is not None:
+            self.image_ready_callback()
+
     def _depth_update(self, depth):
         self.bit_depth = depth
@@ -5,8 +5,11 @@ import time
 import threading
 import json
 
+from zplib import datafile
+
 from .util import logging
 from .util import base_daemon
+from .util import timer
 from .config import scope_configuration
 
 logger = logging.get_logger(__name__)
@@ -58,15 +61,23 @@ class ScopeServer(base_daemon.Runner):
         from . import scope
         from .simple_rpc import rpc_server
         from .simple_rpc import property_server
+        from .simple_rpc import property_history
         from .util import transfer_ism_buffer
+        from .util import live_frames
 
         addresses = scope_configuration.get_addresses(self.host)
         self.context = zmq.Context()
         self.property_server = property_server.ZMQServer(addresses['property'], context=self.context)
+        for name, (policy, interval) in self.config.server.get('PROPERTY_PUBLICATION_POLICIES', {}).items():
+            self.property_server.set_publication_policy(name, policy, interval)
+        history = property_history.PropertyHistory(self.property_server, self.config.server.get('PROPERTY_HISTORY', {}))
         scope_controller = scope.Scope(self.property_server)
+        scope_controller.property_history = history
         # Provide some basic RPC calls for testing...
         scope_controller._sleep = time.sleep
         scope_controller._ping = lambda: "pong"
+        # plans run by the scope server can have it pack or release the images they acquire
+        scope_controller._transfer_ism_buffer = transfer_ism_buffer
 
         image_transfer_namespace = Namespace()
         # add transfer_ism_buffer as hidden elements of the namespace, which RPC clients can use for seamless buffer sharing
@@ -75,20 +86,48 @@ class ScopeServer(base_daemon.Runner):
             image_transfer_namespace.latest_image = scope_controller.camera.latest_image
         self.image_transfer_server = rpc_server.BackgroundBaseZMQServer(image_transfer_namespace,
             addresses['image_transfer_rpc'], context=self.context)
+        if hasattr(scope_controller, 'camera') and 'live_frames' in addresses:
+            self.live_frame_server = live_frames.LiveFrameServer(addresses['live_frames'], self.property_server,
+                scope_controller.camera.latest_image, context=self.context)
+        else:
+            self.live_frame_server = None
         interrupter = rpc_server.ZMQInterrupter(addresses['interrupt'], context=self.context)
-        self.scope_server = rpc_server.ZMQServer(scope_controller, interrupter,
+        # configuration files from before RPC_LANES was introduced will not have that option
+        if self.config.server.get('RPC_LANES', False):
+            server_class = rpc_server.ZMQRouterServer
+        else:
+            server_class = rpc_server.ZMQServer
+        self.scope_server = server_class(scope_controller, interrupter,
             addresses['rpc'], context=self.context)
+        stats_interval = self.config.server.get('RPC_STATS_INTERVAL', 600)
+        if stats_interval is not None:
+            self.stats_timer = timer.Timer(self._write_rpc_stats, stats_interval, run_immediately=False)
+        else:
+            self.stats_timer = None
         logger.info('Scope Server Ready (Listening on {})', self.host)
 
     def run_daemon(self):
         try:
             self.scope_server.run()
         finally:
+            if self.stats_timer is not None:
+                self.stats_timer.stop()
+                self._write_rpc_stats()
             self.property_server.stop()
             self.image_transfer_server.stop()
+            if self.live_frame_server is not None:
+                self.live_frame_server.stop()
             self.scope_server.interrupter.stop()
             self.context.term()
 
+    def _write_rpc_stats(self):
+        stats = dict(rpc=self.scope_server.stats.summary(), image_transfer_rpc=self.image_transfer_server.stats.summary())
+        try:
+            with (self.log_dir / 'rpc_stats.json').open('w') as f:
+                datafile.json_encode_legible_to_file(stats, f)
+        except Exception:
+            logger.log_exception('Could not write RPC statistics:')
+
 
 class ScopeClientTester(threading.Thread):
     def __init__(self):
@@ -0,0 +1,78 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Binary encoding of RPC messages, as an alternative to JSON.
+
+Messages are packed with msgpack, except that numpy arrays and bytearray /
+memoryview objects are sent "out of band" as separate ZeroMQ message frames,
+which can be sent and received without copying or converting to text. Each
+such object is replaced in the msgpack data by a small extension record that
+refers to its frame by index (and for arrays, also gives the dtype, shape, and
+memory order).
+
+pack() returns a list of frames: the msgpack-encoded header first, followed by
+any out-of-band buffers. unpack() reverses the process. Arrays returned by
+unpack() are views onto the received message frames, not copies.
+"""
+
+import numpy
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_NDARRAY_EXT = 1
+_BUFFER_EXT = 2
+
+class Multipart(list):
+    """A list of buffers (bytes, bytearrays, memoryviews, or contiguous numpy
+    arrays) which an RPC function may return to have them sent to the client
+    as separate message frames, without copying or other encoding. The client
+    receives a list of memoryviews onto the frames."""
+    pass
+
+def available_codecs():
+    """Return the names of the codecs that can be used, in order of preference."""
+    if msgpack is None:
+        return ['json']
+    return ['msgpack', 'json']
+
+def pack(obj):
+    """Pack a python object into a list of message frames."""
+    buffers = []
+    def default(o):
+        if isinstance(o, numpy.ndarray):
+            if o.dtype.hasobject or o.dtype.fields is not None:
+                # only plain numeric arrays go out of band; let msgpack deal with the rest
+                return o.tolist()
+            if o.flags.c_contiguous:
+                order = 'C'
+            elif o.flags.f_contiguous:
+                order = 'F'
+            else:
+                o = numpy.ascontiguousarray(o)
+                order = 'C'
+            buffers.append(o.reshape(-1, order=order)) # a 1D view, which all buffer consumers can handle
+            header = msgpack.packb((o.dtype.str, o.shape, order, len(buffers) - 1))
+            return msgpack.ExtType(_NDARRAY_EXT, header)
+        elif isinstance(o, numpy.generic):
+            return o.item()
+        elif isinstance(o, (bytearray, memoryview)):
+            buffers.append(o)
+            return msgpack.ExtType(_BUFFER_EXT, msgpack.packb(len(buffers) - 1))
+        raise TypeError('Object of type {} cannot be serialized.'.format(type(o).__name__))
+    header = msgpack.packb(obj, default=default, use_bin_type=True)
+    return [header] + buffers
+
+def unpack(frames):
+    """Unpack a list of message frames (bytes or buffer objects) produced by
+    pack() into a python object."""
+    header, *buffers = frames
+    def ext_hook(code, data):
+        if code == _NDARRAY_EXT:
+            dtype, shape, order, index = msgpack.unpackb(data)
+            return numpy.ndarray(shape, dtype=dtype, order=order, buffer=buffers[index])
+        elif code == _BUFFER_EXT:
+            return buffers[msgpack.unpackb(data)]
+        return msgpack.ExtType(code, data)
+    return msgpack.unpackb(header, ext_hook=ext_hook, raw=False, strict_map_key=False)
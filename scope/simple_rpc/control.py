@@ -0,0 +1,99 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Control sockets, which allow threads that wait for messages on ZeroMQ
+sockets to be stopped (or otherwise instructed) from other threads immediately,
+rather than having the waiting thread wake up periodically to check a flag.
+"""
+
+import threading
+
+import zmq
+
+class Stopped(RuntimeError):
+    """Raised in a thread waiting on a ControlSocket when it has been asked to stop."""
+    pass
+
+class ControlSocket:
+    def __init__(self, context, message_handler=None):
+        """Inproc socket that delivers control messages (strings) from any thread
+        to a single thread that waits for messages with poll().
+        Parameters:
+            context: the ZeroMQ context to use.
+            message_handler: function to be called (in the polling thread) with
+                any control message other than 'stop'. If None, such messages
+                are ignored (but still wake up the polling thread).
+        """
+        self.context = context
+        self.message_handler = message_handler
+        self.address = 'inproc://control-{}'.format(id(self))
+        self._receiver = context.socket(zmq.PULL)
+        self._receiver.LINGER = 0
+        self._receiver.bind(self.address)
+        self._poller = zmq.Poller()
+        self._poller.register(self._receiver, zmq.POLLIN)
+        self._sockets = set()
+        self._sender = None
+        self._sender_lock = threading.Lock()
+        self._closed = False
+
+    def send(self, message):
+        """Send a control message to the polling thread. Can be called from any
+        thread. Messages sent after the socket is closed are ignored."""
+        with self._sender_lock:
+            if self._closed:
+                return
+            if self._sender is None:
+                self._sender = self.context.socket(zmq.PUSH)
+                self._sender.LINGER = 0
+                self._sender.connect(self.address)
+            self._sender.send_string(message)
+
+    def poll(self, *sockets, timeout=None):
+        """Wait until any of the given sockets has a message to receive, or a
+        control message arrives, or the timeout (in ms; None means forever)
+        expires. Return the list of sockets that are ready to receive (which is
+        empty if only a control message was received, or on timeout).
+
+        If the control message is 'stop', raise Stopped; otherwise pass it to
+        the message_handler, if any."""
+        for socket in self._sockets.difference(sockets):
+            self._poller.unregister(socket)
+        for socket in set(sockets).difference(self._sockets):
+            self._poller.register(socket, zmq.POLLIN)
+        self._sockets = set(sockets)
+        ready = dict(self._poller.poll(timeout))
+        if self._receiver in ready:
+            message = self._receiver.recv_string()
+            if message == 'stop':
+                raise Stopped()
+            if self.message_handler is not None:
+                self.message_handler(message)
+            return []
+        return [socket for socket in sockets if socket in ready]
+
+    def close(self):
+        with self._sender_lock:
+            self._closed = True
+            if self._sender is not None:
+                self._sender.close()
+                self._sender = None
+        self._receiver.close()
+
+
+class ControlledLoopMixin:
+    """Mixin for classes with a loop, running in a thread, that waits on a
+    ControlSocket (stored as the '_control' attribute). Setting the 'running'
+    attribute to False from any thread sends a 'stop' message to that socket,
+    which stops the loop immediately."""
+    _control = None
+    _running = False
+
+    @property
+    def running(self):
+        return self._running
+
+    @running.setter
+    def running(self, running):
+        self._running = running
+        if not running and self._control is not None:
+            self._control.send('stop')
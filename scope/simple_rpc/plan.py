@@ -0,0 +1,142 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Plans: lists of RPC operations to be run by the server in a single call.
+
+A plan is a list of operations, each of which is a dict of one of these forms:
+    {'call': command_name, 'args': [...], 'kwargs': {...}, 'name': result_name}
+        Call the named command. 'args', 'kwargs', and 'name' are optional. If
+        'name' is given, the return value is stored under that name, and it
+        will be returned to the client.
+    {'in_state': namespace_name, 'state': {...}, 'ops': [...]}
+        Run the list of operations 'ops' inside of the in_state() context
+        manager of the given namespace (e.g. 'camera', or '' for the top-level
+        namespace), called with the 'state' keyword arguments.
+
+Any argument value (or any item of a list or dict in an argument) of the form
+{'$ref': result_name} is replaced by the named result of a previous operation.
+To refer to an element of a result, give a list of the name and the indices or
+keys to look up in turn: e.g. {'$ref': ['autofocus', 0]} refers to the first
+element of the 'autofocus' result.
+
+The Plan class provides a convenient way to build these lists.
+"""
+
+class Plan:
+    def __init__(self):
+        """Build a list of operations to be run by the server in a single call.
+
+        Example:
+            plan = Plan()
+            plan.call('stage.set_position', (10, 20, 30))
+            plan.call('stage.wait')
+            autofocus = plan.call('camera.autofocus.autofocus', 27, 29, 20, name='autofocus')
+            with plan.in_state('tl.lamp', enabled=True, intensity=120):
+                plan.call('camera.acquire_image', name='bf')
+            plan.call('stage.set_z', autofocus[0])
+            plan.call('camera.acquisition_sequencer.run', name='images')
+            results = scope.run_plan(plan)
+            bf_image = results['bf']
+        """
+        self.ops = []
+        self._current = self.ops
+
+    def call(self, command, *args, name=None, **kwargs):
+        """Add a call of the named command to the plan.
+
+        Arguments may include references to the results of earlier calls. If
+        'name' is given, return a reference to the result of this call (which
+        can be indexed to refer to an element of the result), and the result
+        will be returned by the server."""
+        op = {'call': command}
+        if args:
+            op['args'] = list(args)
+        if kwargs:
+            op['kwargs'] = kwargs
+        if name is not None:
+            op['name'] = name
+        self._current.append(op)
+        if name is not None:
+            return Ref(name)
+
+    def in_state(self, namespace='', **state):
+        """Context manager: calls added to the plan within the with-block will
+        be run inside of the given namespace's in_state() context manager."""
+        return _InStateBlock(self, namespace, state)
+
+
+class Ref(dict):
+    """Reference to the named result of an operation in a Plan. Indexing a
+    Ref gives a reference to an element of the result."""
+    def __init__(self, name, *path):
+        super().__init__()
+        self['$ref'] = [name, *path] if path else name
+
+    def __getitem__(self, key):
+        if key == '$ref':
+            return super().__getitem__(key)
+        ref = super().__getitem__('$ref')
+        path = ref if isinstance(ref, list) else [ref]
+        return Ref(*path, key)
+
+
+class _InStateBlock:
+    def __init__(self, plan, namespace, state):
+        self.plan = plan
+        self.op = {'in_state': namespace, 'state': state, 'ops': []}
+
+    def __enter__(self):
+        self.plan._current.append(self.op)
+        self.outer = self.plan._current
+        self.plan._current = self.op['ops']
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.plan._current = self.outer
+
+
+class PlanError(Exception):
+    """Error in running a plan. 'location' is the list of indices of the
+    failed operation within the (possibly nested) operation lists."""
+    def __init__(self, location, text):
+        super().__init__(text)
+        self.location = list(location)
+        self.text = text
+
+
+def resolve_refs(value, results, location):
+    """Return a copy of the value with any references replaced by the named
+    values in the 'results' dict."""
+    if isinstance(value, dict):
+        if '$ref' in value:
+            ref = value['$ref']
+            name, *path = ref if isinstance(ref, list) else [ref]
+            try:
+                value = results[name]
+                for key in path:
+                    value = value[key]
+            except (KeyError, IndexError, TypeError):
+                raise PlanError(location, 'Could not resolve reference to {}'.format(ref))
+            return value
+        return {k: resolve_refs(v, results, location) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [resolve_refs(v, results, location) for v in value]
+    return value
+
+def iter_calls(ops):
+    """Yield each 'call' operation in a list of operations, including those
+    inside of in_state blocks."""
+    for op in ops:
+        if 'call' in op:
+            yield op
+        elif 'ops' in op:
+            yield from iter_calls(op['ops'])
+
+def iter_commands(ops):
+    """Yield the name of each command that a list of operations will call,
+    including the in_state() functions of in_state blocks."""
+    for op in ops:
+        if 'call' in op:
+            yield op['call']
+        elif 'in_state' in op:
+            namespace = op['in_state']
+            yield namespace + '.in_state' if namespace else 'in_state'
+            yield from iter_commands(op['ops'])
@@ -3,23 +3,54 @@
 import collections
 import threading
 import traceback
+import uuid
 import zmq
-from ..util import trie
+import zmq.asyncio
+# PyZMQ 15.0.0's __init__.py apparently does not import utils.jsonapi, requiring this explicit import
+import zmq.utils.jsonapi
+from . import control
+from . import property_server
 
 class PropertyClient(threading.Thread):
     """A client for receiving property updates in a background thread.
 
     The background thread is automatically started when this object is constructed.
     To stop the thread, set the 'running' attribute to False.
+
+    By default, callbacks are called in turn from the background thread, so a
+    slow callback delays the receipt of all further updates. If queue_callbacks
+    is True, each callback function is instead called from its own thread,
+    with its own queue of pending updates. If a callback falls behind, only the
+    newest value of each property is kept in its queue (so the queue never holds
+    more than one update per property, and the latest value of a property is
+    never dropped). Each callback still receives its updates in the order they
+    arrived.
     """
-    def __init__(self, daemon=True):
+    def __init__(self, daemon=True, queue_callbacks=False):
         # properties is a local copy of tracked properties, in case that's useful
         self.properties = {}
+        # sequence numbers of the values in self.properties, used to merge updates with snapshots
+        self._sequences = {}
+        # epoch ID of the server instance that the sequence numbers came from
+        self._epoch = None
+        # held while updating properties and calling callbacks, so that updates and snapshots are handled in order
+        self._update_lock = threading.RLock()
         # callbacks is a dict mapping property names to lists of callbacks
         self.callbacks = collections.defaultdict(set)
-        # prefix_callbacks is a trie used to match property names to prefixes
-        # which were registered for "wildcard" callbacks.
-        self.prefix_callbacks = trie.trie()
+        # prefix_callbacks is a dict mapping prefixes to callbacks registered
+        # for all properties starting with that prefix ("wildcard" callbacks).
+        self.prefix_callbacks = {}
+        # dispatch cache: a dict mapping property names to a tuple of all the
+        # callbacks for that property, including prefix callbacks. Cleared
+        # (by replacing it) whenever the subscriptions change.
+        self._dispatch_cache = {}
+        self.queue_callbacks = queue_callbacks
+        # (callback, valueonly) pairs to the number of subscriptions they are registered for
+        self._subscriber_counts = collections.Counter()
+        # (callback, valueonly) pairs to _QueuedCallback instances, if queue_callbacks is True
+        self._queued_callbacks = {}
+        # sync topics (see property_server) to the events to set when they are received
+        self._sync_events = {}
         super().__init__(name='PropertyClient', daemon=daemon)
         self.start()
 
@@ -35,19 +66,111 @@ class PropertyClient(threading.Thread):
     def run(self):
         """Thread target: do not call directly."""
         self.running = True
-        while True:
-            property_name, value = self._receive_update()
-            self.properties[property_name] = value
-            for callbacks in [self.callbacks[property_name]] + list(self.prefix_callbacks.values(property_name)):
-                for callback, valueonly in callbacks:
-                    try:
-                        if valueonly:
-                            callback(value)
-                        else:
-                            callback(property_name, value)
-                    except Exception as e:
-                        print('Caught exception in PropertyClient callback:')
-                        traceback.print_exception(type(e), e, e.__traceback__)
+        try:
+            while True:
+                epoch, updates = self._receive_updates()
+                with self._update_lock:
+                    self._check_epoch(epoch)
+                    for property_name, value, sequence in updates:
+                        if property_name.startswith(property_server.SYNC_PREFIX):
+                            sync_event = self._sync_events.get(property_name)
+                            if sync_event is not None:
+                                sync_event.set()
+                            continue
+                        if sequence is not None:
+                            if sequence <= self._sequences.get(property_name, -1):
+                                continue # older than the value we have from a snapshot
+                            self._sequences[property_name] = sequence
+                        self._update(property_name, value)
+        except control.Stopped:
+            pass
+        finally:
+            for queued_callback in list(self._queued_callbacks.values()):
+                queued_callback.stop()
+
+    def _check_epoch(self, epoch):
+        # a server that was restarted numbers its updates from the beginning again,
+        # so sequence numbers from before then say nothing about the order of new updates
+        if epoch is not None and epoch != self._epoch:
+            self._sequences.clear()
+            self._epoch = epoch
+
+    def _reset_sequences(self):
+        with self._update_lock:
+            self._sequences.clear()
+            self._epoch = None
+
+    def _update(self, property_name, value):
+        self.properties[property_name] = value
+        for subscriber in self._subscribers(property_name):
+            if not self.queue_callbacks:
+                _call_callback(*subscriber, property_name, value)
+            else:
+                queued_callback = self._queued_callbacks.get(subscriber)
+                if queued_callback is not None: # might be None if unsubscribed from another thread just now
+                    queued_callback.put(property_name, value)
+
+    def _subscribers(self, property_name):
+        """Return a tuple of the (callback, valueonly) pairs subscribed to the
+        named property, directly or by prefix."""
+        dispatch_cache = self._dispatch_cache
+        subscribers = dispatch_cache.get(property_name)
+        if subscribers is None:
+            # use get() so that updates to unsubscribed properties (which may arrive
+            # as part of a group of updates) don't add entries to self.callbacks
+            subscribers = list(self.callbacks.get(property_name, ()))
+            for property_prefix, callbacks in list(self.prefix_callbacks.items()):
+                if property_name.startswith(property_prefix):
+                    subscribers.extend(callbacks)
+            subscribers = dispatch_cache[property_name] = tuple(subscribers)
+        return subscribers
+
+    def _add_subscriber(self, callbacks, subscriber):
+        if subscriber in callbacks:
+            return
+        callbacks.add(subscriber)
+        self._dispatch_cache = {}
+        self._subscriber_counts[subscriber] += 1
+        if self.queue_callbacks and subscriber not in self._queued_callbacks:
+            self._queued_callbacks[subscriber] = _QueuedCallback(*subscriber)
+
+    def _remove_subscriber(self, callbacks, subscriber):
+        callbacks.remove(subscriber)
+        self._dispatch_cache = {}
+        self._subscriber_counts[subscriber] -= 1
+        if self._subscriber_counts[subscriber] == 0:
+            del self._subscriber_counts[subscriber]
+            queued_callback = self._queued_callbacks.pop(subscriber, None)
+            if queued_callback is not None:
+                queued_callback.stop()
+
+    def synchronize(self, get_snapshot):
+        """Update the local copy of all property values from a snapshot of the
+        server's current state, and call the callbacks of all subscribed
+        properties with their current values. This is the way for a newly
+        connected client to learn the current state, without making the server
+        re-send every property value to every client.
+
+        Updates received from the server are numbered, so any updates that are
+        older than the snapshot (but were delayed in transit) are ignored, and
+        any newer updates received before the snapshot are not overwritten.
+
+        Parameters:
+            get_snapshot: function that returns (sequence, properties, epoch),
+                as from PropertyServer.snapshot() (e.g. the 'property_snapshot'
+                function of a ScopeClient). (Snapshots without an epoch, from
+                older servers, are also accepted.)
+        """
+        self._apply_snapshot(get_snapshot())
+
+    def _apply_snapshot(self, snapshot):
+        sequence, properties, *epoch = snapshot
+        with self._update_lock:
+            self._check_epoch(epoch[0] if epoch else None)
+            for property_name, value in properties.items():
+                if self._sequences.get(property_name, -1) <= sequence:
+                    self._sequences[property_name] = sequence
+                    self._update(property_name, value)
 
     def stop(self):
         self.running = False
@@ -60,7 +183,7 @@ class PropertyClient(threading.Thread):
 
         Multiple callbacks can be registered for a single property_name.
         """
-        self.callbacks[property_name].add((callback, valueonly))
+        self._add_subscriber(self.callbacks[property_name], (callback, valueonly))
 
     def unsubscribe(self, property_name, callback, valueonly=False):
         """Unregister an exactly matching, previously registered callback.  If
@@ -70,7 +193,7 @@ class PropertyClient(threading.Thread):
             raise ValueError('property_name parameter must not be None.')
         try:
             callbacks = self.callbacks[property_name]
-            callbacks.remove((callback, valueonly))
+            self._remove_subscriber(callbacks, (callback, valueonly))
         except KeyError:
             raise KeyError('No matching subscription found for property name "{}".'.format(property_name)) from None
         if not callbacks:
@@ -89,7 +212,7 @@ class PropertyClient(threading.Thread):
         """
         if property_prefix not in self.prefix_callbacks:
             self.prefix_callbacks[property_prefix] = set()
-        self.prefix_callbacks[property_prefix].add((callback, False))
+        self._add_subscriber(self.prefix_callbacks[property_prefix], (callback, False))
 
     def unsubscribe_prefix(self, property_prefix, callback):
         """Unregister an exactly matching, previously registered callback.  If
@@ -99,30 +222,79 @@ class PropertyClient(threading.Thread):
             raise ValueError('property_prefix parameter must not be None.')
         try:
             callbacks = self.prefix_callbacks[property_prefix]
-            callbacks.remove((callback, False))
+            self._remove_subscriber(callbacks, (callback, False))
         except KeyError:
             raise KeyError('No matching subscription found for property name "{}".'.format(property_prefix))
         if not callbacks:
             del self.prefix_callbacks[property_prefix]
 
-    def _receive_update(self):
-        """Receive an update from the server, or raise an error if self.running
-        goes False."""
+    def _receive_updates(self):
+        """Receive one or more updates from the server, as (epoch, updates),
+        where epoch is the server's epoch ID and updates is a list of
+        (property_name, value, sequence) tuples (either of which may be None if
+        not known), or raise control.Stopped if self.running goes False."""
         raise NotImplementedError()
 
-class ZMQClient(PropertyClient):
-    def __init__(self, addr, heartbeat_sec=None, context=None, daemon=True):
+def _call_callback(callback, valueonly, property_name, value):
+    try:
+        if valueonly:
+            callback(value)
+        else:
+            callback(property_name, value)
+    except Exception as e:
+        print('Caught exception in PropertyClient callback:')
+        traceback.print_exception(type(e), e, e.__traceback__)
+
+class _QueuedCallback(threading.Thread):
+    def __init__(self, callback, valueonly):
+        """Call a property callback from a separate thread, with a queue of
+        pending updates that keeps only the newest value of each property."""
+        super().__init__(name='PropertyClient callback', daemon=True)
+        self.callback = callback
+        self.valueonly = valueonly
+        self.pending = collections.OrderedDict() # property names to values, in order of arrival
+        self.condition = threading.Condition()
+        self.running = True
+        self.start()
+
+    def put(self, property_name, value):
+        with self.condition:
+            self.pending[property_name] = value
+            self.pending.move_to_end(property_name)
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                property_name, value = self.pending.popitem(last=False)
+            _call_callback(self.callback, self.valueonly, property_name, value)
+
+class ZMQClient(control.ControlledLoopMixin, PropertyClient):
+    def __init__(self, addr, heartbeat_sec=None, context=None, daemon=True, queue_callbacks=False):
         """PropertyClient subclass that uses ZeroMQ PUB/SUB to receive out updates.
         Parameters:
             addr: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
             context: a ZeroMQ context to share, if one already exists.
             daemon: exit the client when the foreground thread exits.
+            queue_callbacks: if True, call each callback from its own thread,
+                with a queue holding the newest pending update of each property
+                (see PropertyClient documentation).
         """
         self.context = context if context is not None else zmq.Context()
         self.addr = addr
         self.heartbeat_sec = heartbeat_sec
         self.connected = threading.Event()
-        super().__init__(daemon)
+        self._control = control.ControlSocket(self.context, self._handle_control_message)
+        super().__init__(daemon, queue_callbacks)
 
     def run(self):
         self._connect()
@@ -130,11 +302,20 @@ class ZMQClient(PropertyClient):
             super().run()
         finally:
             self.socket.close()
+            self._control.close()
 
     def reconnect(self):
         self.connected.clear()
+        self._control.send('reconnect')
         self.connected.wait()
 
+    def _handle_control_message(self, message):
+        if message == 'reconnect':
+            self.socket.close()
+            # the server may have been restarted, so its sequence numbers may have started over
+            self._reset_sequences()
+            self._connect()
+
     def _connect(self):
         self.socket = self.context.socket(zmq.SUB)
         self.socket.RCVTIMEO = 0 # we use poll to determine whether there's data to receive, so we don't want to wait on recv
@@ -146,44 +327,146 @@ class ZMQClient(PropertyClient):
             self.socket.HEARTBEAT_TTL = heartbeat_ms * 2
         self.socket.connect(self.addr)
         for property_name in list(self.callbacks) + list(self.prefix_callbacks):
-            self.socket.setsockopt_string(zmq.SUBSCRIBE, property_name)
+            self._subscribe_socket(property_name)
         self.connected.set()
 
+    def _subscribe_socket(self, property_name):
+        # also subscribe to any group messages that could contain the property
+        self.socket.subscribe(property_name)
+        self.socket.subscribe(property_server.group_topic(property_name))
+
+    def _unsubscribe_socket(self, property_name):
+        self.socket.unsubscribe(property_name)
+        self.socket.unsubscribe(property_server.group_topic(property_name))
+
     def subscribe(self, property_name, callback, valueonly=False):
         self.connected.wait()
-        self.socket.subscribe(property_name)
+        self._subscribe_socket(property_name)
         super().subscribe(property_name, callback, valueonly)
     subscribe.__doc__ = PropertyClient.subscribe.__doc__
 
     def unsubscribe(self, property_name, callback, valueonly=False):
         super().unsubscribe(property_name, callback, valueonly)
         self.connected.wait()
-        self.socket.unsubscribe(property_name)
+        self._unsubscribe_socket(property_name)
     unsubscribe.__doc__ = PropertyClient.unsubscribe.__doc__
 
     def subscribe_prefix(self, property_prefix, callback):
         self.connected.wait()
-        self.socket.subscribe(property_prefix)
+        self._subscribe_socket(property_prefix)
         super().subscribe_prefix(property_prefix, callback)
     subscribe_prefix.__doc__ = PropertyClient.subscribe_prefix.__doc__
 
     def unsubscribe_prefix(self, property_prefix, callback):
         super().unsubscribe_prefix(property_prefix, callback)
         self.connected.wait()
-        self.socket.unsubscribe(property_prefix)
+        self._unsubscribe_socket(property_prefix)
     unsubscribe_prefix.__doc__ = PropertyClient.unsubscribe_prefix.__doc__
 
-    def _receive_update(self):
-        while not self.socket.poll(500): # 500 ms wait before checking self.running again
-            if not self.running:
-                raise RuntimeError()
-            if not self.connected.is_set():
-                # reconnect was requested
-                self.socket.close()
-                self._connect()
-        # poll returned true: socket has data to recv
-        property_name = self.socket.recv_string()
-        assert(self.socket.getsockopt(zmq.RCVMORE))
-        value = self.socket.recv_json()
-        return property_name, value
+    def synchronize(self, get_snapshot, sync_timeout_sec=0.5, max_tries=10):
+        """Update the local copy of all property values from a snapshot of the
+        server's current state, as for PropertyClient.synchronize(), making sure
+        that no updates published after the snapshot are missed while this
+        client's subscriptions take effect.
+
+        Parameters:
+            get_snapshot: function that takes a sync topic and returns
+                (sequence, properties, epoch), as from PropertyServer.snapshot()
+                (e.g. the 'property_snapshot' function of a ScopeClient).
+            sync_timeout_sec: time to wait for the server to confirm that the
+                subscriptions are in effect, before trying another snapshot.
+            max_tries: number of snapshots to try. If no confirmation arrives,
+                the last snapshot is used anyway.
+        """
+        self.connected.wait()
+        # subscribe to the sync topic after all other subscriptions, so that they are
+        # all in effect on the server once an update on the sync topic gets through
+        sync_topic = property_server.SYNC_PREFIX + uuid.uuid4().hex
+        sync_event = threading.Event()
+        self._sync_events[sync_topic] = sync_event
+        self.socket.subscribe(sync_topic)
+        try:
+            for i in range(max_tries):
+                snapshot = get_snapshot(sync_topic)
+                if sync_event.wait(sync_timeout_sec):
+                    break
+        finally:
+            self.socket.unsubscribe(sync_topic)
+            del self._sync_events[sync_topic]
+        self._apply_snapshot(snapshot)
+
+    def _receive_updates(self):
+        # wait for data, handling any reconnect requests that arrive in the meantime
+        while not self._control.poll(self.socket):
+            pass
+        # poll returned the socket: it has data to recv
+        return _decode_message(self.socket.recv_multipart())
+
+class AsyncZMQClient:
+    def __init__(self, addr, heartbeat_sec=None, context=None):
+        """Client for receiving property updates from a ZeroMQ PUB/SUB property
+        server in asyncio code. Instead of registering callbacks to be called
+        from a background thread, iterate over updates() in a coroutine:
+
+            async for property_name, value in client.updates('scope.stage.'):
+                ...
+
+        Parameters:
+            addr: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
+            heartbeat_sec: if not None, interval at which to check that the server is alive.
+            context: a zmq.asyncio.Context to share, if one already exists.
+        """
+        self.context = context if context is not None else zmq.asyncio.Context()
+        self.addr = addr
+        self.heartbeat_sec = heartbeat_sec
+        # properties is a local copy of all properties received by any updates() iterator
+        self.properties = {}
+
+    async def updates(self, *property_prefixes):
+        """Asynchronously iterate over (property_name, value) pairs for each
+        update to a property whose name starts with any of the given prefixes.
+        If no prefixes are given, all updates are received.
+
+        Each iterator has its own subscription, so several may be used at once
+        (e.g. in different tasks) without interfering with one another.
+        """
+        socket = self.context.socket(zmq.SUB)
+        socket.LINGER = 0
+        if self.heartbeat_sec is not None:
+            heartbeat_ms = self.heartbeat_sec * 1000
+            socket.HEARTBEAT_IVL = heartbeat_ms
+            socket.HEARTBEAT_TIMEOUT = heartbeat_ms * 2
+            socket.HEARTBEAT_TTL = heartbeat_ms * 2
+        socket.connect(self.addr)
+        property_prefixes = tuple(property_prefixes) or ('',)
+        for property_prefix in property_prefixes:
+            socket.subscribe(property_prefix)
+            socket.subscribe(property_server.group_topic(property_prefix))
+        try:
+            while True:
+                epoch, updates = _decode_message(await socket.recv_multipart())
+                for property_name, value, sequence in updates:
+                    if property_name.startswith(property_server.SYNC_PREFIX):
+                        continue # only for ZMQClient.synchronize()
+                    self.properties[property_name] = value
+                    # group messages may also contain updates to other properties
+                    if property_name.startswith(property_prefixes):
+                        yield property_name, value
+        finally:
+            socket.close()
+
+def _decode_message(frames):
+    """Return (epoch, updates) for a message from the property server, which
+    may contain a single update or a group of updates, where updates is a list
+    of (property_name, value, sequence) tuples. The epoch (and the sequence of
+    a single update) is None for messages from older servers."""
+    topic, value, *extra = frames
+    topic = topic.decode('utf8')
+    value = zmq.utils.jsonapi.loads(value)
+    if topic.endswith(property_server.GROUP_MARKER):
+        epoch = extra[0].decode('ascii') if extra else None
+        return epoch, [tuple(update) for update in value]
+    sequence = int(extra[0]) if extra else None
+    epoch = extra[1].decode('ascii') if len(extra) > 1 else None
+    return epoch, [(topic, value, sequence)]
 
@@ -0,0 +1,160 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Server-side recording of the history of numeric property values.
+
+A PropertyHistory listens to every update published by a PropertyServer, and
+records the (time, value) pairs of selected properties into fixed-size ring
+buffers of numpy arrays, one per property. History can then be queried over a
+time range, and downsampled on the server to a given number of points, so that
+clients can plot (say) a week of temperature data from a few hundred points
+rather than transferring every recorded value.
+"""
+
+import numbers
+import threading
+import time
+
+import numpy
+
+_INITIAL_SIZE = 1024
+
+class _RingBuffer:
+    def __init__(self, capacity):
+        """Ring buffer of (time, value) pairs, which stores at most 'capacity'
+        pairs. Memory is allocated as needed, up to the capacity."""
+        self.capacity = capacity
+        size = min(capacity, _INITIAL_SIZE)
+        self.times = numpy.empty(size, dtype=numpy.float64)
+        self.values = numpy.empty(size, dtype=numpy.float64)
+        self.count = 0 # number of pairs stored
+        self.index = 0 # where the next pair will be stored
+
+    def append(self, t, value):
+        if self.index == len(self.times) and len(self.times) < self.capacity:
+            size = min(self.capacity, 2 * len(self.times))
+            self.times = numpy.resize(self.times, size)
+            self.values = numpy.resize(self.values, size)
+        elif self.index == self.capacity:
+            self.index = 0
+        self.times[self.index] = t
+        self.values[self.index] = value
+        self.index += 1
+        self.count = min(self.count + 1, self.capacity)
+
+    def get(self, start=None, end=None):
+        """Return copies of the times and values arrays, in chronological order,
+        for the pairs with start <= time <= end."""
+        if self.count < self.capacity:
+            segments = [(0, self.count)]
+        else: # full, so the oldest pair is at self.index
+            segments = [(self.index, self.capacity), (0, self.index)]
+        times = []
+        values = []
+        for a, b in segments:
+            segment_times = self.times[a:b]
+            lo = 0 if start is None else numpy.searchsorted(segment_times, start, side='left')
+            hi = len(segment_times) if end is None else numpy.searchsorted(segment_times, end, side='right')
+            times.append(segment_times[lo:hi])
+            values.append(self.values[a+lo:a+hi])
+        return numpy.concatenate(times), numpy.concatenate(values)
+
+
+class PropertyHistory:
+    def __init__(self, property_server, recorded_properties):
+        """Record the history of numeric property values published by a
+        PropertyServer.
+
+        Parameters:
+            property_server: PropertyServer instance to record updates from.
+            recorded_properties: dict mapping property names, or prefixes ending
+                in '.', to the maximum number of values to keep for each
+                matching property. If more than one entry matches a property,
+                the longest is used. Once the maximum is reached, the oldest
+                values are discarded.
+
+        Values of non-numeric properties are not recorded, except that None
+        is recorded as NaN.
+        """
+        self._recorded_properties = dict(recorded_properties)
+        self._buffers = {}
+        self._capacities = {} # property names to the capacity of their buffer, or None if not recorded
+        self._sequences = {} # property names to the sequence number of the last recorded update
+        self._lock = threading.Lock()
+        property_server.add_listener(self._record)
+
+    def _get_capacity(self, property_name):
+        try:
+            return self._capacities[property_name]
+        except KeyError:
+            pass
+        matches = [name for name in self._recorded_properties if name == property_name or
+            (name.endswith('.') and property_name.startswith(name))]
+        capacity = self._recorded_properties[max(matches, key=len)] if matches else None
+        self._capacities[property_name] = capacity
+        return capacity
+
+    def _record(self, property_name, value, sequence):
+        capacity = self._get_capacity(property_name)
+        if capacity is None:
+            return
+        if value is None:
+            value = numpy.nan
+        elif not isinstance(value, numbers.Real):
+            return
+        if sequence <= self._sequences.get(property_name, -1):
+            return # a repeat of an earlier update, e.g. from rebroadcast_properties()
+        self._sequences[property_name] = sequence
+        with self._lock:
+            buffer = self._buffers.get(property_name)
+            if buffer is None:
+                buffer = self._buffers[property_name] = _RingBuffer(capacity)
+            buffer.append(time.time(), value)
+
+    def recorded_properties(self):
+        """Return a dict mapping the names of properties with recorded history
+        to the number of values recorded."""
+        with self._lock:
+            return {property_name: buffer.count for property_name, buffer in sorted(self._buffers.items())}
+
+    def history(self, property_name, start=None, end=None, max_points=500):
+        """Return the recorded values of a property between the start and end
+        times (in seconds since the epoch, as from time.time()).
+
+        Parameters:
+            property_name: name of a property with recorded history.
+            start, end: time range to return; None means the time of the
+                earliest or latest recorded value, respectively.
+            max_points: if more values than this were recorded in the time
+                range, divide the range into max_points equal intervals and
+                return summary statistics for the values in each interval.
+                If None, return all the values.
+
+        Returns a dict with the following keys, each of which maps to a list
+        with one entry for each recorded value (or for each interval with any
+        values recorded, if the values were downsampled):
+            'time': time of the value, or the mean time of the values in the interval.
+            'mean', 'min', 'max': statistics of the values in the interval
+                (for values that were not downsampled, all are the value itself).
+            'count': number of values in the interval (1 if not downsampled).
+        """
+        with self._lock:
+            try:
+                buffer = self._buffers[property_name]
+            except KeyError:
+                raise KeyError('No history recorded for property "{}"'.format(property_name)) from None
+            times, values = buffer.get(start, end)
+        if max_points is None or len(times) <= max_points:
+            values = values.tolist()
+            return dict(time=times.tolist(), mean=values, min=values, max=values, count=[1] * len(values))
+        t0 = times[0] if start is None else start
+        t1 = times[-1] if end is None else end
+        bins = ((times - t0) * (max_points / max(t1 - t0, 1e-9))).astype(numpy.intp)
+        numpy.clip(bins, 0, max_points - 1, out=bins)
+        # times are sorted, so each interval's values are contiguous: find where each one starts
+        starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(bins)) + 1])
+        counts = numpy.diff(numpy.append(starts, len(times)))
+        return dict(time=(numpy.add.reduceat(times, starts) / counts).tolist(),
+            mean=(numpy.add.reduceat(values, starts) / counts).tolist(),
+            min=numpy.minimum.reduceat(values, starts).tolist(),
+            max=numpy.maximum.reduceat(values, starts).tolist(),
+            count=counts.tolist())
@@ -3,6 +3,8 @@
 import zmq
 import threading
 import queue
+import time
+import uuid
 
 from zplib import datafile
 
@@ -11,6 +13,44 @@ logger = logging.get_logger(__name__)
 
 _NOTHING = object() # will compare false to anything, even None
 
+# Updates that are published together are grouped by the namespace that contains
+# them (e.g. 'scope.stage.' for 'scope.stage.x'), and each group is sent as a
+# single message. The topic of a group message is the namespace followed by
+# GROUP_MARKER (which cannot appear in a property name), so that clients
+# subscribed to a prefix of the namespace receive it, but clients subscribed to
+# individual properties only receive it if they also subscribe to group_topic()
+# of the property name. The message body is a JSON list of [name, value, sequence]
+# lists.
+#
+# Each update is numbered in order with a sequence number, which is sent as the
+# (ASCII-encoded) third frame of single-update messages. A client can get the
+# current value of every property from snapshot(), along with the sequence number
+# of the most recent update, and then combine that with updates from the PUB
+# stream: any update with a lower sequence number is older than the snapshot.
+#
+# Sequence numbers start over when the server is restarted, so each server
+# instance has a random "epoch" ID, which is sent as the (ASCII-encoded) last
+# frame of every message and returned by snapshot(). Sequence numbers from
+# different epochs cannot be compared.
+#
+# A SUB socket's subscriptions take effect on the server some time after they
+# are made, so updates published after a snapshot could be missed by a client
+# that just subscribed. To avoid this, snapshot() can be passed a topic starting
+# with SYNC_PREFIX, which the client subscribes to after its other subscriptions:
+# an update of that name (with a null value and the snapshot's sequence number)
+# is then published right after the updates included in the snapshot. Once the
+# client receives it, all of its subscriptions are in effect, and it will
+# receive every later update. (Otherwise, it can try another snapshot.)
+GROUP_MARKER = '\0'
+SYNC_PREFIX = '__sync__.'
+_MAX_DRAIN = 1000 # maximum number of queued updates to handle before publishing
+
+def group_topic(property_name):
+    """Return the topic of group messages that could contain updates to
+    properties starting with the given name (or prefix)."""
+    namespace, dot, name = property_name.rpartition('.')
+    return namespace + dot + GROUP_MARKER
+
 class PropertyServer(threading.Thread):
     """Server for publishing changes to properties (i.e. (key, value) pairs) to
     other clients.
@@ -37,49 +77,218 @@ class PropertyServer(threading.Thread):
             def x(self, value):
                 self._x = value
 
+    Each update is numbered with a sequence number (which, along with the
+    server's 'epoch' ID, identifies the update); snapshot() returns the
+    current value of every property along with the latest sequence number, so
+    that new clients can learn the current state without requiring all
+    properties to be re-published to every client (as with
+    rebroadcast_properties()).
+
+    How each update is published depends on the publication policy for the
+    property (see set_publication_policy()). By default, every update is
+    published immediately. Updates that are ready to be published at the same
+    time (e.g. a burst of updates from setting up a device) are published
+    together with _publish_updates().
     """
     def __init__(self):
         super().__init__(daemon=True)
         self.properties = {}
+        self.sequence = 0 # sequence number of the most recent update
+        self.epoch = uuid.uuid4().hex # distinguishes this server's sequence numbers from those of earlier instances
+        self._sequences = {} # property names to the sequence number of their current values
+        self._lock = threading.Lock()
         self.task_queue = queue.Queue()
+        self._policies = {}
+        self._policy_cache = {} # property names to the policy that applies to them
+        self._last_published = {} # 'latest' property names to the time they were last published
+        self._latest_pending = {} # 'latest' property names to (value, sequence) pairs waiting to be published
+        self._latest_deadlines = {} # 'latest' property names to the time their pending value is due
+        self._batch_pending = [] # (property name, value, sequence) updates waiting to be published
+        self._batch_deadline = None
+        self._listeners = []
         self.running = True
         self.start()
 
+    def add_listener(self, listener):
+        """Register a function to be called as listener(property_name, value,
+        sequence) for every update, from the publishing thread, before the
+        publication policy is applied. Note that rebroadcast_properties()
+        repeats earlier updates, with their original sequence numbers."""
+        self._listeners.append(listener)
+
+    def set_publication_policy(self, name, policy, interval=None):
+        """Set how updates to a property, or a group of properties, are published.
+
+        Parameters:
+            name: a property name, or a prefix ending in '.' (e.g. 'scope.stage.')
+                that applies to all properties whose names start with it. If
+                more than one policy applies to a property, the one with the
+                longest name is used.
+            policy: one of:
+                'immediate': publish every update as soon as it is made.
+                'latest': publish at most one update per 'interval' seconds;
+                    if the property changes more often, intermediate values are
+                    dropped, but the latest value is always published (at most
+                    'interval' seconds after it was set).
+                'batch': publish every update, but collect updates for up to
+                    'interval' seconds and publish them together.
+                None: remove any policy set for this name.
+            interval: time in seconds (required for 'latest' and 'batch').
+        """
+        if policy not in ('immediate', 'latest', 'batch', None):
+            raise ValueError('Unknown publication policy "{}"'.format(policy))
+        if policy in ('latest', 'batch') and interval is None:
+            raise ValueError('An interval is required for the "{}" publication policy'.format(policy))
+        policies = dict(self._policies)
+        if policy is None:
+            policies.pop(name, None)
+        else:
+            policies[name] = (policy, interval)
+        # replace rather than modify the dicts, which are in use from the publishing thread
+        self._policies = policies
+        self._policy_cache = {}
+
+    def _get_policy(self, property_name):
+        policy_cache = self._policy_cache
+        policy = policy_cache.get(property_name)
+        if policy is None:
+            policies = self._policies
+            matches = [name for name in policies if name == property_name or
+                (name.endswith('.') and property_name.startswith(name))]
+            policy = policies[max(matches, key=len)] if matches else ('immediate', None)
+            policy_cache[property_name] = policy
+        return policy
+
     def run(self):
-        while self.running:
+        while True:
+            deadlines = list(self._latest_deadlines.values())
+            if self._batch_deadline is not None:
+                deadlines.append(self._batch_deadline)
             try:
-                property_name, value = self.task_queue.get(timeout=0.5) # wake up if something in queue, or if it's time to check self.running
-                self._publish_update(property_name, value)
+                if deadlines:
+                    task = self.task_queue.get(timeout=max(0, min(deadlines) - time.perf_counter()))
+                else:
+                    task = self.task_queue.get()
             except queue.Empty:
-                pass
+                task = _NOTHING
+            updates = []
+            stopping = task is None # sentinel placed in the queue by stop()
+            if not stopping and task is not _NOTHING:
+                self._handle_update(*task, updates)
+                # handle any other updates that are already queued, so they can be published together
+                for i in range(_MAX_DRAIN):
+                    try:
+                        task = self.task_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if task is None:
+                        stopping = True
+                        break
+                    self._handle_update(*task, updates)
+            self._publish_pending(updates, flush=stopping)
+            if updates:
+                self._publish_updates(updates)
+            if stopping:
+                break
+
+    def _handle_update(self, property_name, value, sequence, updates):
+        """Apply the property's publication policy to an update, appending it
+        to the list of updates if it is to be published now."""
+        if property_name.startswith(SYNC_PREFIX):
+            # not a real property: publish it at once, after the updates queued before it
+            # (and separately from any later ones, which grouping could otherwise send first)
+            if updates:
+                self._publish_updates(updates)
+                updates.clear()
+            self._publish_updates([(property_name, value, sequence)])
+            return
+        for listener in self._listeners:
+            try:
+                listener(property_name, value, sequence)
+            except Exception:
+                logger.log_exception('Error in property listener:')
+        policy, interval = self._get_policy(property_name)
+        if policy == 'latest':
+            now = time.perf_counter()
+            last_published = self._last_published.get(property_name)
+            if property_name in self._latest_pending or (last_published is not None and now - last_published < interval):
+                self._latest_pending[property_name] = value, sequence
+                self._latest_deadlines[property_name] = last_published + interval
+                return
+            self._last_published[property_name] = now
+        elif policy == 'batch':
+            if self._batch_deadline is None:
+                self._batch_deadline = time.perf_counter() + interval
+            self._batch_pending.append((property_name, value, sequence))
+            return
+        updates.append((property_name, value, sequence))
+
+    def _publish_pending(self, updates, flush=False):
+        """Append any coalesced or batched updates that are due (or all of
+        them, if flush is True) to the list of updates to publish."""
+        now = time.perf_counter()
+        for property_name, deadline in list(self._latest_deadlines.items()):
+            if flush or deadline <= now:
+                del self._latest_deadlines[property_name]
+                self._last_published[property_name] = now
+                updates.append((property_name, *self._latest_pending.pop(property_name)))
+        if self._batch_deadline is not None and (flush or self._batch_deadline <= now):
+            updates.extend(self._batch_pending)
+            self._batch_pending = []
+            self._batch_deadline = None
 
     def stop(self):
         self.running = False
+        self.task_queue.put(None)
         self.join()
 
     def rebroadcast_properties(self):
-        """Re-send an update about all known property values. Useful for
-        clients that have just connected and want to learn about the current
-        state."""
-        for property_name, value in self.properties.items():
-            self.task_queue.put((property_name, value))
+        """Re-send an update about all known property values to all clients.
+        Clients that have just connected and want to learn about the current
+        state should generally use snapshot() instead."""
+        with self._lock:
+            for property_name, value in self.properties.items():
+                self.task_queue.put((property_name, value, self._sequences[property_name]))
+
+    def snapshot(self, sync_topic=None):
+        """Return (sequence, properties, epoch), where properties is a dict of
+        the current values of all properties, sequence is the sequence number
+        of the most recent update included in those values, and epoch is the
+        ID of this server instance.
+
+        If sync_topic (a name starting with SYNC_PREFIX) is given, an update of
+        that name is published after all the updates included in the snapshot
+        (see the notes at the top of this module)."""
+        with self._lock:
+            if sync_topic is not None:
+                if not sync_topic.startswith(SYNC_PREFIX):
+                    raise ValueError('Sync topic must start with "{}"'.format(SYNC_PREFIX))
+                self.task_queue.put((sync_topic, None, self.sequence))
+            return self.sequence, dict(self.properties), self.epoch
 
     def add_property(self, property_name, value):
         """Add a named property and provide an initial value.
         Returns a callback to call when the property's value has changed."""
-        self.properties[property_name] = value
+        with self._lock:
+            self.sequence += 1
+            self.properties[property_name] = value
+            self._sequences[property_name] = self.sequence
         def change_callback(value):
             self.update_property(property_name, value)
         return change_callback
 
     def update_property(self, property_name, value):
         """Inform the server that the property has a new value"""
-        if self.properties.get(property_name, _NOTHING) == value: # don't use None as the default since the value might be None
-            # don't update if we already have this precise value
-            return
-        self.properties[property_name] = value
+        with self._lock:
+            if self.properties.get(property_name, _NOTHING) == value: # don't use None as the default since the value might be None
+                # don't update if we already have this precise value
+                return
+            self.sequence += 1
+            self.properties[property_name] = value
+            self._sequences[property_name] = self.sequence
+            # queue the update while holding the lock, so that updates are queued in sequence order
+            self.task_queue.put((property_name, value, self.sequence))
         logger.debug('updating property: {} to {}', property_name, value)
-        self.task_queue.put((property_name, value))
 
     def property_decorator(self, property_name):
         """Return a property decorator that will auto-update the named
@@ -92,7 +301,12 @@ class PropertyServer(threading.Thread):
                 propertyserver.update_property(property_name, value)
         return serverproperty
 
-    def _publish_update(self, property_name, value):
+    def _publish_updates(self, updates):
+        """Publish a list of (property_name, value, sequence) updates."""
+        for property_name, value, sequence in updates:
+            self._publish_update(property_name, value, sequence)
+
+    def _publish_update(self, property_name, value, sequence):
         raise NotImplementedError()
 
 class ZMQServer(PropertyServer):
@@ -113,8 +327,28 @@ class ZMQServer(PropertyServer):
         finally:
             self.socket.close()
 
-    def _publish_update(self, property_name, value):
-        # dump json first to catch "not serializable" errors before sending the first part of a two-part message
+    def _publish_updates(self, updates):
+        groups = {}
+        for update in updates:
+            groups.setdefault(group_topic(update[0]), []).append(update)
+        for topic, group in groups.items():
+            if len(group) == 1:
+                self._publish_update(*group[0])
+                continue
+            try:
+                json = datafile.json_encode_compact_to_bytes(group)
+            except (TypeError, ValueError):
+                # send the updates separately, so that only the unserializable value(s) fail
+                super()._publish_updates(group)
+            else:
+                self.socket.send_string(topic, flags=zmq.SNDMORE)
+                self.socket.send(json, flags=zmq.SNDMORE)
+                self.socket.send_string(self.epoch)
+
+    def _publish_update(self, property_name, value, sequence):
+        # dump json first to catch "not serializable" errors before sending the first part of a multipart message
         json = datafile.json_encode_compact_to_bytes(value)
         self.socket.send_string(property_name, flags=zmq.SNDMORE)
-        self.socket.send(json)
+        self.socket.send(json, flags=zmq.SNDMORE)
+        self.socket.send_string(str(sequence), flags=zmq.SNDMORE)
+        self.socket.send_string(self.epoch)
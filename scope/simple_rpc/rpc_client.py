@@ -1,12 +1,25 @@
 # This code is licensed under the MIT License (see LICENSE file for details)
 
 import zmq
+import zmq.asyncio
+# PyZMQ 15.0.0's __init__.py apparently does not import utils.jsonapi, requiring this explicit import
+import zmq.utils.jsonapi
+import asyncio
 import collections
 import contextlib
+import functools
+import itertools
+import inspect
+import marshal
+import pathlib
+import sys
 import time
+import uuid
 
 from zplib import datafile
 
+from . import binary_codec
+
 class RPCError(RuntimeError):
     pass
 
@@ -24,16 +37,51 @@ class RPCClient:
     and appropriate argument names, defaults, etc., for run-time introspection.
     In contrast, client.proxy_function() merely returns a simplistic function that
     takes *args and **kwargs parameters.
+
+    Several calls can be sent to the server in a single message with the
+    batch() context manager; see its documentation for details.
+
+    Messages are JSON-encoded unless proxy_namespace() negotiates a binary
+    encoding with the server (see binary_codec), which is then used for all
+    further calls. The 'codec' attribute gives the encoding in use.
+
+    If the 'call_cache' attribute is not None, it must be an object with
+    lookup() and store() methods, which can supply the results of some calls
+    without contacting the server. Before each call, call_cache.lookup(command,
+    args, kwargs) is called, and returns (found, value, token). If found is
+    True, value is returned instead of making the call; otherwise, if token is
+    not None, the result of the call is passed to call_cache.store(token, result),
+    or if the call fails, call_cache.abandon(token) is called.
     """
+    codec = 'json'
+    call_cache = None
+    _batch_calls = None # list of queued calls when inside a batch() block
+    _proxy_method_class = '_ProxyMethodClass' # name of base class for rich proxy functions
+
     def __call__(self, command, *args, **kwargs):
-        self._send(command, args, kwargs)
+        if self._batch_calls is not None:
+            return self._queue_call(command, args, kwargs)
+        cache = self.call_cache
+        cache_token = None
+        if cache is not None:
+            found, value, cache_token = cache.lookup(command, args, kwargs)
+            if found:
+                return value
         try:
-            retval, is_error = self._receive_reply()
-        except KeyboardInterrupt:
-            self.send_interrupt()
-            retval, is_error = self._receive_reply()
-        if is_error:
-            raise RPCError(retval)
+            self._send(command, args, kwargs)
+            try:
+                retval, is_error = self._receive_reply()
+            except KeyboardInterrupt:
+                self.send_interrupt()
+                retval, is_error = self._receive_reply()
+            if is_error:
+                raise RPCError(retval)
+        except BaseException:
+            if cache_token is not None:
+                cache.abandon(cache_token)
+            raise
+        if cache_token is not None:
+            cache.store(cache_token, retval)
         return retval
 
     def _send(self, command, args, kwargs):
@@ -42,6 +90,60 @@ class RPCClient:
     def _receive_reply(self):
         raise NotImplementedError()
 
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager to send all calls made within the with-block to the
+        server as a single message, which saves a network round-trip per call.
+
+        Inside the block, calls (including calls via proxy functions and
+        property accesses) return BatchFuture objects instead of results. When
+        the block exits, the calls are sent and run in order on the server.
+        Each future's result() method then gives the return value of its call.
+        If a call raises an error, the subsequent calls are not run, and an
+        RPCError describing the failed call is raised at the end of the block.
+        If the block itself raises an exception, the queued calls are not sent.
+
+        Example:
+            with client.batch():
+                client('stage.set_x', 10)
+                z = client('stage.get_z')
+            print(z.result())
+        """
+        if self._batch_calls is not None:
+            # already in a batch: calls just join the enclosing batch
+            yield
+            return
+        self._batch_calls = []
+        try:
+            yield
+        except:
+            calls = self._batch_calls
+            self._batch_calls = None
+            for command, args, kwargs, future in calls:
+                future._set_error('Batch was not sent because of an exception.')
+            raise
+        calls = self._batch_calls
+        self._batch_calls = None
+        if calls:
+            self._send_batch(calls)
+
+    def _queue_call(self, command, args, kwargs):
+        future = BatchFuture(command)
+        self._batch_calls.append((command, args, kwargs, future))
+        return future
+
+    def _send_batch(self, calls):
+        results, error = self('__BATCH__', [(command, args, kwargs) for command, args, kwargs, future in calls])
+        for result, (command, args, kwargs, future) in zip(results, calls):
+            future._set_result(result)
+        if error is not None:
+            error_index, error_text = error
+            failed_command = calls[error_index][0]
+            for command, args, kwargs, future in calls[error_index:]:
+                future._set_error('Not run because call {} ({}) in batch failed.'.format(error_index, failed_command))
+            calls[error_index][3]._set_error(error_text)
+            raise RPCError('Call {} ({}) in batch failed:\n{}'.format(error_index, failed_command, error_text))
+
     def send_interrupt(self):
         """Raise a KeyboardInterrupt exception in the server process"""
         raise NotImplementedError()
@@ -53,7 +155,7 @@ class RPCClient:
         func.__name__ = func.__qualname__ = command
         return func
 
-    def proxy_namespace(self, no_property={}):
+    def proxy_namespace(self, no_property={}, cache_dir=None, lazy=False):
         """Use the RPC server's __DESCRIBE__ functionality to reconstitute a
         faxscimile namespace on the client side with well-described functions
         that can be seamlessly called.
@@ -61,27 +163,88 @@ class RPCClient:
         A set of the fully-qualified function names available in the namespace
         is included as the _functions_proxied attribute of this namespace.
 
-        Parameter:
+        Parameters:
             no_property: set of qualified names that should not be made properties,
                 despite starting with 'set_' or 'get_'.
+            cache_dir: if not None, directory in which to cache the server's
+                descriptions and the compiled proxy functions. If the server
+                reports that its descriptions are unchanged since they were
+                cached, the cached copy is used, which is much faster.
+            lazy: if True, sub-namespaces and proxy functions are created only
+                when first accessed, which is faster and uses less memory if
+                only a few functions are used. Docstrings, signatures, and
+                dir() work the same either way.
         """
+        cache_file = self._description_cache_file(cache_dir)
+        cached = _load_description_cache(cache_file)
+        known_hash = None if cached is None else cached['hash']
+        description = self('__DESCRIBE__', codecs=binary_codec.available_codecs(), known_hash=known_hash)
+        return self._namespace_from_description(description, cached, cache_file, no_property, lazy=lazy)
+
+    def _description_cache_file(self, cache_dir):
+        if cache_dir is None:
+            return None
+        # make a filename from the server address, like 'tcp_127.0.0.1_6000'
+        name = ''.join(c if c.isalnum() or c in '.-' else '_' for c in self.rpc_addr)
+        return pathlib.Path(cache_dir) / (name + '.describe')
+
+    def _namespace_from_description(self, description, cached, cache_file, no_property, make_properties=True, lazy=False):
+        """Build a proxy namespace from a __DESCRIBE__ reply, using and
+        updating the cached descriptions and proxy code if possible."""
+        if not isinstance(description, dict):
+            # older servers ignore the codecs argument and return only the descriptions
+            return self._build_namespace(description, no_property, make_properties, lazy=lazy)
+        self.codec = description['codec']
+        descriptions = description['descriptions']
+        if descriptions is None:
+            # server says our cached copy is current
+            return self._build_namespace(cached['descriptions'], no_property, make_properties, cached['proxy_code'], lazy)
+        proxy_code = {}
+        if cache_file is not None and 'hash' in description:
+            # compile all the proxy code now, even if lazy, so that later connections
+            # can skip compiling entirely (a lazy namespace would only compile what it uses)
+            for qualname, doc, argspec in descriptions:
+                proxy_code[qualname] = _compile_proxy_class(doc, argspec, qualname.rsplit('.', 1)[-1])
+            _save_description_cache(cache_file, dict(hash=description['hash'],
+                descriptions=descriptions, proxy_code=proxy_code))
+        return self._build_namespace(descriptions, no_property, make_properties, proxy_code, lazy)
+
+    def _build_namespace(self, descriptions, no_property, make_properties=True, proxy_code=None, lazy=False):
+        """Build a proxy namespace from a list of __DESCRIBE__ descriptions.
+        If make_properties is False, no get_/set_ functions are made into properties.
+        If proxy_code is not None, it must be a dict mapping qualified names to
+        compiled proxy classes: these will be used where present, and any newly
+        compiled classes will be added to the dict.
+        If lazy is True, sub-namespaces and proxy functions are only created
+        when first accessed."""
+        if proxy_code is None:
+            proxy_code = {}
         # group functions by their namespace
         server_namespaces = collections.defaultdict(list)
+        children = collections.defaultdict(set)
         functions_proxied = set()
-        for qualname, doc, argspec in self('__DESCRIBE__'):
+        for qualname, doc, argspec in descriptions:
             functions_proxied.add(qualname)
             *parents, name = qualname.split('.')
             parents = tuple(parents)
             server_namespaces[parents].append((name, qualname, doc, argspec))
-            # make sure that intermediate (and possibly-empty) namespaces are also in the dict
+            # make sure that intermediate (and possibly-empty) namespaces are also known
             for i in range(len(parents)):
-                server_namespaces[parents[:i]] # for a defaultdict, just looking up the entry adds it
-
-        # for each namespace that contains functions:
-        # 1: see if there are any get/set pairs to turn into properties, and
-        # 2: make a class for that namespace with the given properties and functions
-        client_namespaces = {}
-        for parents, function_descriptions in server_namespaces.items():
+                children[parents[:i]].add(parents[i])
+
+        def make_proxy(name, qualname, doc, argspec):
+            if lazy:
+                return _LazyProxyFunction(self, name, qualname, doc, argspec, proxy_code)
+            code = proxy_code.get(qualname)
+            if code is None:
+                code = proxy_code[qualname] = _compile_proxy_class(doc, argspec, name)
+            return _rich_proxy_function(code, name, self, qualname, self._proxy_method_class)
+
+        # for each namespace:
+        # 1: see if there are any get/set pairs to turn into properties,
+        # 2: make a class for that namespace with the given properties and functions, and
+        # 3: add the sub-namespaces (or functions to make them, if lazy)
+        def make_namespace(parents):
             # make a custom class to have the right names and more importantly to receive the namespace-specific properties
             class NewNamespace(_ClientNamespace):
                 pass
@@ -89,9 +252,9 @@ class RPCClient:
             NewNamespace.__qualname__ = '.'.join(parents) if parents else 'root'
             # create functions and gather property accessors
             accessors = collections.defaultdict(_AccessorProperty)
-            for name, qualname, doc, argspec in function_descriptions:
-                client_func = _rich_proxy_function(doc, argspec, name, self, qualname)
-                if qualname not in no_property:
+            for name, qualname, doc, argspec in server_namespaces[parents]:
+                client_func = make_proxy(name, qualname, doc, argspec)
+                if make_properties and qualname not in no_property:
                     if name.startswith('get_'):
                         accessors[name[4:]].getter = client_func
                         name = '_'+name
@@ -102,27 +265,96 @@ class RPCClient:
             for name, accessor_property in accessors.items():
                 accessor_property._set_doc()
                 setattr(NewNamespace, name, accessor_property)
-            client_namespaces[parents] = NewNamespace()
-
-        # now assemble these namespaces into the correct hierarchy, fetching intermediate
-        # namespaces from the proxy_namespaces dict as required.
-        root = client_namespaces[()]
-        for parents in list(client_namespaces.keys()):
-            if parents not in client_namespaces:
-                # we might have already popped it below
-                continue
-            namespace = root
-            for i, element in enumerate(parents):
-                try:
-                    namespace = getattr(namespace, element)
-                except AttributeError:
-                    new_namespace = client_namespaces.pop(parents[:i+1])
-                    setattr(namespace, element, new_namespace)
-                    namespace = new_namespace
+            if lazy:
+                NewNamespace._lazy_children = {child: functools.partial(make_namespace, parents + (child,))
+                    for child in children[parents]}
+            namespace = NewNamespace()
+            if not lazy:
+                for child in children[parents]:
+                    setattr(namespace, child, make_namespace(parents + (child,)))
+            return namespace
+
+        root = make_namespace(())
         root._functions_proxied = functions_proxied
         return root
 
 
+def _load_description_cache(cache_file):
+    """Return the cached descriptions from a file written by
+    _save_description_cache(), or None if unavailable."""
+    if cache_file is None:
+        return None
+    try:
+        with cache_file.open('rb') as f:
+            cached = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    # compiled code is only valid for the python version that produced it
+    if not isinstance(cached, dict) or cached.get('cache_tag') != sys.implementation.cache_tag:
+        return None
+    return cached
+
+def _save_description_cache(cache_file, cached):
+    cached['cache_tag'] = sys.implementation.cache_tag
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temp file and rename, so other clients never see a partial file
+        temp_file = cache_file.with_suffix('.tmp{}'.format(id(cached)))
+        with temp_file.open('wb') as f:
+            marshal.dump(cached, f)
+        temp_file.replace(cache_file)
+    except (OSError, ValueError):
+        # can't write cache (or descriptions contain un-marshalable defaults): no big deal
+        pass
+
+
+class BatchFuture:
+    """Placeholder for the result of a call made inside of an RPCClient.batch()
+    block. The result is available via result() once the batch has been sent."""
+    _NOT_SET = object()
+
+    def __init__(self, command):
+        self.command = command
+        self._result = self._NOT_SET
+        self._error = None
+        self._handlers = []
+
+    def __repr__(self):
+        if self._error is not None:
+            state = 'failed'
+        elif self._result is self._NOT_SET:
+            state = 'pending'
+        else:
+            state = 'done'
+        return '<BatchFuture for {} ({})>'.format(self.command, state)
+
+    def done(self):
+        """Return whether the batch containing this call has been run."""
+        return self._error is not None or self._result is not self._NOT_SET
+
+    def result(self):
+        """Return the result of the call, or raise RPCError if the call failed
+        or the batch has not yet been sent."""
+        if self._error is not None:
+            raise RPCError(self._error)
+        if self._result is self._NOT_SET:
+            raise RPCError('Result of {} is not available until the batch is sent.'.format(self.command))
+        # apply any output handlers lazily, so that e.g. image data is only fetched if asked for
+        while self._handlers:
+            self._result = self._handlers.pop(0)(self._result)
+        return self._result
+
+    def _add_handler(self, handler):
+        self._handlers.append(handler)
+        return self
+
+    def _set_result(self, result):
+        self._result = result
+
+    def _set_error(self, error):
+        self._error = error
+
+
 class _AccessorProperty:
     def __init__(self):
         self.getter = None
@@ -145,8 +377,42 @@ class _AccessorProperty:
         self.setter(value)
 
 
+class _LazyProxyFunction:
+    """Placeholder for a proxy function in a lazily-built namespace class,
+    which creates the real proxy function when first accessed, and then
+    replaces itself in the class with that function."""
+    def __init__(self, rpc_client, name, qualname, doc, argspec, proxy_code):
+        self._args = rpc_client, name, qualname, doc, argspec, proxy_code
+        self._proxy = None
+        self.__doc__ = doc
+
+    def _resolve(self):
+        if self._proxy is None:
+            rpc_client, name, qualname, doc, argspec, proxy_code = self._args
+            code = proxy_code.get(qualname)
+            if code is None:
+                code = proxy_code[qualname] = _compile_proxy_class(doc, argspec, name)
+            self._proxy = _rich_proxy_function(code, name, rpc_client, qualname, rpc_client._proxy_method_class)
+        return self._proxy
+
+    def __get__(self, obj, objtype=None):
+        proxy = self._resolve()
+        if objtype is None:
+            objtype = type(obj)
+        for name, value in vars(objtype).items():
+            if value is self:
+                setattr(objtype, name, proxy)
+                break
+        return proxy
+
+    def __call__(self, *args, **kws):
+        # called as the getter or setter of an _AccessorProperty
+        return self._resolve()(*args, **kws)
+
+
 class _ClientNamespace:
     __attrs_locked = False
+    _lazy_children = {} # maps names to functions that create sub-namespaces on first access
 
     def _lock_attrs(self):
         self.__attrs_locked = True
@@ -154,6 +420,20 @@ class _ClientNamespace:
             if hasattr(v, '_lock_attrs'):
                 v._lock_attrs()
 
+    def __getattr__(self, name):
+        # only called if normal attribute lookup fails: see if this is a lazily-created sub-namespace
+        make_namespace = type(self)._lazy_children.get(name)
+        if make_namespace is None:
+            raise AttributeError("'{}' namespace has no attribute '{}'".format(type(self).__qualname__, name))
+        namespace = make_namespace()
+        if self.__attrs_locked:
+            namespace._lock_attrs()
+        object.__setattr__(self, name, namespace)
+        return namespace
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(self._lazy_children))
+
     def __setattr__(self, name, value):
         if self.__attrs_locked:
             if not hasattr(self, name):
@@ -178,10 +458,12 @@ class ZMQClient(RPCClient):
         self.interrupt_addr = interrupt_addr
         self.heartbeat_sec = heartbeat_sec
         self._timeout_sec = timeout_sec
+        self._batch_timeout_sec = None
         self._connect()
 
     def _connect(self):
         self.socket = self.context.socket(zmq.REQ)
+        self._client_id = _set_routing_id(self.socket)
         self.socket.RCVTIMEO = 0 # we use poll to determine when a message is ready, so set a zero timeout
         self.socket.LINGER = 0
         self.socket.REQ_RELAXED = True
@@ -220,8 +502,21 @@ class ZMQClient(RPCClient):
             self._timeout_sec = old_timeout
 
     def _send(self, command, args, kwargs):
-        json = datafile.json_encode_compact_to_bytes((command, args, kwargs))
-        self.socket.send(json)
+        self.socket.send_multipart(_encode_request(self.codec, command, args, kwargs), copy=False)
+
+    def _queue_call(self, command, args, kwargs):
+        # the server runs batched calls one after another, so allow the batch as long
+        # to run as all of its calls together
+        if not self._batch_calls:
+            self._batch_timeout_sec = 0 # first call of the batch (an earlier batch may have been abandoned)
+        self._batch_timeout_sec += self._timeout_sec
+        return super()._queue_call(command, args, kwargs)
+
+    def _send_batch(self, calls):
+        timeout_sec = self._batch_timeout_sec
+        self._batch_timeout_sec = None
+        with self.timeout_sec(timeout_sec):
+            super()._send_batch(calls)
 
     def _receive_reply(self):
         if not self.socket.poll(self._timeout_sec * 1000):
@@ -233,16 +528,175 @@ class ZMQClient(RPCClient):
             except zmq.Again:
                 time.sleep(0.001)
         assert(self.socket.RCVMORE)
-        if reply_type == 'bindata':
-            reply = self.socket.recv(copy=False, track=False).buffer
-        else:
-            reply = self.socket.recv_json()
-        return reply, reply_type == 'error'
+        frames = [self.socket.recv(copy=False, track=False)]
+        while self.socket.RCVMORE:
+            frames.append(self.socket.recv(copy=False, track=False))
+        return _decode_reply(reply_type, frames), reply_type == 'error'
+
+    def send_interrupt(self):
+        """Raise a KeyboardInterrupt exception in the server process"""
+        if self.interrupt_addr is not None:
+            self.interrupt_socket.send(b'interrupt ' + self._client_id)
+
+
+def _set_routing_id(socket):
+    """Give the socket a unique routing ID, and return it in the hex form that
+    the server uses to identify the client in interrupt requests."""
+    routing_id = uuid.uuid4().hex.encode('ascii')
+    socket.ROUTING_ID = routing_id
+    return routing_id.hex().encode('ascii')
+
+def _encode_request(codec, command, args, kwargs):
+    """Return a list of message frames encoding the call."""
+    if codec == 'msgpack':
+        return [b'msgpack'] + binary_codec.pack((command, args, kwargs))
+    return [datafile.json_encode_compact_to_bytes((command, args, kwargs))]
+
+def _decode_reply(reply_type, frames):
+    """Decode the message frames (zmq.Frame objects) that follow the reply type."""
+    if reply_type == 'bindata':
+        return frames[0].buffer
+    elif reply_type == 'multipart':
+        return [frame.buffer for frame in frames]
+    elif reply_type == 'msgpack':
+        return binary_codec.unpack([frame.buffer for frame in frames])
+    else:
+        return zmq.utils.jsonapi.loads(frames[0].bytes)
+
+
+class AsyncZMQClient(RPCClient):
+    _proxy_method_class = '_AsyncProxyMethodClass'
+
+    def __init__(self, rpc_addr, interrupt_addr=None, heartbeat_sec=None, timeout_sec=10, context=None):
+        """RPCClient subclass for use with asyncio, where calls are coroutines.
+
+        Unlike ZMQClient, many calls may be awaited concurrently over a single
+        connection: each request is tagged with an ID and replies are matched
+        up with their requests as they arrive. (Calls are only run concurrently
+        by servers that support it, such as rpc_server.ZMQRouterServer; other
+        servers will simply run them in turn.)
+
+        proxy_namespace() is also a coroutine, and the namespace it returns
+        contains proxy functions that return awaitables. No properties are made
+        from get_ and set_ functions, as attribute access cannot be awaited.
+        Batches are not supported: just await several calls at once instead.
+
+        Parameters:
+            rpc_addr: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
+            interrupt_addr: a string ZeroMQ port identifier for the interrupt server, if any.
+            heartbeat_sec: if not None, interval at which to check that the server is alive.
+            timeout_sec: timeout in seconds for RPC call to fail.
+            context: a zmq.asyncio.Context to share, if one already exists.
+        """
+        self.context = context if context is not None else zmq.asyncio.Context()
+        self.rpc_addr = rpc_addr
+        self.interrupt_addr = interrupt_addr
+        self.heartbeat_sec = heartbeat_sec
+        self._timeout_sec = timeout_sec
+        self._request_ids = itertools.count()
+        self._connect()
+
+    def _connect(self):
+        # a DEALER socket (unlike REQ) can have several outstanding requests
+        self.socket = self.context.socket(zmq.DEALER)
+        self._client_id = _set_routing_id(self.socket)
+        self.socket.LINGER = 0
+        if self.heartbeat_sec is not None:
+            heartbeat_ms = self.heartbeat_sec * 1000
+            self.socket.HEARTBEAT_IVL = heartbeat_ms
+            self.socket.HEARTBEAT_TIMEOUT = heartbeat_ms * 2
+            self.socket.HEARTBEAT_TTL = heartbeat_ms * 2
+        self.socket.connect(self.rpc_addr)
+        self._pending = {} # maps request IDs to futures awaiting the replies
+        self._reader = None
+
+        if self.interrupt_addr is not None:
+            self.interrupt_socket = self.context.socket(zmq.PUSH)
+            self.interrupt_socket.LINGER = 0
+            if self.heartbeat_sec is not None:
+                self.interrupt_socket.HEARTBEAT_IVL = heartbeat_ms
+                self.interrupt_socket.HEARTBEAT_TIMEOUT = heartbeat_ms * 2
+                self.interrupt_socket.HEARTBEAT_TTL = heartbeat_ms * 2
+            self.interrupt_socket.connect(self.interrupt_addr)
+
+    def reconnect(self):
+        """Close and reopen the connection. Any outstanding calls fail."""
+        if self._reader is not None:
+            self._reader.cancel()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(RPCError('Connection to server was reset.'))
+        self.socket.close()
+        if self.interrupt_addr is not None:
+            self.interrupt_socket.close()
+        self._connect()
+
+    async def __call__(self, command, *args, **kwargs):
+        return await self.call(command, args, kwargs)
+
+    async def call(self, command, args=(), kwargs={}, timeout_sec=None):
+        """Call the named command with the given args and kwargs, and return
+        its result. If timeout_sec is None, the client's default timeout is used."""
+        if timeout_sec is None:
+            timeout_sec = self._timeout_sec
+        if self._reader is None:
+            self._reader = asyncio.ensure_future(self._read_replies())
+        request_id = next(self._request_ids).to_bytes(8, 'little')
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            await self.socket.send_multipart([request_id, b''] + _encode_request(self.codec, command, args, kwargs), copy=False)
+            retval, is_error = await asyncio.wait_for(future, timeout_sec)
+        except asyncio.TimeoutError:
+            raise RPCError('Timed out waiting for reply from server (is it running?)')
+        finally:
+            self._pending.pop(request_id, None)
+        if is_error:
+            raise RPCError(retval)
+        return retval
+
+    async def _read_replies(self):
+        while True:
+            request_id, delimiter, reply_type, *frames = await self.socket.recv_multipart(copy=False, track=False)
+            future = self._pending.get(request_id.bytes)
+            if future is None or future.done():
+                # reply to a call that timed out or was cancelled
+                continue
+            reply_type = reply_type.bytes.decode('ascii')
+            try:
+                future.set_result((_decode_reply(reply_type, frames), reply_type == 'error'))
+            except Exception as e:
+                future.set_exception(e)
 
     def send_interrupt(self):
         """Raise a KeyboardInterrupt exception in the server process"""
         if self.interrupt_addr is not None:
-            self.interrupt_socket.send(b'interrupt')
+            # for an asyncio socket, send() returns a future, but PUSH sends do not need to be awaited
+            self.interrupt_socket.send(b'interrupt ' + self._client_id)
+
+    async def proxy_namespace(self, no_property={}, cache_dir=None, lazy=False):
+        """Use the RPC server's __DESCRIBE__ functionality to reconstitute a
+        faxscimile namespace on the client side with well-described proxy
+        functions, which return awaitables.
+
+        A set of the fully-qualified function names available in the namespace
+        is included as the _functions_proxied attribute of this namespace.
+
+        Parameters:
+            no_property: ignored; present for compatibility with RPCClient.
+            cache_dir: if not None, directory in which to cache the server's
+                descriptions; see RPCClient.proxy_namespace().
+            lazy: if True, create sub-namespaces and proxy functions only when
+                first accessed; see RPCClient.proxy_namespace().
+        """
+        cache_file = self._description_cache_file(cache_dir)
+        cached = _load_description_cache(cache_file)
+        known_hash = None if cached is None else cached['hash']
+        description = await self('__DESCRIBE__', codecs=binary_codec.available_codecs(), known_hash=known_hash)
+        return self._namespace_from_description(description, cached, cache_file, no_property, make_properties=False, lazy=lazy)
+
+    def batch(self):
+        raise NotImplementedError('Batches are not supported by AsyncZMQClient.')
 
 
 class _ProxyMethodClass:
@@ -255,13 +709,40 @@ class _ProxyMethodClass:
     def _call_function(self, *args, **kws):
         with self._rpc_client.timeout_sec(self._timeout_sec):
             result = self._rpc_client(self._rpc_function, *args, **kws)
+        if isinstance(result, BatchFuture):
+            return result._add_handler(self._output_handler)
         return self._output_handler(result)
 
 
-def _rich_proxy_function(doc, argspec, name, rpc_client, rpc_function):
+class _AsyncProxyMethodClass(_ProxyMethodClass):
+    async def _call_function(self, *args, **kws):
+        result = await self._rpc_client.call(self._rpc_function, args, kws, timeout_sec=self._timeout_sec)
+        result = self._output_handler(result)
+        if inspect.isawaitable(result):
+            # output handlers for async proxies may be coroutine functions
+            result = await result
+        return result
+
+
+def _rich_proxy_function(code, name, rpc_client, rpc_function, base_class='_ProxyMethodClass'):
+    """Given a proxy class compiled by _compile_proxy_class(), generate a proxy
+    function that looks just like the remote function, but which calls
+    'rpc_function' via 'rpc_client'. The proxy is an instance of a subclass
+    of the named base class."""
+    namespace = {'_ProxyBase': globals()[base_class]} # dict in which exec operates
+    exec(code, globals(), namespace)
+    ProxyClass = namespace[name]
+    ProxyClass.__doc__ = ProxyClass.__call__.__doc__
+    # now pretend that the given class was defined in a module named like the rpc function's namespace
+    ProxyClass.__module__ = rpc_function.rsplit('.', maxsplit=1)[0]
+    return ProxyClass(rpc_client, rpc_function)
+
+def _compile_proxy_class(doc, argspec, name):
     """Using the docstring and argspec from the RPC __DESCRIBE__ command,
-    generate a proxy function that looks just like the remote function, except
-    wraps the function 'to_proxy' that is passed in."""
+    compile the definition of a proxy class whose __call__ method has the same
+    signature and docstring as the remote function. The result is a code
+    object that can be cached (e.g. with marshal) and passed to
+    _rich_proxy_function()."""
     args = argspec['args']
     defaults = argspec['defaults']
     varargs = argspec['varargs']
@@ -298,13 +779,8 @@ def _rich_proxy_function(doc, argspec, name, rpc_client, rpc_function):
     arg_parts = ', '.join(arg_parts)
     call_parts = ', '.join(call_parts)
     class_def = f"""
-        class {name}(_ProxyMethodClass):
+        class {name}(_ProxyBase):
             def __call__(self, {arg_parts}):
                 '''{doc}'''
                 return self._call_function({call_parts})"""
-    namespace = {} # dict in which exec operates
-    exec(class_def.strip(), globals(), namespace)
-    ProxyClass = namespace[name]
-    # now pretend that the given class was defined in a module named like the rpc function's namespace
-    ProxyClass.__module__ = rpc_function.rsplit('.', maxsplit=1)[0]
-    return ProxyClass(rpc_client, rpc_function)
+    return compile(class_def.strip(), '<rpc proxy {}>'.format(name), 'exec')
@@ -8,33 +8,58 @@ import zmq.utils.jsonapi
 import traceback
 import inspect
 import threading
+import queue
+import ctypes
 import os
 import signal
 import contextlib
+import hashlib
+import collections
+import time
 
 from zplib import datafile
 
+from . import binary_codec
+from . import control
+from . import plan
+from . import rpc_stats
 from ..util import logging
 logger = logging.get_logger(__name__)
 
 class BaseRPCServer:
     """Dispatch remote calls to callables specified in a potentially-nested namespace.
+
+    Per-command call and error counts and latency histograms are collected in
+    the 'stats' attribute (an rpc_stats.RPCStats instance), and can be read by
+    clients with the hidden '_rpc_stats' command, which takes an optional
+    'reset' parameter to clear the statistics after reading.
     """
     def __init__(self, namespace):
         self.namespace = namespace
+        self.stats = rpc_stats.RPCStats()
 
     def run(self):
         """Run the RPC server. To quit the server from another thread,
         set the 'running' attribute to False."""
         self.running = True
-        while True:
-            command, args, kwargs = self._receive()
-            logger.debug("Received command: {}\n    args: {}\n    kwargs: {}", command, args, kwargs)
-            self.call(command, args, kwargs)
-
-    def call(self, command, args, kwargs):
-        """Call the named command with *args and **kwargs"""
-        py_command = self.lookup(command)
+        try:
+            while True:
+                command, args, kwargs = self._receive()
+                logger.debug("Received command: {}\n    args: {}\n    kwargs: {}", command, args, kwargs)
+                self.call(command, args, kwargs)
+        except control.Stopped:
+            pass
+
+    def call(self, command, args, kwargs, received=None):
+        """Call the named command with *args and **kwargs. If the call was
+        queued before being run, 'received' is the time.perf_counter() value
+        when it was received, so that the time spent waiting can be recorded."""
+        start = time.perf_counter()
+        queue_wait = None if received is None else start - received
+        if command == '_rpc_stats':
+            py_command = self.stats.summary
+        else:
+            py_command = self.lookup(command)
         if py_command is None:
             self._reply('No such command: {}'.format(command), error=True)
             logger.info('Received unknown command: {}', command)
@@ -43,12 +68,17 @@ class BaseRPCServer:
             response = self.run_command(py_command, args, kwargs)
 
         except (Exception, KeyboardInterrupt) as e:
+            executed = time.perf_counter()
+            error = True
             exception_str = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
             logger.debug('Exception caught: {}', exception_str)
             self._reply(exception_str, error=True)
         else:
+            executed = time.perf_counter()
+            error = False
             logger.debug('Sending response: {}', response)
             self._reply(response)
+        self.stats.record(command, queue_wait, executed - start, time.perf_counter() - executed, error)
 
     def run_command(self, py_command, args, kwargs):
         return py_command(*args, **kwargs)
@@ -71,10 +101,10 @@ class BaseRPCServer:
     def _receive(self):
         """Wait until an RPC call is received from the client, then return the call
         as (command_name, args, kwargs). If self.running goes to False while waiting,
-        raise an error."""
+        raise control.Stopped."""
         raise NotImplementedError()
 
-class ZMQServerMixin:
+class ZMQServerMixin(control.ControlledLoopMixin):
     def __init__(self, address, context=None):
         """Mixin for RPC servers that uses ZeroMQ REQ/REP to communicate with clients.
         Parameters:
@@ -85,41 +115,256 @@ class ZMQServerMixin:
         self.socket = self.context.socket(zmq.REP)
         self.socket.RCVTIMEO = 0
         self.socket.bind(address)
+        self._request_codec = 'json'
+        # setting self.running to False sends a message on this socket to stop the server
+        self._control = control.ControlSocket(self.context)
 
     def run(self):
         try:
             super().run()
         finally:
             self.socket.close()
+            self._control.close()
 
     def _receive(self):
-        while not self.socket.poll(500):
-            # every 500 ms, check if still running while we wait for data
-            if not self.running:
-                raise RuntimeError()
-        json = self.socket.recv()
+        while not self._control.poll(self.socket):
+            pass
+        frames = self.socket.recv_multipart(copy=False)
         try:
-            command, args, kwargs = zmq.utils.jsonapi.loads(json)
+            self._request_codec, (command, args, kwargs) = self._decode_request(frames)
             return command, args, kwargs
         except Exception as e:
-            self._reply('Could not unpack command, arguments, and keyword arguments from JSON message: {}'.format(e), error=True)
+            self._request_codec = 'json'
+            self._reply('Could not unpack command, arguments, and keyword arguments from message: {}'.format(e), error=True)
+
+    @staticmethod
+    def _decode_request(frames):
+        """Return (codec, (command, args, kwargs)) from the frames of a request.
+        Requests are either a single JSON frame, or a b'msgpack' frame followed
+        by frames from binary_codec.pack()."""
+        if len(frames) > 1 and frames[0].bytes == b'msgpack':
+            return 'msgpack', binary_codec.unpack([frame.buffer for frame in frames[1:]])
+        return 'json', zmq.utils.jsonapi.loads(frames[0].bytes)
 
     def _reply(self, reply, error=False):
+        reply_type, parts = self._encode_reply(reply, error, self._request_codec)
+        self.socket.send_string(reply_type, flags=zmq.SNDMORE)
+        self.socket.send_multipart(parts, copy=False)
+
+    @staticmethod
+    def _encode_reply(reply, error=False, codec='json'):
+        """Return (reply_type, reply_parts) for a given reply, where reply_parts
+        is a list of message frames."""
         if error:
             reply_type = 'error'
+        elif isinstance(reply, binary_codec.Multipart):
+            return 'multipart', list(reply)
         elif isinstance(reply, (bytearray, bytes, memoryview)):
             reply_type = 'bindata'
         else:
-            reply_type = 'json'
+            reply_type = codec
 
+        if reply_type == 'msgpack':
+            try:
+                return reply_type, binary_codec.pack(reply)
+            except Exception:
+                reply_type = 'error'
+                reply = 'Could not serialize return value.'
         if reply_type == 'error' or reply_type == 'json':
             try:
                 reply = datafile.json_encode_compact_to_bytes(reply)
             except TypeError:
                 reply_type = 'error'
                 reply = datafile.json_encode_compact_to_bytes('Could not JSON-serialize return value.')
-        self.socket.send_string(reply_type, flags=zmq.SNDMORE)
-        self.socket.send(reply) # TODO: profile to see if copy=False improves performance
+        return reply_type, [reply]
+
+
+class ZMQRouterServerMixin(ZMQServerMixin):
+    def __init__(self, address, context=None):
+        """Mixin for RPC servers that uses a ZeroMQ ROUTER socket to communicate
+        with REQ (or DEALER) clients, and which runs each call in a worker "lane"
+        selected by the top-level component of the command name (e.g. 'stage' for
+        'stage.set_z' or 'camera' for 'camera.autofocus.autofocus'). Calls in
+        different lanes run concurrently; calls within the same lane run in the
+        order received. Top-level functions, special commands like __DESCRIBE__,
+        and unknown names all share a single root lane. A __BATCH__ or __PLAN__
+        runs in the lane of the commands it contains; if these are in several lanes, it runs
+        in one of them while the others are held idle until it is done.
+
+        Parameters:
+            address: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
+            context: a ZeroMQ context to share, if one already exists.
+        """
+        self.context = context if context is not None else zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.RCVTIMEO = 0
+        self.socket.bind(address)
+        # lanes send replies to the main thread over inproc sockets, since the
+        # ROUTER socket may only be used from the thread that runs the server.
+        self._lane_reply_address = 'inproc://rpc-lane-replies-{}'.format(id(self))
+        self._lane_replies = self.context.socket(zmq.PULL)
+        self._lane_replies.bind(self._lane_reply_address)
+        self._lanes = {}
+        self._lane_local = threading.local()
+        self._control = control.ControlSocket(self.context)
+
+    def run(self):
+        self.running = True
+        try:
+            while True:
+                for socket in self._control.poll(self.socket, self._lane_replies):
+                    if socket is self.socket:
+                        self._dispatch(self.socket.recv_multipart(copy=False))
+                    else:
+                        self.socket.send_multipart(self._lane_replies.recv_multipart(copy=False), copy=False)
+        except control.Stopped:
+            pass
+        finally:
+            self._stop_lanes()
+            self._lane_replies.close()
+            self.socket.close()
+            self._control.close()
+
+    def _dispatch(self, frames):
+        """Unpack a message received on the ROUTER socket and queue it on the
+        appropriate lane."""
+        # envelope is the routing identities, up to and including the empty delimiter frame
+        for delimiter, frame in enumerate(frames):
+            if len(frame) == 0:
+                break
+        else:
+            logger.info('Dropping malformed message without envelope delimiter.')
+            return
+        envelope, message = frames[:delimiter+1], frames[delimiter+1:]
+        try:
+            codec, (command, args, kwargs) = self._decode_request(message)
+        except Exception as e:
+            reply_type, parts = self._encode_reply('Could not unpack command, arguments, and keyword arguments from message: {}'.format(e), error=True)
+            self.socket.send_multipart(envelope + [reply_type.encode('ascii')] + parts, copy=False)
+            return
+        logger.debug("Received command: {}\n    args: {}\n    kwargs: {}", command, args, kwargs)
+        key, *held_keys = self._lane_keys(command, args)
+        hold = None
+        if held_keys:
+            # lanes process their queues in the order calls are dispatched, so
+            # calls holding overlapping sets of lanes cannot deadlock
+            hold = _LaneHold(len(held_keys))
+            for held_key in held_keys:
+                self._get_lane(held_key).queue.put(hold)
+        self._get_lane(key).queue.put((envelope, codec, command, args, kwargs, time.perf_counter(), hold))
+
+    def _get_lane(self, key):
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane(self, key)
+        return lane
+
+    def _lane_key(self, command):
+        """Return the name of the lane that should run the given command."""
+        key, sep, rest = command.partition('.')
+        if not sep or key.startswith('_') or not hasattr(self.namespace, key):
+            return ''
+        return key
+
+    def _lane_keys(self, command, args):
+        """Return the names of the lanes that the given command uses: the first
+        is the lane to run it in, and any others must be held while it runs."""
+        if command == '__BATCH__':
+            try:
+                commands = [call[0] for call in args[0]]
+            except Exception:
+                commands = [] # malformed batch: let run_batch() report the error
+        elif command == '__PLAN__':
+            try:
+                commands = list(plan.iter_commands(args[0]))
+            except Exception:
+                commands = [] # malformed plan: let run_plan() report the error
+        else:
+            commands = [command]
+        keys = sorted(set(map(self._lane_key, commands)))
+        return keys if keys else ['']
+
+    def _stop_lanes(self, timeout=5):
+        lanes = list(self._lanes.values())
+        self._lanes.clear()
+        for lane in lanes:
+            lane.queue.put(None)
+        for lane in lanes:
+            if lane.busy:
+                # break the lane out of whatever it's doing so that its socket gets closed
+                _raise_in_thread(lane.ident, SystemExit)
+            lane.join(timeout)
+
+    def client_id(self):
+        # the first envelope frame is the routing ID of the client's socket
+        return self._lane_local.envelope[0].bytes.hex()
+
+    def _reply(self, reply, error=False):
+        local = self._lane_local
+        reply_type, parts = self._encode_reply(reply, error, local.codec)
+        local.socket.send_multipart(local.envelope + [reply_type.encode('ascii')] + parts, copy=False)
+
+
+class _Lane(threading.Thread):
+    """Thread that runs RPC calls for a single top-level namespace in order."""
+    def __init__(self, server, key):
+        super().__init__(name='RPC lane: {}'.format(key if key else 'root'), daemon=True)
+        self.server = server
+        self.queue = queue.Queue()
+        self.busy = False
+        self.start()
+
+    def run(self):
+        local = self.server._lane_local
+        local.socket = self.server.context.socket(zmq.PUSH)
+        local.socket.LINGER = 0
+        local.socket.connect(self.server._lane_reply_address)
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                self.busy = True
+                try:
+                    if isinstance(item, _LaneHold):
+                        item.wait()
+                        continue
+                    local.envelope, local.codec, command, args, kwargs, received, hold = item
+                    try:
+                        if hold is not None:
+                            hold.acquire()
+                        self.server.call(command, args, kwargs, received)
+                    finally:
+                        if hold is not None:
+                            hold.release()
+                except KeyboardInterrupt:
+                    # an interrupt can arrive just after a call has finished: don't let it kill the lane
+                    logger.debug('Interrupt received outside of RPC call in {}', self.name)
+                finally:
+                    self.busy = False
+        finally:
+            local.socket.close()
+
+
+class _LaneHold:
+    """Keeps other lanes idle while a call that uses them runs in one lane."""
+    def __init__(self, held_lanes):
+        self._held_lanes = held_lanes
+        self._arrived = threading.Semaphore(0)
+        self._released = threading.Event()
+
+    def wait(self):
+        """Called from each held lane: block until the call is done."""
+        self._arrived.release()
+        self._released.wait()
+
+    def acquire(self):
+        """Called from the running lane: block until all held lanes are idle."""
+        for _ in range(self._held_lanes):
+            self._arrived.acquire()
+
+    def release(self):
+        self._released.set()
 
 
 class BaseZMQServer(ZMQServerMixin, BaseRPCServer):
@@ -170,26 +415,213 @@ class RPCServer(BaseRPCServer):
             varkw: name of the variable-keyword parameter (usually '**kwarg', but without the asterisks)
             kwonlyargs: list of keyword-only arguments
             kwonlydefaults: dict mapping keyword-only argument names to default values (if any)
+
+    If __DESCRIBE__ is called with a 'codecs' keyword argument (a list of message
+    encodings the client supports, in order of preference), the server picks the
+    first of those it supports and instead returns a dict with keys:
+        codec: name of the encoding the client should use for further calls.
+        hash: a hash of the command descriptions, which changes if and only if
+            the descriptions do.
+        descriptions: the list of command descriptions above, or None if the
+            client also passed a 'known_hash' keyword argument equal to 'hash'
+            (i.e. if the client already has an up-to-date copy).
+    The descriptions are gathered anew for each __DESCRIBE__ call, so that
+    clients see any changes to the namespace (e.g. a device added after the
+    server was created).
+
+    At the same time, a table mapping each command name to its callable is
+    built, so that dispatching a call is a single dict lookup. (Names not in
+    the table, such as those starting with an underscore, are looked up in the
+    namespace and added to the table on first use.) The number of times each
+    command has been called is recorded in the 'call_counts' Counter.
+
+    The special '__BATCH__' command takes a list of (command_name, args, kwargs)
+    triples, and runs each command in order. It returns (results, error), where
+    results is a list of the return values of the commands that ran, and error
+    is None if all commands succeeded, or (index, error_text) for the first
+    command that failed, after which no further commands are run.
+
+    The special '__PLAN__' command takes a list of operations (see the plan
+    module), which may depend on each other's results and be nested inside of
+    in_state() blocks, and runs them in order. It returns (results, error),
+    where results is a dict of the named results of the operations that ran,
+    and error is None if all operations succeeded, or (location, error_text)
+    for the first operation that failed, after which no further operations
+    are run. (The location is the list of indices of the operation in the
+    nested lists of operations.)
+    __PLAN__ may also be given a 'pack' keyword argument, a dict with keys:
+        call: name of a command that returns a binary_codec.Multipart of
+            buffers packed from a dict of results (e.g. the images they name).
+        names: the names of the results to pass to that command.
+        args, kwargs: further arguments for the command (optional).
+    The command is run after the plan (even if it failed), and the plan then
+    returns (results, error, buffers), where buffers is the list it returned
+    (or None if it failed). With the msgpack codec, the buffers are sent as
+    separate message frames, saving the client a call per result to fetch.
+    Similarly, a 'release' keyword argument (a dict with the same keys) names a
+    command that is run with the chosen results after the plan (and after any
+    packing) to free resources they hold, e.g. images that the client will
+    never fetch. Its return value is ignored.
     """
     def __init__(self, namespace, interrupter):
         super().__init__(namespace)
         self.interrupter = interrupter
+        self.call_counts = collections.Counter()
+        # subclasses may run commands from several threads, which all use the dispatch table and call_counts
+        self._lookup_lock = threading.Lock()
+        self._refresh_namespace()
+
+    def _refresh_namespace(self):
+        """Rebuild the command dispatch table, and return the descriptions
+        returned by __DESCRIBE__ and their hash."""
+        descriptions = []
+        dispatch_table = {}
+        self.gather_descriptions(descriptions, self.namespace, dispatch_table=dispatch_table)
+        with self._lookup_lock:
+            self._dispatch_table = dispatch_table
+        return descriptions, hashlib.sha1(datafile.json_encode_compact_to_bytes(descriptions)).hexdigest()
 
-    def call(self, command, args, kwargs):
+    def lookup(self, name):
+        """Look up a command name in the dispatch table, falling back to
+        searching the namespace for names not in the table."""
+        with self._lookup_lock:
+            py_command = self._dispatch_table.get(name)
+            if py_command is None:
+                py_command = super().lookup(name)
+                if py_command is None:
+                    return None
+                self._dispatch_table[name] = py_command
+            self.call_counts[name] += 1
+        return py_command
+
+    def call(self, command, args, kwargs, received=None):
         """Dispatch a command or deal with special keyword commands.
-        Currently, only __DESCRIBE__ is supported.
+        Currently, __DESCRIBE__, __BATCH__, and __PLAN__ are supported.
         """
         if command == '__DESCRIBE__':
-            descriptions = []
-            self.gather_descriptions(descriptions, self.namespace)
-            self._reply(descriptions)
+            descriptions, description_hash = self._refresh_namespace()
+            if 'codecs' in kwargs:
+                available = binary_codec.available_codecs()
+                codec = next((codec for codec in kwargs['codecs'] if codec in available), 'json')
+                if kwargs.get('known_hash') == description_hash:
+                    descriptions = None
+                self._reply(dict(codec=codec, hash=description_hash, descriptions=descriptions))
+            else:
+                self._reply(descriptions)
+        elif command in ('__BATCH__', '__PLAN__'):
+            start = time.perf_counter()
+            if command == '__BATCH__':
+                reply = self.run_batch(*args)
+            else:
+                reply = self.run_plan(*args, **kwargs)
+            error = reply[1]
+            executed = time.perf_counter()
+            self._reply(reply)
+            queue_wait = None if received is None else start - received
+            self.stats.record(command, queue_wait, executed - start, time.perf_counter() - executed, error is not None)
         else:
-            super().call(command, args, kwargs)
+            super().call(command, args, kwargs, received)
+
+    def run_batch(self, calls):
+        """Run a list of (command, args, kwargs) calls in order, stopping at
+        the first error. Return (results, error) as described for __BATCH__."""
+        results = []
+        for i, (command, args, kwargs) in enumerate(calls):
+            py_command = self.lookup(command)
+            if py_command is None:
+                logger.info('Received unknown command in batch: {}', command)
+                return results, (i, 'No such command: {}'.format(command))
+            start = time.perf_counter()
+            try:
+                results.append(self.run_command(py_command, args, kwargs))
+            except (Exception, KeyboardInterrupt) as e:
+                self.stats.record(command, execution=time.perf_counter() - start, error=True)
+                exception_str = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+                logger.debug('Exception caught in batch: {}', exception_str)
+                return results, (i, exception_str)
+            self.stats.record(command, execution=time.perf_counter() - start)
+        return results, None
+
+    def run_plan(self, ops, pack=None, release=None):
+        """Run a list of plan operations, stopping at the first error. Return
+        (results, error), or (results, error, buffers) if 'pack' is given, as
+        described for __PLAN__."""
+        results = {}
+        error = None
+        try:
+            self._run_plan_ops(ops, results, [])
+        except plan.PlanError as e:
+            logger.debug('Error in plan at {}: {}', e.location, e.text)
+            error = e.location, e.text
+        reply = results, error
+        if pack is not None:
+            buffers = self._call_with_plan_results(pack, results, 'pack')
+            if buffers is not None:
+                # msgpack would copy bytes into the reply header: make them out-of-band buffers instead
+                buffers = [memoryview(buffer) if isinstance(buffer, bytes) else buffer for buffer in buffers]
+            reply += (buffers,)
+        if release is not None:
+            self._call_with_plan_results(release, results, 'release')
+        return reply
+
+    def _call_with_plan_results(self, spec, results, purpose):
+        command = spec['call']
+        py_command = self.lookup(command)
+        if py_command is None:
+            logger.info('Received unknown command to {} plan results: {}', purpose, command)
+            return None
+        chosen = {name: results[name] for name in spec['names'] if name in results}
+        start = time.perf_counter()
+        try:
+            retval = self.run_command(py_command, [chosen] + list(spec.get('args', [])), spec.get('kwargs', {}))
+        except (Exception, KeyboardInterrupt):
+            self.stats.record(command, execution=time.perf_counter() - start, error=True)
+            logger.log_exception('Could not {} plan results:'.format(purpose))
+            return None
+        self.stats.record(command, execution=time.perf_counter() - start)
+        return retval
+
+    def _run_plan_ops(self, ops, results, location):
+        for i, op in enumerate(ops):
+            op_location = location + [i]
+            if 'call' in op:
+                command = op['call']
+                py_command = self.lookup(command)
+                if py_command is None:
+                    logger.info('Received unknown command in plan: {}', command)
+                    raise plan.PlanError(op_location, 'No such command: {}'.format(command))
+                args = plan.resolve_refs(op.get('args', []), results, op_location)
+                kwargs = plan.resolve_refs(op.get('kwargs', {}), results, op_location)
+                start = time.perf_counter()
+                try:
+                    result = self.run_command(py_command, args, kwargs)
+                except (Exception, KeyboardInterrupt) as e:
+                    self.stats.record(command, execution=time.perf_counter() - start, error=True)
+                    raise plan.PlanError(op_location, ''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+                self.stats.record(command, execution=time.perf_counter() - start)
+                if 'name' in op:
+                    results[op['name']] = result
+            elif 'in_state' in op:
+                namespace = op['in_state']
+                in_state = self.lookup(namespace + '.in_state' if namespace else 'in_state')
+                if in_state is None:
+                    raise plan.PlanError(op_location, 'No in_state() function for namespace: "{}"'.format(namespace))
+                state = plan.resolve_refs(op.get('state', {}), results, op_location)
+                try:
+                    with in_state(**state):
+                        self._run_plan_ops(op['ops'], results, op_location)
+                except plan.PlanError:
+                    raise
+                except (Exception, KeyboardInterrupt) as e:
+                    raise plan.PlanError(op_location, ''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+            else:
+                raise plan.PlanError(op_location, 'Unknown plan operation: {}'.format(op))
 
     @staticmethod
-    def gather_descriptions(descriptions, namespace, prefix=''):
+    def gather_descriptions(descriptions, namespace, prefix='', dispatch_table=None):
         """Recurse through a namespace, adding descriptions of callable objects encountered
-        to the 'descriptions' list."""
+        to the 'descriptions' list. If dispatch_table is not None, the callables
+        are also added to that dict, keyed by their fully-qualified names."""
         for k in dir(namespace):
             if k.startswith('_'):
                 continue
@@ -220,17 +652,24 @@ class RPCServer(BaseRPCServer):
                 argdict['kwonlyargs'] = argspec.kwonlyargs
                 argdict['kwonlydefaults'] = argspec.kwonlydefaults if argspec.kwonlydefaults else {}
                 descriptions.append((prefixed_name, doc, argdict))
+                if dispatch_table is not None:
+                    dispatch_table[prefixed_name] = v
             else:
                 try:
                     subnamespace = v
                 except AttributeError:
                     continue
-                RPCServer.gather_descriptions(descriptions, subnamespace, prefixed_name)
+                RPCServer.gather_descriptions(descriptions, subnamespace, prefixed_name, dispatch_table)
 
     def run_command(self, py_command, args, kwargs):
-            with self.interrupter.armed():
+            with self.interrupter.armed(self.client_id()):
                 return py_command(*args, **kwargs)
 
+    def client_id(self):
+        """Return the ID of the client whose call is running, as sent along
+        with its interrupt requests, or None if clients cannot be told apart."""
+        return None
+
 
 class ZMQServer(ZMQServerMixin, RPCServer):
     def __init__(self, namespace, interrupter, address, context=None):
@@ -244,38 +683,91 @@ class ZMQServer(ZMQServerMixin, RPCServer):
         RPCServer.__init__(self, namespace, interrupter)
         ZMQServerMixin.__init__(self, address, context)
 
+class ZMQRouterServer(ZMQRouterServerMixin, RPCServer):
+    def __init__(self, namespace, interrupter, address, context=None):
+        """RPCServer subclass that uses a ZeroMQ ROUTER socket to communicate with
+        clients, running calls on different top-level namespaces concurrently.
+        Parameters:
+            namespace: contains a hierarchy of callable objects to expose to clients.
+            interrupter: Interrupter instance for simulating control-c on server
+            address: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
+            context: a ZeroMQ context to share, if one already exists.
+        """
+        RPCServer.__init__(self, namespace, interrupter)
+        ZMQRouterServerMixin.__init__(self, address, context)
+
+def _raise_in_thread(thread_id, exception_class):
+    """Asynchronously raise an exception in the thread with the given ident.
+    The exception is raised the next time that thread executes Python code, so
+    unlike a SIGINT delivered to the main thread, it cannot break a blocking C
+    call (e.g. time.sleep() or a serial port read): it takes effect only once
+    that call returns."""
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), ctypes.py_object(exception_class))
+
 class Interrupter(threading.Thread):
     """Interrupter runs in a background thread and creates KeyboardInterrupt
-    events in the main thread when requested to do so."""
+    events in the threads running armed RPC calls when requested to do so.
+
+    An interrupt message is either 'interrupt', which interrupts all armed
+    calls, or 'interrupt <client_id>', which interrupts only the calls made by
+    that client (and any calls whose client is not known).
+
+    Calls running in the main thread are interrupted with a real SIGINT, which
+    also breaks out of blocking system calls. Calls in other threads (e.g. the
+    lanes of a ZMQRouterServer) are interrupted with _raise_in_thread(), which
+    cannot break out of blocking C calls such as time.sleep() or serial reads.
+    """
     def __init__(self):
         super().__init__(name='InterruptServer', daemon=True)
-        self._armed = False
+        self._armed_threads = {} # thread IDs to the IDs of the clients whose calls they are running
+        self._lock = threading.Lock()
         self.start()
 
     @contextlib.contextmanager
-    def armed(self):
-        self._armed = True
+    def armed(self, client_id=None):
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._armed_threads[thread_id] = client_id
         try:
             yield
         finally:
-            self._armed = False
+            with self._lock:
+                # the entry is already gone if this thread was interrupted
+                self._armed_threads.pop(thread_id, None)
 
     def run(self):
         self.running = True
-        while True:
-            message = self._receive()
-            logger.debug('Interrupt received: {}, armed={}', message, self._armed)
-            if message == 'interrupt' and self._armed:
-                os.kill(os.getpid(), signal.SIGINT)
+        try:
+            while True:
+                message = self._receive()
+                with self._lock:
+                    logger.debug('Interrupt received: {}, armed threads={}', message, len(self._armed_threads))
+                    command, sep, client_id = message.partition(' ')
+                    if command == 'interrupt':
+                        for thread_id, armed_client_id in list(self._armed_threads.items()):
+                            if sep and armed_client_id is not None and armed_client_id != client_id:
+                                continue
+                            # disarm the thread first: the exception might arrive while
+                            # armed() is exiting, and keep it from removing the entry itself
+                            del self._armed_threads[thread_id]
+                            if thread_id == threading.main_thread().ident:
+                                # use a real signal for the main thread, which also interrupts blocking system calls
+                                os.kill(os.getpid(), signal.SIGINT)
+                            else:
+                                _raise_in_thread(thread_id, KeyboardInterrupt)
+        except control.Stopped:
+            pass
 
     def stop(self):
         self.running = False
         self.join()
 
     def _receive(self):
+        """Wait for and return a message from a client. If self.running goes to
+        False while waiting, raise control.Stopped."""
         raise NotImplementedError()
 
-class ZMQInterrupter(Interrupter):
+class ZMQInterrupter(control.ControlledLoopMixin, Interrupter):
     def __init__(self, address, context=None):
         """InterruptServer subclass that uses ZeroMQ PUSH/PULL to communicate with clients.
         Parameters:
@@ -286,6 +778,7 @@ class ZMQInterrupter(Interrupter):
         self.socket = self.context.socket(zmq.PULL)
         self.socket.RCVTIMEO = 0
         self.socket.bind(address)
+        self._control = control.ControlSocket(self.context)
         super().__init__()
 
     def run(self):
@@ -293,11 +786,10 @@ class ZMQInterrupter(Interrupter):
             super().run()
         finally:
             self.socket.close()
+            self._control.close()
 
     def _receive(self):
-        while not self.socket.poll(500):
-            # every 500 ms, check if still running while we wait for data
-            if not self.running:
-                raise RuntimeError()
+        while not self._control.poll(self.socket):
+            pass
         return str(self.socket.recv(), encoding='ascii')
 
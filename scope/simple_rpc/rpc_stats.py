@@ -0,0 +1,134 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Latency and throughput statistics for RPC servers.
+
+RPCStats records, for each command, the number of calls and errors, and
+histograms of the time each call spent waiting to be run (queue wait), running
+(execution), and encoding and sending its reply (serialization).
+
+The histograms are in the style of HdrHistogram: values are recorded in
+integer microseconds into buckets whose width grows with the magnitude of the
+value, such that any recorded value can be recovered to within a fixed relative
+precision (here, better than 1%), no matter whether it is a few microseconds
+or many minutes. This keeps recording fast and memory use small.
+"""
+
+import threading
+import time
+
+class LatencyHistogram:
+    _SUB_BUCKET_BITS = 7 # 2**7 = 128 sub-buckets per power of two
+    _HALF_COUNT = 2**(_SUB_BUCKET_BITS - 1)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = {} # sparse mapping of bucket index to count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        """Record a duration, given in seconds."""
+        value = max(0, int(seconds * 1e6))
+        magnitude = max(0, value.bit_length() - self._SUB_BUCKET_BITS)
+        index = magnitude * self._HALF_COUNT + (value >> magnitude)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def _bucket_value(self, index):
+        """Return the midpoint of the range of values in the given bucket."""
+        if index < 2 * self._HALF_COUNT:
+            return index
+        magnitude = index // self._HALF_COUNT - 1
+        sub_bucket = index - magnitude * self._HALF_COUNT
+        return (sub_bucket << magnitude) + (1 << magnitude) // 2
+
+    def percentile(self, percent):
+        """Return the value (in microseconds) below which the given percent of
+        recorded values fall, or None if no values were recorded."""
+        if self.count == 0:
+            return None
+        target = max(1, percent / 100 * self.count)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        """Return a dict of summary statistics, in milliseconds."""
+        if self.count == 0:
+            return dict(count=0)
+        ms = lambda us: us / 1000
+        return dict(count=self.count, mean=ms(self.total / self.count), min=ms(self.min), max=ms(self.max),
+            p50=ms(self.percentile(50)), p90=ms(self.percentile(90)), p99=ms(self.percentile(99)),
+            p999=ms(self.percentile(99.9)))
+
+
+class _CommandStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.queue_wait = LatencyHistogram()
+        self.execution = LatencyHistogram()
+        self.serialization = LatencyHistogram()
+
+    def summary(self):
+        return dict(calls=self.calls, errors=self.errors, queue_wait=self.queue_wait.summary(),
+            execution=self.execution.summary(), serialization=self.serialization.summary())
+
+
+class RPCStats:
+    def __init__(self):
+        """Thread-safe collection of per-command RPC statistics."""
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._commands = {}
+            self._start_time = time.time()
+
+    def record(self, command, queue_wait=None, execution=None, serialization=None, error=False):
+        """Record a call to the named command.
+        Parameters:
+            command: name of the command called.
+            queue_wait, execution, serialization: durations in seconds of each
+                phase of the call, or None if not measured.
+            error: True if the call raised an exception.
+        """
+        with self._lock:
+            stats = self._commands.get(command)
+            if stats is None:
+                stats = self._commands[command] = _CommandStats()
+            stats.calls += 1
+            if error:
+                stats.errors += 1
+            if queue_wait is not None:
+                stats.queue_wait.record(queue_wait)
+            if execution is not None:
+                stats.execution.record(execution)
+            if serialization is not None:
+                stats.serialization.record(serialization)
+
+    def summary(self, reset=False):
+        """Return a dict describing the statistics collected since the server
+        started (or since the last reset), suitable for JSON encoding. Times are
+        in milliseconds. If reset is True, clear the statistics afterward."""
+        with self._lock:
+            now = time.time()
+            summary = dict(start_time=self._start_time, end_time=now,
+                commands={command: stats.summary() for command, stats in sorted(self._commands.items())})
+            if reset:
+                self._commands = {}
+                self._start_time = now
+        return summary
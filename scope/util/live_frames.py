@@ -0,0 +1,298 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Push live camera frames to remote viewers over ZeroMQ PUB/SUB.
+
+Without this, each viewer waits for a 'scope.camera.frame_number' property
+update, asks the server for the latest image, and then fetches (and has the
+server compress) the image data itself. A LiveFrameServer instead packs each
+new frame once for each "profile" (compressor, downsampling, and compressor
+arguments) that any client has subscribed to, and publishes it to all the
+clients that want that profile.
+
+The subscription topic is the JSON-encoded profile (see profile_topic()). The
+server uses an XPUB socket to find out which profiles have subscribers, so it
+never packs frames that nobody will receive. Each message consists of:
+    topic: the profile.
+    info: JSON-encoded [frame_number, timestamp].
+    the array description and data, as from transfer_ism_buffer._pack_array().
+
+Only the newest frame matters for live viewing, so frames are dropped rather
+than queued: the server packs only the latest frame when it is ready for
+another, the PUB socket drops messages for subscribers that have fallen more
+than a couple of frames behind, and the client keeps only the newest frame
+received.
+
+Profiles with delta encoding (for compressed frames) send each frame as the
+difference from the last full frame (a "keyframe"; see
+transfer_ism_buffer._KeyframeDelta), rather than from the previous frame, so
+that dropped frames do not matter. A keyframe is sent whenever a client
+subscribes, and periodically after that. A client that has missed the keyframe
+skips frames until the next one.
+"""
+
+import json
+import threading
+
+import numpy
+import zmq
+
+from ..simple_rpc import control
+from . import transfer_ism_buffer
+from . import logging
+
+logger = logging.get_logger(__name__)
+
+_HWM = 2 # maximum number of frames queued in ZeroMQ for each subscriber
+
+def profile_topic(compressor, downsample=None, blocked=True, bit_depth=None, delta=False, **compressor_args):
+    """Return the subscription topic for live frames packed with the given
+    compression options (see transfer_ism_buffer._NetworkGetData.set_network_compression(),
+    and transfer_ism_buffer._pack_array() for bit_depth)."""
+    profile = dict(compressor=compressor, downsample=downsample, blocked=blocked, bit_depth=bit_depth, args=compressor_args)
+    if delta:
+        profile['delta'] = True # leave out otherwise, so that topics are the same as from older clients
+    return json.dumps(profile, sort_keys=True).encode('ascii')
+
+class LiveFrameServer(control.ControlledLoopMixin, threading.Thread):
+    def __init__(self, addr, property_server, latest_image, context=None, frame_property='scope.camera.frame_number'):
+        """Publish each new camera frame to subscribed LiveFrameClients, from a
+        background thread.
+
+        Parameters:
+            addr: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
+            property_server: PropertyServer that publishes the frame number.
+            latest_image: function returning the (ISM_Buffer name, timestamp,
+                frame number) of the latest frame, with the frame registered
+                for transfer (e.g. camera.latest_image).
+            context: a ZeroMQ context to share, if one already exists.
+            frame_property: name of the property that is updated for each new frame.
+        """
+        self.context = context if context is not None else zmq.Context()
+        self.latest_image = latest_image
+        self.frame_property = frame_property
+        self.socket = self.context.socket(zmq.XPUB)
+        self.socket.XPUB_VERBOSE = True # pass on every subscription, so that each new client gets a keyframe
+        self.socket.SNDHWM = _HWM
+        self.socket.LINGER = 0
+        self.socket.bind(addr)
+        self._control = control.ControlSocket(self.context, self._handle_control_message)
+        self._profiles = {} # topics to profile dicts
+        self._frame_pending = False
+        property_server.add_listener(self._property_updated)
+        super().__init__(name='live frame server', daemon=True)
+        self.start()
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def _property_updated(self, property_name, value, sequence):
+        # called in the property server's thread: only wake up the publishing thread once per frame it publishes
+        if property_name == self.frame_property and value != -1 and self._profiles and not self._frame_pending:
+            self._frame_pending = True
+            self._control.send('frame')
+
+    def _handle_control_message(self, message):
+        pass # the only message is 'frame', which just wakes up the loop in run()
+
+    def run(self):
+        self.running = True
+        try:
+            while True:
+                if self._control.poll(self.socket):
+                    self._handle_subscription(self.socket.recv())
+                if self._frame_pending:
+                    self._frame_pending = False
+                    try:
+                        self._publish_latest()
+                    except Exception:
+                        logger.log_exception('Could not publish live frame:')
+        except control.Stopped:
+            pass
+        finally:
+            self.socket.close()
+            self._control.close()
+
+    def _handle_subscription(self, message):
+        # XPUB passes on every subscription and the last unsubscription to each topic
+        subscribe, topic = message[:1] == b'\x01', message[1:]
+        if not subscribe:
+            self._profiles.pop(topic, None)
+            return
+        profile = self._profiles.get(topic)
+        if profile is not None:
+            # another client for an existing profile
+            if profile['delta'] is not None:
+                profile['delta'].keyframe_due = True
+            return
+        try:
+            profile = json.loads(topic.decode('ascii'))
+            if profile['compressor'] not in (None, 'zlib', 'blosc'):
+                raise ValueError('un-recognized compressor')
+            delta = transfer_ism_buffer._KeyframeDelta() if profile.get('delta') else None
+            profile = dict(compressor=profile['compressor'], downsample=profile['downsample'],
+                blocked=profile['blocked'], bit_depth=profile.get('bit_depth'), delta=delta,
+                compressor_args=dict(profile['args']))
+        except Exception:
+            logger.warning('Ignoring live-frame subscription with invalid profile {!r}', topic)
+            return
+        self._profiles[topic] = profile
+
+    def _publish_latest(self):
+        if not self._profiles:
+            return
+        name, timestamp, frame_number = self.latest_image()
+        info = json.dumps([frame_number, timestamp]).encode('ascii')
+        messages = []
+        # pack the frame once for each profile, before releasing it: a pooled frame could be overwritten once released
+        array = transfer_ism_buffer.borrow_array(name)
+        try:
+            for topic, profile in self._profiles.items():
+                descr, *data = transfer_ism_buffer._pack_array(array, profile['compressor'], profile['downsample'],
+                    profile['compressor_args'], profile['blocked'], profile['delta'], profile['bit_depth'])
+                if numpy.may_share_memory(data[0], array):
+                    data = [data[0].copy()] # uncompressed data would be sent after the frame is released
+                messages.append([topic, info, descr] + data)
+        finally:
+            transfer_ism_buffer.release_array(name)
+        for message in messages:
+            self.socket.send_multipart(message, copy=False)
+
+
+class LiveFrameClient(control.ControlledLoopMixin, threading.Thread):
+    def __init__(self, addr, frame_callback=None, heartbeat_sec=None, context=None, daemon=True):
+        """Receive frames published by a LiveFrameServer in a background thread.
+
+        Only the newest frame received (and, in delta mode, the newest
+        keyframe) is kept, and it is only unpacked when retrieved with
+        get_frame(). Call set_profile() to choose how frames are compressed; no
+        frames are received until then.
+
+        Parameters:
+            addr: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
+            frame_callback: function to call (with no arguments) in the background
+                thread when a frame arrives. It should not do anything slow.
+            heartbeat_sec: if not None, interval for ZeroMQ connection heartbeats.
+            context: a ZeroMQ context to share, if one already exists.
+            daemon: exit the client when the foreground thread exits.
+        """
+        self.context = context if context is not None else zmq.Context()
+        self.addr = addr
+        self.frame_callback = frame_callback
+        self.heartbeat_sec = heartbeat_sec
+        self.connected = threading.Event()
+        self._control = control.ControlSocket(self.context, self._handle_control_message)
+        self._topic = None # topic to subscribe to
+        self._subscribed = None # topic that the socket is subscribed to
+        self._latest = None
+        self._keyframe = None # newest keyframe not yet retrieved, in delta mode
+        self._reference = None # last keyframe unpacked, in delta mode
+        self._reference_id = None
+        self._lock = threading.Lock()
+        super().__init__(name='live frame client', daemon=daemon)
+        self.start()
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def set_profile(self, compressor, downsample=None, blocked=True, bit_depth=None, delta=False, **compressor_args):
+        """Set the compression options for the frames to receive (see profile_topic())."""
+        topic = profile_topic(compressor, downsample, blocked, bit_depth, delta, **compressor_args)
+        if topic != self._topic:
+            self._topic = topic
+            self._control.send('subscribe')
+
+    def get_frame(self):
+        """Return the newest frame received since the last call, as (image,
+        timestamp, frame_number), or None if no frame has been received (or,
+        in delta mode, if the keyframe it depends on was not received)."""
+        with self._lock:
+            frames, self._latest = self._latest, None
+            keyframe, self._keyframe = self._keyframe, None
+        if frames is None:
+            return None
+        if keyframe is not None and keyframe is not frames:
+            self._unpack(keyframe)
+        image = self._unpack(frames)
+        if image is None:
+            return None
+        frame_number, timestamp = json.loads(frames[1].bytes.decode('ascii'))
+        return image, timestamp, frame_number
+
+    def _unpack(self, frames):
+        topic, info, *parts = frames
+        compressor = json.loads(topic.bytes.decode('ascii'))['compressor']
+        image, extra = transfer_ism_buffer._decode_parts([part.buffer for part in parts], compressor)
+        delta = extra.get('delta')
+        if delta is None:
+            return image
+        if delta['base'] is None:
+            # keep a copy: the caller may modify the returned image
+            self._reference = image.copy(order='K')
+            self._reference_id = topic.bytes, delta['frame_id']
+            return image
+        if self._reference_id != (topic.bytes, delta['base']):
+            return None # wait for the next keyframe
+        return transfer_ism_buffer._undo_zigzag_difference(image, self._reference)
+
+    def run(self):
+        self._connect()
+        self.running = True
+        try:
+            while True:
+                if not self._control.poll(self.socket):
+                    continue
+                frames = keyframe = None
+                while self.socket.poll(0): # only keep the newest frame (and keyframe)
+                    received = self.socket.recv_multipart(copy=False)
+                    if received[0].bytes != self._subscribed:
+                        continue # from a profile we have since unsubscribed from
+                    frames = received
+                    if _is_keyframe(frames):
+                        keyframe = frames
+                if frames is None:
+                    continue
+                with self._lock:
+                    self._latest = frames
+                    if keyframe is not None:
+                        self._keyframe = keyframe
+                if self.frame_callback is not None:
+                    self.frame_callback()
+        except control.Stopped:
+            pass
+        finally:
+            self.socket.close()
+            self._control.close()
+
+    def _handle_control_message(self, message):
+        if message == 'subscribe':
+            self._subscribe()
+
+    def _connect(self):
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.RCVHWM = _HWM
+        self.socket.LINGER = 0
+        if self.heartbeat_sec is not None:
+            heartbeat_ms = self.heartbeat_sec * 1000
+            self.socket.HEARTBEAT_IVL = heartbeat_ms
+            self.socket.HEARTBEAT_TIMEOUT = heartbeat_ms * 2
+            self.socket.HEARTBEAT_TTL = heartbeat_ms * 2
+        self.socket.connect(self.addr)
+        self._subscribe()
+        self.connected.set()
+
+    def _subscribe(self):
+        topic = self._topic
+        if topic == self._subscribed:
+            return
+        if self._subscribed is not None:
+            self.socket.unsubscribe(self._subscribed)
+        if topic is not None:
+            self.socket.subscribe(topic)
+        self._subscribed = topic
+
+def _is_keyframe(frames):
+    """Return whether a live-frame message is a keyframe in delta mode."""
+    descr = json.loads(frames[2].bytes.decode('ascii'))
+    return len(descr) > 3 and descr[3].get('delta', {}).get('base', 0) is None
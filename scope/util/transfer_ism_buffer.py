@@ -7,11 +7,32 @@ import zlib
 import platform
 import collections
 import threading
+import weakref
+import os
+import concurrent.futures
+import uuid
+import asyncio
 
 import ism_buffer
 
+from ..simple_rpc import binary_codec
+
 _ism_buffer_registry = collections.defaultdict(list)
 _registry_lock = threading.Lock()
+_packed_cache = {} # names of arrays with further transfers pending to {packing options: packed buffers}
+_frame_pools = weakref.WeakValueDictionary() # pool names to FramePool instances
+_BLOCK_BYTES = 2**20 # approximate uncompressed size of blocks for blocked compression
+_executor = None # thread pool for blocked compression, created when first needed
+_executor_lock = threading.Lock()
+_delta_sessions = collections.OrderedDict() # client session ids to _DeltaSession instances, least recently used first
+_delta_lock = threading.Lock()
+_MAX_DELTA_SESSIONS = 8 # each session keeps a copy of the last frame sent
+_KEYFRAME_INTERVAL = 30 # send a full frame at least this often in delta mode
+
+class StaleFrameError(KeyError):
+    """Raised when trying to lease a pooled frame whose slot has already been
+    reused for a newer frame."""
+    pass
 
 def create_array(name, shape, dtype, order):
     """Create a numpy array view onto an ISM_Buffer shared memory region
@@ -25,12 +46,101 @@ def create_array(name, shape, dtype, order):
     """
     return ism_buffer.new(name, shape, dtype, order).asarray()
 
+class FramePool:
+    def __init__(self, name, shape, dtype, order, size):
+        """A fixed number of reusable ISM_Buffer-backed arrays ("slots") for
+        a stream of frames, to avoid creating and mapping a new shared memory
+        region for each frame.
+
+        Each frame acquired from the pool has a name of the form
+        '{pool name}-{slot}#{generation}', where the generation counts the
+        number of times the slot has been used. A slot is only reused once all
+        leases on its frame have been released: the code that acquired the
+        frame holds one lease, which it must give up with release_frame(), and
+        register_array_for_transfer() and release_array() take and give up
+        further leases, so a frame cannot be overwritten while it is waiting
+        to be transferred or in use by a client on the same machine.
+
+        Parameters:
+            name: unique name for the pool (must not contain '#').
+            shape, dtype, order: as for create_array().
+            size: number of slots.
+        """
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.order = order
+        self.size = size
+        self._arrays = [None] * size
+        self._generations = [0] * size
+        self._leases = [0] * size
+        self._next_slot = 0
+        self._lock = threading.Lock()
+        _frame_pools[name] = self
+
+    def acquire(self):
+        """Return (name, array) for the next free slot, leased to the caller,
+        or None if all slots are leased."""
+        with self._lock:
+            for i in range(self.size):
+                slot = (self._next_slot + i) % self.size
+                if self._leases[slot] == 0:
+                    break
+            else:
+                return None
+            self._next_slot = (slot + 1) % self.size
+            self._generations[slot] += 1
+            self._leases[slot] = 1
+            array = self._arrays[slot]
+            if array is None:
+                array = self._arrays[slot] = create_array(self._slot_name(slot), self.shape, self.dtype, self.order)
+            return '{}#{}'.format(self._slot_name(slot), self._generations[slot]), array
+
+    def _slot_name(self, slot):
+        return '{}-{}'.format(self.name, slot)
+
+    def lease(self, slot, generation):
+        with self._lock:
+            if self._generations[slot] != generation or self._leases[slot] == 0:
+                raise StaleFrameError('Frame {} of slot {} in pool "{}" is no longer available.'.format(generation, slot, self.name))
+            self._leases[slot] += 1
+
+    def release(self, slot, generation):
+        with self._lock:
+            if self._generations[slot] == generation and self._leases[slot] > 0:
+                self._leases[slot] -= 1
+
+def _parse_frame_name(name):
+    """Return (pool, slot, generation) for the name of a frame from a
+    FramePool, or None if the name does not refer to a pooled frame (or its
+    pool no longer exists)."""
+    if '#' not in name:
+        return None
+    slot_name, generation = name.rsplit('#', 1)
+    pool_name, slot = slot_name.rsplit('-', 1)
+    pool = _frame_pools.get(pool_name)
+    if pool is None:
+        return None
+    return pool, int(slot), int(generation)
+
+def release_frame(name):
+    """Release the lease on a pooled frame held by the code that acquired it
+    with FramePool.acquire(). Does nothing for arrays not from a FramePool."""
+    frame = _parse_frame_name(name)
+    if frame is not None:
+        pool, slot, generation = frame
+        pool.release(slot, generation)
+
 def register_array_for_transfer(name, array):
     """Register a named, ISM_Buffer-backed array with the server that is going
     to be transfered to another process. Once the other process obtains the
     ISM_Buffer, it must call the appropriate get_data() function (provided by
     client_get_data_getter()), which will ensure that the _release_array()
-    function gets called."""
+    function gets called.
+
+    If the array is a pooled frame (from FramePool.acquire()), this leases the
+    frame until it is released, or raises StaleFrameError if the frame's slot
+    has already been reused."""
     # A single image can get queued for transfer several times (i.e. if several
     # clients all want to grab the same live image). Appending it to a list
     # makes sure we can track the count of outgoing requests, so we don't free
@@ -39,6 +149,10 @@ def register_array_for_transfer(name, array):
     # via camera.latest_image running on the main thread and the image transfer
     # thread; or this function and _release_array might get called simultaneously.
     # Thus we protect mutating access to the registry.
+    frame = _parse_frame_name(name)
+    if frame is not None:
+        pool, slot, generation = frame
+        pool.lease(slot, generation)
     with _registry_lock:
         # the below is sufficiently atomic that simultaneous calls to this function
         # won't cause a problem (the default will only get created once),
@@ -49,7 +163,11 @@ def register_array_for_transfer(name, array):
 def release_array(name):
     """Remove the named, ISM_Buffer-backed array from the transfer registry,
     allowing it to be deallocated if nobody else on the server process is
-    retaining any references. Return the named array."""
+    retaining any references. Return the named array.
+
+    Note that if the array is a pooled frame (from FramePool.acquire()), its
+    contents may be overwritten by a new frame once it is released, so use
+    borrow_array() and then release_array() once done with the data."""
     arrays = _ism_buffer_registry[name]
     array = arrays.pop()
     with _registry_lock:
@@ -58,6 +176,8 @@ def release_array(name):
         # this section only.
         if not arrays:
             del _ism_buffer_registry[name]
+            _packed_cache.pop(name, None)
+    release_frame(name)
     return array
 
 def borrow_array(name):
@@ -72,7 +192,7 @@ def _server_release_array(name):
     is safe to call over RPC (which does not know how to send numpy arrays)."""
     release_array(name)
 
-def _server_pack_data(name, compressor='blosc', downsample=None, **compressor_args):
+def _server_pack_data(name, compressor='blosc', downsample=None, bit_depth=None, **compressor_args):
     """Pack the data in the named ISM_Buffer into bytes for transfer over
     the network (or other serialization).
     Downsample parameter: int / None. If not None, only return every nth pixel.
@@ -80,9 +200,142 @@ def _server_pack_data(name, compressor='blosc', downsample=None, **compressor_ar
       - None: pack raw image bytes
       - 'blosc': use the fast, modern BLOSC compression library
       - 'zlib': use older, more widely supported zlib compression
-    compressor_args are passed to zlib.compress() or blosc.compress() directly."""
+    bit_depth: int / None. If 12 or less, 16-bit data are sent packed into 12
+      bits per pixel (if all values fit), before any compression.
+    compressor_args are passed to zlib.compress() or blosc.compress() directly.
+
+    _server_pack_data_multipart() is more efficient for RPC transfers."""
+    descr, data = _pack_registered_array(name, compressor, downsample, compressor_args, bit_depth=bit_depth)
+    # put the len of the descr in a 2-byte uint16
+    return b''.join([struct.pack('<H', len(descr)), descr, data])
+
+def _server_pack_data_multipart(name, compressor='blosc', downsample=None, blocked=False, session=None, bit_depth=None,
+        **compressor_args):
+    """Pack the data in the named ISM_Buffer for transfer over RPC, as with
+    _server_pack_data(), but return a binary_codec.Multipart reply containing
+    the array description and the (possibly compressed) data as separate
+    buffers, which the RPC server sends without further copying. (If the data
+    are not compressed or downsampled, the array itself is sent.)
+    If blocked is True, zlib-compressed data are split into blocks which are
+    compressed (and can be decompressed) in parallel. (blosc compression is
+    always multithreaded.)
+    If session is not None, it must be a (session_id, frame_id) pair, as
+    sent by a client in delta mode (see _NetworkGetData), and compressed data
+    may be sent as the difference from the last frame sent to that session.
+    Unpack with _client_unpack_parts(), or _decode_parts() in delta mode."""
+    return binary_codec.Multipart(_pack_registered_array(name, compressor, downsample, compressor_args, blocked, session,
+        bit_depth))
+
+def _server_pack_many(names, compressor='blosc', downsample=None, blocked=False, bit_depth=None, **compressor_args):
+    """Pack the data in each of the named ISM_Buffers, as with
+    _server_pack_data_multipart(), and return them all in a single
+    binary_codec.Multipart reply, to save a round-trip per array. The first
+    buffer is a JSON list of the number of buffers for each array, which follow
+    in order. Each array is released from the transfer registry as soon as it
+    has been packed (or has failed to pack).
+    zlib-compressed arrays are compressed in parallel, one per thread, so
+    blocked applies only when a single array is requested. (blosc compression
+    is always multithreaded.)
+    Unpack with _client_unpack_many()."""
+    parallel = compressor == 'zlib' and len(names) > 1
+    def pack(name):
+        try:
+            return _pack_registered_array(name, compressor, downsample, compressor_args, blocked and not parallel,
+                bit_depth=bit_depth)
+        except Exception as e:
+            return e # release the remaining arrays before raising
+    packed = list(_get_executor().map(pack, names)) if parallel else [pack(name) for name in names]
+    for parts in packed:
+        if isinstance(parts, Exception):
+            raise parts
+    counts = json.dumps([len(parts) for parts in packed]).encode('ascii')
+    return binary_codec.Multipart([counts] + [part for parts in packed for part in parts])
+
+def _registered_names(results):
+    """Return a list of the names of arrays registered for transfer that appear
+    (at any level of nesting) in the given results."""
+    names = []
+    def find_names(value):
+        if isinstance(value, str):
+            if value in _ism_buffer_registry and value not in names:
+                names.append(value)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                find_names(item)
+        elif isinstance(value, dict):
+            for item in value.values():
+                find_names(item)
+    find_names(results)
+    return names
+
+def _server_pack_results(results, compressor='blosc', downsample=None, blocked=False, bit_depth=None, **compressor_args):
+    """Pack each array registered for transfer whose name appears (at any
+    level of nesting) in the given dict of results, e.g. the images acquired by
+    a plan. Return a binary_codec.Multipart whose first buffer is a JSON list
+    of the names, followed by the buffers from _server_pack_many().
+    Unpack with _client_unpack_results()."""
+    names = _registered_names(results)
+    packed = _server_pack_many(names, compressor, downsample, blocked, bit_depth, **compressor_args)
+    return binary_codec.Multipart([json.dumps(names).encode('ascii')] + packed)
+
+def _server_release_results(results):
+    """Release each array registered for transfer whose name appears (at any
+    level of nesting) in the given dict of results, e.g. the images acquired by
+    plan steps whose results the client does not want."""
+    for name in _registered_names(results):
+        _server_release_array(name)
+
+def _pack_registered_array(name, compressor, downsample, compressor_args, blocked=False, session=None, bit_depth=None):
+    """Pack the named array with _pack_array(), and release it from the
+    transfer registry.
+
+    If the array is registered for transfer more than once (e.g. because
+    several clients asked for the same live image), the packed buffers are kept
+    until all of its transfers are released, so that requests with the same
+    packing options share them, rather than each compressing the array again.
+    (Packing for a delta-mode session is specific to that session, so is not
+    shared.)"""
+    key = None if session is not None else (compressor, downsample, blocked, bit_depth,
+        json.dumps(compressor_args, sort_keys=True))
+    with _registry_lock:
+        parts = _packed_cache.get(name, {}).get(key)
+    if parts is not None:
+        release_array(name)
+        return list(parts)
+    # only release the array once packed: a pooled frame could be overwritten once released
+    array = borrow_array(name)
+    try:
+        descr, *data = _pack_array(array, compressor, downsample, compressor_args, blocked, session, bit_depth)
+        if _parse_frame_name(name) is not None and numpy.may_share_memory(data[0], array):
+            # uncompressed data would be sent after the frame is released: send a copy
+            data = [data[0].copy()]
+        parts = [descr] + data
+        with _registry_lock:
+            if key is not None and len(_ism_buffer_registry.get(name, ())) > 1:
+                _packed_cache.setdefault(name, {})[key] = parts
+    finally:
+        release_array(name)
+    return list(parts)
+
+def _pack_array(array, compressor, downsample, compressor_args, blocked=False, session=None, bit_depth=None):
+    """Return a list of buffers: a JSON-encoded description of the array,
+    followed by its (possibly compressed) contents.
 
-    array = release_array(name) # get the array and release it from the list of to-be-transfered arrays
+    The description is a list of the dtype, shape, and order of the array,
+    optionally followed by a dict of further information about the contents:
+        'blocks': if blocked is True and the contents are to be compressed with
+            zlib, they are split into blocks of about _BLOCK_BYTES, which are
+            compressed in parallel and returned as separate buffers. This lists
+            the uncompressed size of each block. (blosc compression is
+            multithreaded internally, so blosc-compressed contents are not split.)
+        'delta': if a session is given (see _server_pack_data_multipart()), a
+            dict with the 'frame_id' of this frame, and the 'base' frame_id of
+            the reference frame the contents are a difference from, or None if
+            the contents are a full frame (a "keyframe"). The session may also
+            be a _KeyframeDelta instance, for frames published to many clients.
+        'bits': 12 if bit_depth is 12 or less, and the contents are uint16
+            values that all fit in 12 bits, in which case they are packed two
+            values to three bytes (see _pack_12_bit()) before compression."""
     if downsample:
         array = array[::downsample, ::downsample]
     dtype_str = numpy.lib.format.dtype_to_descr(array.dtype)
@@ -93,53 +346,268 @@ def _server_pack_data(name, compressor='blosc', downsample=None, **compressor_ar
     else:
         array = numpy.asfortranarray(array)
         order = 'F'
-    descr = json.dumps((dtype_str, array.shape, order)).encode('ascii')
-    output = bytearray(struct.pack('<H', len(descr))) # put the len of the descr in a 2-byte uint16
-    output += descr
+    descr = [dtype_str, array.shape, order]
+    extra = {}
+    if session is not None and compressor is not None:
+        # differences are only worth sending compressed
+        if isinstance(session, _KeyframeDelta):
+            array, extra['delta'] = session.encode(array)
+        else:
+            array, extra['delta'] = _delta_encode(array, *session)
+        if extra['delta']['base'] is not None and compressor == 'blosc' and 'shuffle' not in compressor_args:
+            import blosc
+            # the high bits of small differences are mostly zero, which bit-shuffling exploits much better
+            compressor_args = dict(compressor_args, shuffle=blosc.BITSHUFFLE)
+    flat = array.reshape(-1, order=order) # a 1D view onto the contiguous array: no copy
+    if bit_depth is not None and bit_depth <= 12 and array.dtype == numpy.uint16 and array.size and array.max() < 4096:
+        flat = _pack_12_bit(flat)
+        extra['bits'] = 12
     if compressor is None:
-        output += memoryview(array.flatten(order=order))
-    elif compressor == 'zlib':
+        data = [flat]
+    else:
+        compress = _get_compressor(compressor, compressor_args, flat.dtype.itemsize)
+        if blocked and compressor == 'zlib':
+            blocks = numpy.array_split(flat, max(1, round(flat.nbytes / _BLOCK_BYTES)))
+            extra['blocks'] = [block.nbytes for block in blocks]
+            data = list(_get_executor().map(compress, blocks))
+        else:
+            data = [compress(flat)]
+    if extra:
+        descr.append(extra)
+    return [json.dumps(descr).encode('ascii')] + data
+
+def _pack_12_bit(flat):
+    """Pack a 1D array of uint16 values less than 4096 into a uint8 array,
+    with each pair of values a, b stored in three bytes as: the low 8 bits of
+    a; the high 4 bits of a and the low 4 bits of b; the high 8 bits of b."""
+    if len(flat) % 2:
+        flat = numpy.append(flat, numpy.uint16(0))
+    a = flat[0::2]
+    b = flat[1::2]
+    packed = numpy.empty((len(a), 3), dtype=numpy.uint8)
+    packed[:, 0] = a & 0xFF
+    packed[:, 1] = (a >> 8) | ((b & 0xF) << 4)
+    packed[:, 2] = b >> 4
+    return packed.reshape(-1)
+
+def _unpack_12_bit(packed, count):
+    """Invert _pack_12_bit(), returning a 1D uint16 array of count values."""
+    triples = packed.reshape(-1, 3)
+    byte0, byte1, byte2 = (triples[:, i].astype(numpy.uint16) for i in range(3))
+    flat = numpy.empty((len(triples), 2), dtype=numpy.uint16)
+    flat[:, 0] = byte0 | ((byte1 & 0xF) << 8)
+    flat[:, 1] = (byte1 >> 4) | (byte2 << 4)
+    return flat.reshape(-1)[:count]
+
+class _DeltaSession:
+    def __init__(self):
+        """The last frame sent to a client in delta mode."""
+        self.reference = None
+        self.frame_id = 0
+        self.frames_since_keyframe = 0
+
+def _delta_encode(array, session_id, client_frame_id):
+    """Return the array (C- or F-contiguous) or its difference from the last
+    frame sent to the given session, and the 'delta' dict for the array
+    description (see _pack_array()).
+
+    A difference is only sent if the client reports that it holds the last
+    frame sent (i.e. client_frame_id matches), so a lost reply or a restarted
+    client or server simply results in a keyframe. Differences are taken
+    modulo the range of the (unsigned integer) dtype and zigzag-encoded, so
+    that small positive and negative differences both have mostly-zero high
+    bits, which compress well."""
+    with _delta_lock:
+        try:
+            state = _delta_sessions.pop(session_id)
+        except KeyError:
+            state = _DeltaSession()
+        _delta_sessions[session_id] = state # (re)insert as most recently used
+        if len(_delta_sessions) > _MAX_DELTA_SESSIONS:
+            _delta_sessions.popitem(last=False)
+    reference = state.reference
+    base = state.frame_id
+    if client_frame_id != base or state.frames_since_keyframe >= _KEYFRAME_INTERVAL or not _can_difference(array, reference):
+        contents = array
+        base = None
+        state.frames_since_keyframe = 0
+    else:
+        contents = _zigzag_difference(array, reference)
+        state.frames_since_keyframe += 1
+    # keep a copy: the array may be a pooled frame, which will be overwritten
+    state.reference = array.copy(order='K') if array.dtype.kind == 'u' else None
+    state.frame_id += 1
+    return contents, dict(frame_id=state.frame_id, base=base)
+
+class _KeyframeDelta:
+    def __init__(self):
+        """Delta encoding for frames that are published to any number of
+        clients, some of which may miss some frames (see live_frames). Unlike
+        _delta_encode(), each frame is sent as the difference from the last
+        keyframe, rather than from the previous frame, so a client can decode
+        any frame as long as it has received the keyframe before it. Set
+        keyframe_due to send a keyframe next (e.g. for a new client)."""
+        self.reference = None # the last keyframe
+        self.keyframe_id = None
+        self.frame_id = 0
+        self.frames_since_keyframe = 0
+        self.keyframe_due = True
+
+    def encode(self, array):
+        """Return the array (C- or F-contiguous) or its difference from the
+        last keyframe, and the 'delta' dict for the array description (see
+        _pack_array())."""
+        self.frame_id += 1
+        if self.keyframe_due or self.frames_since_keyframe >= _KEYFRAME_INTERVAL or not _can_difference(array, self.reference):
+            self.keyframe_due = False
+            self.frames_since_keyframe = 0
+            # keep a copy: the array may be a pooled frame, which will be overwritten
+            self.reference = array.copy(order='K') if array.dtype.kind == 'u' else None
+            self.keyframe_id = self.frame_id
+            return array, dict(frame_id=self.frame_id, base=None)
+        self.frames_since_keyframe += 1
+        return _zigzag_difference(array, self.reference), dict(frame_id=self.frame_id, base=self.keyframe_id)
+
+def _can_difference(array, reference):
+    """Return whether the array can be sent as a difference from the reference."""
+    return (reference is not None and array.dtype.kind == 'u' and reference.dtype == array.dtype
+        and reference.shape == array.shape and reference.flags.f_contiguous == array.flags.f_contiguous)
+
+def _zigzag_difference(array, reference):
+    """Return array - reference (modulo the range of the unsigned dtype),
+    with the sign of the difference folded into the low bit."""
+    difference = numpy.subtract(array, reference, dtype=array.dtype)
+    sign = difference >> (8 * array.dtype.itemsize - 1) # 1 for negative (i.e. wrapped) differences
+    sign *= numpy.iinfo(array.dtype).max
+    difference <<= 1
+    difference ^= sign
+    return difference
+
+def _undo_zigzag_difference(difference, reference):
+    """Invert _zigzag_difference() in place, given the same reference."""
+    sign = difference & 1
+    sign *= numpy.iinfo(difference.dtype).max
+    difference >>= 1
+    difference ^= sign
+    difference += reference
+    return difference
+
+def _get_compressor(compressor, compressor_args, typesize):
+    """Return a function that compresses a contiguous 1D array."""
+    if compressor == 'zlib':
         has_level_arg = 'level' in compressor_args
         if len(compressor_args) - has_level_arg > 0:
             raise RuntimeError('"level" is the only valid valid zlib compression option.')
         zlib_compressor_args = [compressor_args['level']] if has_level_arg else []
-        output += zlib.compress(array.flatten(order=order), *zlib_compressor_args)
+        return lambda flat: zlib.compress(flat, *zlib_compressor_args)
     elif compressor == 'blosc':
         import blosc
         # because blosc.compress can't handle a memoryview, we need to use blosc.compress_ptr
-        output += blosc.compress_ptr(array.ctypes.data, array.size, typesize=array.dtype.itemsize, **compressor_args)
+        return lambda flat: blosc.compress_ptr(flat.ctypes.data, flat.size, typesize=typesize, **compressor_args)
     else:
         raise RuntimeError('un-recognized compressor')
-    return output
+
+def _get_executor():
+    """Return the thread pool used to compress and decompress blocks in parallel.
+    (zlib releases the GIL while working on large buffers.)"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _executor
 
 def _client_unpack_data(buf, compressor='blosc'):
     """Unpack (on the client side) data packed (on the server side) by _server_pack_data().
     The compressor name passed to _server_pack_data() must also be passed
     to this function."""
     header_len = struct.unpack_from('<H', buf[:2])[0]
-    dtype, shape, order = json.loads(bytes(buf[2:header_len+2]).decode('ascii'))
-    array_buf = buf[header_len+2:]
+    return _client_unpack_parts([buf[2:header_len+2], buf[header_len+2:]], compressor)
+
+def _client_unpack_parts(parts, compressor='blosc'):
+    """Unpack (on the client side) the buffers returned by
+    _server_pack_data_multipart(). The compressor name passed to the server
+    must also be passed to this function. Uncompressed data are not copied:
+    the array is a view onto the received buffer."""
+    return _decode_parts(parts, compressor)[0]
+
+def _client_unpack_many(parts, compressor='blosc'):
+    """Unpack (on the client side) the buffers returned by _server_pack_many()
+    into a list of arrays, decompressing zlib-compressed arrays in parallel."""
+    counts = json.loads(bytes(parts[0]).decode('ascii'))
+    offsets = numpy.cumsum([1] + counts)
+    groups = [parts[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    unpack = lambda group: _client_unpack_parts(group, compressor)
+    if compressor == 'zlib' and len(groups) > 1: # (arrays packed together are never blocked)
+        return list(_get_executor().map(unpack, groups))
+    return [unpack(group) for group in groups]
+
+def _client_unpack_results(parts, compressor='blosc'):
+    """Unpack (on the client side) the buffers returned by
+    _server_pack_results() into a dict mapping names to arrays."""
+    names = json.loads(bytes(parts[0]).decode('ascii'))
+    return dict(zip(names, _client_unpack_many(parts[1:], compressor)))
+
+def _decode_parts(parts, compressor):
+    """Unpack as with _client_unpack_parts(), and return the array along
+    with the dict of further information from its description (see
+    _pack_array()). If this contains 'delta' information, the array may need
+    to be added to a reference frame: see _NetworkGetData."""
+    descr, *data = parts
+    dtype, shape, order, *extra = json.loads(bytes(descr).decode('ascii'))
+    extra = extra[0] if extra else {}
+    if extra.get('bits') == 12:
+        count = int(numpy.prod(shape))
+        buffer_dtype, buffer_shape, buffer_order = numpy.uint8, [(count + 1) // 2 * 3], 'C'
+    else:
+        buffer_dtype, buffer_shape, buffer_order = dtype, shape, order
+    if 'blocks' in extra:
+        array = _unpack_blocks(data, extra['blocks'], compressor, buffer_dtype, buffer_shape, buffer_order)
+    else:
+        array = _unpack_buffer(data, compressor, buffer_dtype, buffer_shape, buffer_order)
+    if extra.get('bits') == 12:
+        array = _unpack_12_bit(array, count).reshape(shape, order=order)
+    return array, extra
+
+def _unpack_buffer(data, compressor, dtype, shape, order):
+    array_buf, = data
     # NB: If this function exits with an exception involving zero-length slices, please upgrade your pyzmq
     # installation (the issue is known to be fixed pyzmq 14.6.0, and at the time this comment was written,
     # "pip-3.4 install pyzmq" grabbed 14.7.0).
     if compressor is None:
         data = array_buf
     elif compressor == 'zlib':
-        data = zlib.decompress(array_buf)
+        # zlib returns read-only bytes: copy to a writable buffer
+        data = bytearray(zlib.decompress(array_buf))
     elif compressor == 'blosc':
-        import blosc
-        try:
-            # This works as of June 2 (pyblosc git repo commit ID 487fe5531abc38faebd47b92a34991a1489a7ac3)
-            data = blosc.decompress(array_buf)
-        except TypeError:
-            # However, as of Aug 11 2015, the version of pyblosc installed by pip-3.4 does not yet include
-            # the fix, so most lab machines will fall through to the following legacy method, which copies
-            # to a temporary intermediate buffer
-            data = blosc.decompress(bytes(array_buf))
+        # decompress directly into a new (writable) array
+        array = numpy.empty(shape, dtype=dtype, order=order)
+        _blosc_decompress_into(array_buf, array.ctypes.data)
+        return array
     array = numpy.ndarray(shape, dtype=dtype, order=order, buffer=data)
     array.flags.writeable = True
     return array
 
+def _unpack_blocks(blocks, block_sizes, compressor, dtype, shape, order):
+    """Decompress blocks produced by _pack_array(blocked=True) in parallel,
+    directly into a new array."""
+    array = numpy.empty(shape, dtype=dtype, order=order)
+    target = array.reshape(-1, order=order).view(numpy.uint8) # a 1D byte view onto the array
+    offsets = numpy.cumsum([0] + block_sizes)
+    def decompress(i):
+        if compressor != 'zlib':
+            raise RuntimeError('un-recognized compressor for blocked data')
+        target[offsets[i]:offsets[i+1]] = numpy.frombuffer(zlib.decompress(blocks[i]), dtype=numpy.uint8)
+    list(_get_executor().map(decompress, range(len(blocks))))
+    return array
+
+def _blosc_decompress_into(buf, address):
+    import blosc
+    try:
+        blosc.decompress_ptr(buf, address)
+    except TypeError:
+        # older versions of pyblosc can't handle memoryviews, so copy to a temporary intermediate buffer
+        blosc.decompress_ptr(bytes(buf), address)
+
 def _server_get_node():
     return platform.node()
 
@@ -159,40 +627,230 @@ def client_get_data_getter(rpc_client, force_remote=False):
         is_local = rpc_client('_transfer_ism_buffer._server_get_node') == platform.node()
 
     if is_local: # on same machine -- use ISM buffer directly
-        def get_data(name):
-            array = ism_buffer.open(name).asarray()
-            rpc_client('_transfer_ism_buffer._server_release_array', name)
-            return array
+        get_data = _LocalGetData(rpc_client)
     else: # pipe data over network
-        class GetData:
-            def __init__(self):
-                self.downsample = None
-                self.compressor_args = {}
-                try:
-                    import blosc
-                    self.compressor = 'blosc'
-                    self.compressor_args['cname'] = 'lz4'
-                except ImportError:
-                    self.compressor = 'zlib'
-                    self.compressor_args['level'] = 2
-
-            def set_network_compression(self, compressor, downsample=None, **compressor_args):
-                """Set the type of compression applied to images sent over the
-                network.
-
-                Parameters:
-                    compressor: what compression method to use. Valid choices:
-                      - None: pack raw image bytes
-                      - 'blosc': use the fast, modern BLOSC compression library
-                      - 'zlib': use older, more widely supported zlib compression
-                    downsample: int / None. If not None, return every nth pixel.
-                    compressor_args: passed to zlib.compress() or blosc.compress() directly."""
-                self.compressor = compressor
-                self.compressor_args = compressor_args
-                self.downsample = downsample
-
-            def __call__(self, name):
-                data = rpc_client('_transfer_ism_buffer._server_pack_data', name, self.compressor, self.downsample, **self.compressor_args)
-                return _client_unpack_data(data, self.compressor)
-        get_data = GetData()
+        get_data = _NetworkGetData(rpc_client)
+    return is_local, get_data
+
+async def async_client_get_data_getter(rpc_client, force_remote=False):
+    """Version of client_get_data_getter() for use with an asyncio RPC client
+    (e.g. rpc_client.AsyncZMQClient). Returns is_local and get_data, where
+    get_data() is a coroutine function."""
+    if force_remote:
+        is_local = False
+    else:
+        is_local = await rpc_client('_transfer_ism_buffer._server_get_node') == platform.node()
+
+    if is_local:
+        get_data = _AsyncLocalGetData(rpc_client)
+    else:
+        get_data = _AsyncNetworkGetData(rpc_client)
     return is_local, get_data
+
+class _LocalGetData:
+    _MAX_OPEN_SLOTS = 32
+
+    def __init__(self, rpc_client):
+        """Get arrays from ISM_Buffers on the same machine as the server.
+
+        Arrays that are not pooled frames are released from the server's
+        transfer registry at once, as the ISM_Buffer stays open as long as the
+        array is in use. Pooled frames (see FramePool) are instead released
+        once the returned array (and any views onto it) are no longer in use,
+        so that the server does not reuse the frame's slot in the meantime.
+        These releases are sent to the server at the next call.
+
+        The ISM_Buffers of pooled frames' slots are kept open, so that they
+        need not be mapped anew for each frame."""
+        self.rpc_client = rpc_client
+        self._open_slots = collections.OrderedDict() # slot names to open ISM_Buffers
+        self._finished_frames = collections.deque() # names of pooled frames to release
+
+    def _get_array(self, name):
+        if '#' not in name:
+            return ism_buffer.open(name).asarray(), True
+        slot_name = name.rsplit('#', 1)[0]
+        try:
+            buffer = self._open_slots.pop(slot_name)
+        except KeyError:
+            buffer = ism_buffer.open(slot_name)
+        self._open_slots[slot_name] = buffer # (re)insert as most recently used
+        if len(self._open_slots) > self._MAX_OPEN_SLOTS:
+            self._open_slots.popitem(last=False)
+        lease = _FrameLease(buffer.asarray())
+        weakref.finalize(lease, self._finished_frames.append, name)
+        return numpy.asarray(lease), False
+
+    def _names_to_release(self):
+        names = []
+        while self._finished_frames:
+            names.append(self._finished_frames.popleft())
+        return names
+
+    def __call__(self, name):
+        array, release_now = self._get_array(name)
+        names = self._names_to_release()
+        if release_now:
+            names.append(name)
+        for name in names:
+            self.rpc_client('_transfer_ism_buffer._server_release_array', name)
+        return array
+
+    def get_many(self, names):
+        """Return a list of the arrays with the given names."""
+        return [self(name) for name in names]
+
+class _AsyncLocalGetData(_LocalGetData):
+    async def __call__(self, name):
+        array, release_now = self._get_array(name)
+        names = self._names_to_release()
+        if release_now:
+            names.append(name)
+        for name in names:
+            await self.rpc_client('_transfer_ism_buffer._server_release_array', name)
+        return array
+
+    async def get_many(self, names):
+        return [await self(name) for name in names]
+
+class _FrameLease:
+    """Exposes an array via the array interface, so that a finalizer on
+    this object runs when no arrays based on it remain."""
+    def __init__(self, array):
+        self._array = array # keep the underlying buffer open
+        self.__array_interface__ = array.__array_interface__
+
+class _NetworkGetData:
+    _MAX_MANY = 8 # number of arrays to fetch per call in get_many(), to limit the size of each reply
+
+    def __init__(self, rpc_client):
+        self.rpc_client = rpc_client
+        self.downsample = None
+        self.blocked = True
+        self.delta = False
+        self.bit_packing = None
+        self.bit_depth = None # bit depth of the camera's images, if known (kept up to date by ScopeClient)
+        self.compressor_args = {}
+        self._session_id = uuid.uuid4().hex
+        self._reference = None # last frame received in delta mode
+        self._reference_id = None
+        self._prefetched = {} # names to arrays sent along with the results of a plan
+        try:
+            import blosc
+            self.compressor = 'blosc'
+            self.compressor_args['cname'] = 'lz4'
+        except ImportError:
+            self.compressor = 'zlib'
+            self.compressor_args['level'] = 2
+
+    def set_network_compression(self, compressor, downsample=None, blocked=True, delta=False, bit_packing=None,
+            **compressor_args):
+        """Set the type of compression applied to images sent over the
+        network.
+
+        Parameters:
+            compressor: what compression method to use. Valid choices:
+              - None: pack raw image bytes
+              - 'blosc': use the fast, modern BLOSC compression library
+              - 'zlib': use older, more widely supported zlib compression
+            downsample: int / None. If not None, return every nth pixel.
+            blocked: if True, zlib-compressed images are split into blocks that
+                are compressed and decompressed in parallel, using multiple cores.
+                (blosc compression is always multithreaded.)
+            delta: if True, and images are compressed, the server may send the
+                difference from the previous image it sent to this client,
+                with a full image sent periodically. This greatly reduces the
+                data sent for live images of a mostly-unchanging scene, at the
+                cost of keeping a copy of the previous image on the client and
+                the server.
+            bit_packing: if True, images from a camera in a 12-bit (or lower)
+                mode are sent packed into 12 bits per pixel, which cuts the data
+                to be compressed (or sent) by 25%. If None, only do so for
+                uncompressed images: bit-packing defeats blosc's byte-shuffling,
+                so blosc compresses packed data worse, and zlib compresses
+                packed data to about the same size as unpacked data.
+            compressor_args: passed to zlib.compress() or blosc.compress() directly."""
+        self.compressor = compressor
+        self.compressor_args = compressor_args
+        self.downsample = downsample
+        self.blocked = blocked
+        self.delta = delta
+        self.bit_packing = bit_packing
+
+    def packed_bit_depth(self):
+        """Return the bit depth that the server is asked to pack images to, or None."""
+        bit_packing = self.compressor is None if self.bit_packing is None else self.bit_packing
+        return self.bit_depth if bit_packing else None
+
+    def _args(self, name):
+        session = (self._session_id, self._reference_id) if self.delta else None
+        return ('_transfer_ism_buffer._server_pack_data_multipart', name, self.compressor, self.downsample,
+            self.blocked, session, self.packed_bit_depth())
+
+    def plan_pack(self, names):
+        """Return the 'pack' argument for a __PLAN__ call that has the server
+        send the images named in the given plan results along with the reply,
+        packed with the current compression options. Pass the buffers returned
+        to prefetch()."""
+        return dict(call='_transfer_ism_buffer._server_pack_results', names=names,
+            args=[self.compressor, self.downsample, self.blocked, self.packed_bit_depth()], kwargs=self.compressor_args)
+
+    def prefetch(self, parts):
+        """Unpack the buffers packed by a plan_pack() request, so that getting
+        these images does not require further calls to the server."""
+        self._prefetched.update(_client_unpack_results(parts, self.compressor))
+
+    def _unpack(self, parts):
+        array, extra = _decode_parts(parts, self.compressor)
+        delta = extra.get('delta')
+        if delta is None:
+            self._reference = self._reference_id = None
+        else:
+            if delta['base'] is not None:
+                if delta['base'] != self._reference_id:
+                    raise RuntimeError('Image difference received without the matching reference image (delta-mode transfers must not overlap)')
+                array = _undo_zigzag_difference(array, self._reference)
+            # keep a copy: the caller may modify the returned array
+            self._reference = array.copy(order='K')
+            self._reference_id = delta['frame_id']
+        return array
+
+    def __call__(self, name):
+        if name in self._prefetched:
+            return self._prefetched.pop(name)
+        return self._unpack(self.rpc_client(*self._args(name), **self.compressor_args))
+
+    def _batches(self, names):
+        for i in range(0, len(names), self._MAX_MANY):
+            yield ('_transfer_ism_buffer._server_pack_many', names[i:i+self._MAX_MANY], self.compressor,
+                self.downsample, self.blocked, self.packed_bit_depth())
+
+    def get_many(self, names):
+        """Return a list of the arrays with the given names, fetching several
+        arrays per call. (Delta mode does not apply.)"""
+        arrays = self._take_prefetched(names)
+        for args in self._batches([name for name in names if name not in arrays]):
+            arrays.update(zip(args[1], _client_unpack_many(self.rpc_client(*args, **self.compressor_args), self.compressor)))
+        return [arrays[name] for name in names]
+
+    def _take_prefetched(self, names):
+        return {name: self._prefetched.pop(name) for name in names if name in self._prefetched}
+
+class _AsyncNetworkGetData(_NetworkGetData):
+    _delta_lock = None
+
+    async def __call__(self, name):
+        if name in self._prefetched:
+            return self._prefetched.pop(name)
+        if not self.delta:
+            return self._unpack(await self.rpc_client(*self._args(name), **self.compressor_args))
+        if self._delta_lock is None:
+            self._delta_lock = asyncio.Lock()
+        async with self._delta_lock: # each transfer needs the reference image from the one before
+            return self._unpack(await self.rpc_client(*self._args(name), **self.compressor_args))
+
+    async def get_many(self, names):
+        arrays = self._take_prefetched(names)
+        for args in self._batches([name for name in names if name not in arrays]):
+            arrays.update(zip(args[1], _client_unpack_many(await self.rpc_client(*args, **self.compressor_args), self.compressor)))
+        return [arrays[name] for name in names]